@@ -1,30 +1,133 @@
-from django.contrib import admin
-from .models import (Item, OrderItem, Cart, Address, Category, Comment,
-                     Payment, Coupon, Refund, UserProfile)
+from django.contrib import admin, messages
+from django.contrib.auth import get_user_model
+from django.contrib.auth.admin import UserAdmin
+from django.db.models import Q
+from django.urls import reverse
+from . import refunds
+from .models import (Item, OrderItem, OrderLine, Cart, Address, Category, Comment,
+                     Payment, Coupon, Refund, UserProfile, REFUND_GRANTED, REFUND_FAILED)
+from .pagination import CachedCountPaginator
+from .search import get_search_backend
 
-admin.site.register(UserProfile)
-admin.site.register(Item)
+User = get_user_model()
+
+# Change forms pick users, items, addresses and coupons through search-backed autocompletes and
+# the rest through raw ids, instead of a <select> listing every row of the table
+
+# Sorts after every string starting with the prefix it is appended to
+PREFIX_END = '\U0010ffff'
+
+
+def prefix_q(field, term):
+    """
+    Rows whose field starts with the term, case-sensitively
+    A range rather than istartswith, which compiles to LIKE ... ESCAPE and scans the whole table,
+    so the field's index serves it.
+    """
+    return Q(**{f'{field}__gte': term, f'{field}__lt': term + PREFIX_END})
+
+
+class CustomerAdmin(UserAdmin):
+    def get_search_results(self, request, queryset, search_term):
+        # Autocompletes match the start of the username through its unique index, the user list
+        # keeps UserAdmin's search of usernames, names and emails
+        search_term = search_term.strip()
+        if request.path != reverse('admin:autocomplete') or not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        return queryset.filter(prefix_q('username', search_term)), False
+
+
+admin.site.unregister(User)
+admin.site.register(User, CustomerAdmin)
+
+
+class UserProfileAdmin(admin.ModelAdmin):
+    class Meta:
+        model = UserProfile
+    list_select_related = ['user']
+    autocomplete_fields = ['user']
+
+
+admin.site.register(UserProfile, UserProfileAdmin)
+
+
+class ItemAdmin(admin.ModelAdmin):
+    class Meta:
+        model = Item
+    search_fields = ['item_name']
+    ordering = ['id']
+    # Every liker would be an option, the ids are enough
+    raw_id_fields = ['likes']
+    # Kept by toggle_like and the likes and comment signals
+    readonly_fields = ['like_count', 'comment_count']
+
+    def get_search_results(self, request, queryset, search_term):
+        # Served by the catalog's search index rather than a LIKE over every item
+        if not search_term.strip():
+            return queryset, False
+        return get_search_backend().search(queryset, search_term), False
+
+
+admin.site.register(Item, ItemAdmin)
 admin.site.register(Category)
 
 
-class OrderAdmin(admin.ModelAdmin):
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Changelist for tables growing with every order
+    The filtered count is cached by CachedCountPaginator and the count of the whole table, only
+    shown next to search results, is skipped. Subclasses list the relations their columns print in
+    list_select_related, so a page costs the same few queries whatever its size.
+    """
+    paginator = CachedCountPaginator
+    show_full_result_count = False
+
+
+class OrderAdmin(LargeTableAdmin):
     class Meta:
         model = OrderItem
 
     list_display = ["__str__", 'ordered']
+    list_select_related = ['item']
+    autocomplete_fields = ['user', 'item']
 
 
 admin.site.register(OrderItem, OrderAdmin)
 
 
-def update_refund_request_to_true(model_admin, request, query_set):
-    query_set.update(refund_requested=False, refund_granted=True)
+# Failed orders listed one by one after a refund run, the rest are left to the refund list
+REPORTED_FAILURES = 20
+
 
+@admin.action(description="Refund the selected orders")
+def grant_refunds(model_admin, request, query_set):
+    processed = refunds.grant_refunds(query_set)
+    granted = [refund for refund in processed if refund.status == REFUND_GRANTED]
+    failed = [refund for refund in processed if refund.status == REFUND_FAILED]
+    if granted:
+        model_admin.message_user(request, f"Refunded {len(granted)} orders", messages.SUCCESS)
+    for refund in failed[:REPORTED_FAILURES]:
+        model_admin.message_user(request, f"Order {refund.reference_code} was not refunded: {refund.error}",
+                                 messages.ERROR)
+    if len(failed) > REPORTED_FAILURES:
+        model_admin.message_user(request, f"{len(failed) - REPORTED_FAILURES} more orders were not refunded, "
+                                          "see the failed refunds", messages.ERROR)
+    if not processed:
+        model_admin.message_user(request, "None of the selected orders is waiting for a refund", messages.INFO)
 
-update_refund_request_to_true.short_description_message = "Update orders to refund granted"
 
+class OrderLineInline(admin.TabularInline):
+    model = OrderLine
+    fields = ['item_name', 'price', 'discount_price', 'quantity', 'line_total']
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
 
-class CartAdmin(admin.ModelAdmin):
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class CartAdmin(LargeTableAdmin):
     class Meta:
         model = Cart
 
@@ -52,29 +155,98 @@ class CartAdmin(admin.ModelAdmin):
                    'refund_requested',
                    'refund_granted'
                    ]
-    search_fields = ['user__username', 'reference_code']
-    actions = [update_refund_request_to_true]
+    # Addresses and payments print their user's name
+    list_select_related = ['user', 'billing_address__user', 'shipping_address__user', 'payment__user', 'coupon']
+    search_fields = ['reference_code__exact', 'user__username__exact']
+    actions = [grant_refunds]
+    inlines = [OrderLineInline]
+    autocomplete_fields = ['user', 'billing_address', 'shipping_address', 'coupon']
+    raw_id_fields = ['items', 'payment']
+
+    def get_search_results(self, request, queryset, search_term):
+        # Exact matches on indexed columns, the default search joins auth_user and LIKEs every order
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        users = User.objects.filter(username=search_term)
+        return queryset.filter(Q(reference_code=search_term) | Q(user__in=users)), False
 
 
 admin.site.register(Cart, CartAdmin)
-admin.site.register(Address)
-admin.site.register(Payment)
-admin.site.register(Coupon)
 
 
-class RefundAdmin(admin.ModelAdmin):
+class AddressAdmin(admin.ModelAdmin):
+    class Meta:
+        model = Address
+    list_display = ['__str__', 'address_type', 'zip_code', 'is_default']
+    list_select_related = ['user']
+    search_fields = ['user__username', 'zip_code']
+    ordering = ['-id']
+    autocomplete_fields = ['user']
+
+    def get_search_results(self, request, queryset, search_term):
+        # Prefixes of the username or the zip code, through the user and zip code indexes
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        users = User.objects.filter(prefix_q('username', search_term))
+        return queryset.filter(Q(user__in=users) | prefix_q('zip_code', search_term)), False
+
+
+admin.site.register(Address, AddressAdmin)
+
+
+class PaymentAdmin(LargeTableAdmin):
+    class Meta:
+        model = Payment
+    list_display = ['__str__', 'amount', 'date']
+    list_select_related = ['user']
+    search_fields = ['stripe_charge_id__exact', 'ssl_charge_id__exact']
+    autocomplete_fields = ['user']
+
+
+admin.site.register(Payment, PaymentAdmin)
+
+
+class CouponAdmin(admin.ModelAdmin):
+    class Meta:
+        model = Coupon
+    list_display = ['coupon', 'amount', 'times_used', 'max_uses', 'valid_until']
+    search_fields = ['coupon']
+    ordering = ['coupon']
+    # Counted by core.coupons as orders using the coupon are paid
+    readonly_fields = ['times_used']
+
+    def get_search_results(self, request, queryset, search_term):
+        # Prefixes of the code, through its unique index
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        return queryset.filter(prefix_q('coupon', search_term)), False
+
+
+admin.site.register(Coupon, CouponAdmin)
+
+
+class RefundAdmin(LargeTableAdmin):
     class Meta:
         model = Refund
-    list_display = ['__str__', 'order']
+    list_display = ['__str__', 'order', 'status', 'processed_date']
+    list_filter = ['status']
+    list_select_related = ['order__user']
+    search_fields = ['reference_code__exact']
+    raw_id_fields = ['order']
 
 
 admin.site.register(Refund, RefundAdmin)
 
 
-class CommentAdmin(admin.ModelAdmin):
+class CommentAdmin(LargeTableAdmin):
     class Meta:
         model = Comment
     list_display = ['__str__', 'user']
+    list_select_related = ['user']
+    autocomplete_fields = ['user', 'item']
 
 
 admin.site.register(Comment, CommentAdmin)
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+# How each profile opens its transactions and the PRAGMAs it runs on every new connection, the
+# profile in use is named by the SQLITE_PROFILE setting
+SQLITE_PROFILES = {
+    # Django's own behaviour, spelled out so that going back from production also leaves WAL
+    'default': {
+        'transaction_mode': 'DEFERRED',
+        'pragmas': {
+            'journal_mode': 'DELETE',
+            'synchronous': 'FULL',
+        },
+    },
+    'production': {
+        # Take the write lock when the transaction begins, waiting for it under busy_timeout. A deferred
+        # transaction that reads first fails at once with "database is locked" when it has to write
+        # after another writer committed.
+        'transaction_mode': 'IMMEDIATE',
+        'pragmas': {
+            # Readers no longer wait for the writer, and a commit only appends to the log
+            'journal_mode': 'WAL',
+            # Durable enough with WAL, a power cut may lose the last commits but never corrupts the file
+            'synchronous': 'NORMAL',
+            # Page cache per connection, negative values are in KiB
+            'cache_size': -64000,
+            # Read the file through a memory map instead of read() calls
+            'mmap_size': 256 * 1024 * 1024,
+            # Wait this many ms for a busy lock before giving up with "database is locked"
+            'busy_timeout': 5000,
+            'temp_store': 'MEMORY',
+        },
+    },
+}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    The SQLite backend set up by the profile named in the SQLITE_PROFILE setting
+    Does what the init_command and transaction_mode OPTIONS of Django 5.1 do, so on 5.1 the
+    profile can move to OPTIONS and the stock backend.
+    """
+    @property
+    def profile(self):
+        return SQLITE_PROFILES[settings.SQLITE_PROFILE]
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.profile['pragmas'].items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        # Closed here even when BEGIN gives up on the lock. Left to the traceback, the cursor would
+        # be freed by the garbage collector of whichever thread runs next, which then blocks on
+        # this connection, holding the GIL, while another BEGIN of it waits out busy_timeout.
+        with self.cursor() as cursor:
+            cursor.execute(f"BEGIN {self.profile['transaction_mode']}")
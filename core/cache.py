@@ -0,0 +1,150 @@
+import hashlib
+import time
+from functools import wraps
+
+from django.contrib import messages
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+from .models import OrderItem
+from .routers import primary_reads
+
+CART_COUNT_TIMEOUT = 60 * 60 * 24
+CATALOG_VERSION_KEY = 'core:catalog_version'
+# Fragments are keyed by the catalog version, so they are never stale and only expire to free memory
+CATALOG_CACHE_TIMEOUT = 60 * 60 * 24
+PAGE_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def cart_version_key(user_id):
+    return f'core:cart_version:{user_id}'
+
+
+def cart_count_key(user_id, version):
+    return f'core:cart_count:{user_id}:{version}'
+
+
+def get_cart_count(user):
+    """
+    Number of lines in the user's open cart, as shown on the navbar badge
+    Memoised on the user object for the rest of the request and cached per user under the version
+    of their cart, so drawing the badge usually runs no query at all. The version is read before
+    counting, a count taken just before a cart change commits is stored under the version that
+    change moves away from and never shown.
+    """
+    if not hasattr(user, '_cart_count'):
+        key = cart_count_key(user.pk, get_version(cart_version_key(user.pk), CART_COUNT_TIMEOUT))
+        count = cache.get(key)
+        if count is None:
+            # Cart data only ever comes from the primary, the badge is drawn on replica views too
+            with primary_reads():
+                count = OrderItem.objects.filter(cart__user=user, cart__ordered=False).count()
+            cache.set(key, count, CART_COUNT_TIMEOUT)
+        user._cart_count = count
+    return user._cart_count
+
+
+def invalidate_cart_count(user_id):
+    """
+    Move the user's cart on to a new version once the current transaction commits
+    Any earlier would let a concurrent request cache the count from before the change under the new version.
+    """
+    bump_version(cart_version_key(user_id), CART_COUNT_TIMEOUT)
+
+
+def get_version(key, timeout=None):
+    """
+    Version of the data covered by key, part of the key of everything cached from that data
+    Versions are the time of the last change in nanoseconds, so they double as Last-Modified. Being
+    taken from the clock also means a version lost to eviction or a restart does not come back
+    and match what was cached under it earlier.
+    """
+    version = cache.get(key)
+    if version is None:
+        version = time.time_ns()
+        if not cache.add(key, version, timeout):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_version(key, timeout=None):
+    """
+    Move key on to a new version once the current transaction commits, which orphans everything
+    cached under the old one
+    """
+    def bump():
+        cache.set(key, max(time.time_ns(), cache.get(key, 0) + 1), timeout)
+    transaction.on_commit(bump)
+
+
+def get_catalog_version():
+    # Covers every item and category
+    return get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    bump_version(CATALOG_VERSION_KEY)
+
+
+def item_version_key(slug):
+    return f'core:item_version:{slug}'
+
+
+def get_item_version(slug):
+    # Covers what the product page shows besides the item itself, its likes and comments
+    return get_version(item_version_key(slug))
+
+
+def bump_item_version(slug):
+    bump_version(item_version_key(slug))
+
+
+def cache_anonymous_page(get_versions):
+    """
+    Cache the pages of a view for anonymous visitors, keyed by the versions of the data they show
+    get_versions receives the URL kwargs of the view and returns those versions. Pages carry a strong
+    ETag and a Last-Modified built from them, so a revalidating browser gets a 304 without the view
+    running. Logged-in users, visitors with pending messages and anything that is not a plain 200
+    GET are passed through uncached.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if (request.method not in ('GET', 'HEAD') or request.user.is_authenticated
+                    or len(messages.get_messages(request))):
+                response = view(request, *args, **kwargs)
+                patch_vary_headers(response, ('Cookie',))
+                return response
+            versions = get_versions(**kwargs)
+            etag = '"%s"' % hashlib.md5(f'{request.get_full_path()}:{versions}'.encode()).hexdigest()
+            last_modified = max(versions) // 10 ** 9
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                key = f'core:page:{etag}'
+                cached = cache.get(key)
+                if cached is None:
+                    # Rendered from the primary, the page is cached under the versions read from it
+                    with primary_reads():
+                        response = view(request, *args, **kwargs)
+                        if hasattr(response, 'render'):
+                            response = response.render()
+                    # Anything tied to this visitor must not be handed to the next one
+                    if (response.status_code != 200 or response.cookies
+                            or request.META.get('CSRF_COOKIE_NEEDS_UPDATE')):
+                        patch_vary_headers(response, ('Cookie',))
+                        return response
+                    cache.set(key, (response.content, response['Content-Type']), PAGE_CACHE_TIMEOUT)
+                else:
+                    content, content_type = cached
+                    response = HttpResponse(content, content_type=content_type)
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            # Shared caches may keep the page, but have to check it is still current before reuse
+            patch_cache_control(response, public=True, no_cache=True)
+            patch_vary_headers(response, ('Cookie',))
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,198 @@
+import logging
+import secrets
+import string
+
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from .cache import invalidate_cart_count
+from .models import Cart, OrderItem, OrderLine, Payment
+
+logger = logging.getLogger(__name__)
+
+# What a cart mutation did, so the views can tell the user
+ADDED = 'added'
+UPDATED = 'updated'
+REMOVED = 'removed'
+NOT_IN_CART = 'not_in_cart'
+NO_CART = 'no_cart'
+
+# The Payment field holding the gateway's transaction id, by payment type
+CHARGE_ID_FIELDS = {
+    'S': 'stripe_charge_id',
+}
+DEFAULT_CHARGE_ID_FIELD = 'ssl_charge_id'
+
+REFERENCE_CODE_ALPHABET = string.ascii_letters + string.digits
+REFERENCE_CODE_LENGTH = 20
+
+
+def generate_reference_code():
+    # Drawn from the OS's CSPRNG, 119 bits a code, the unique index on Cart.reference_code backs it up
+    return "".join(secrets.choice(REFERENCE_CODE_ALPHABET) for _ in range(REFERENCE_CODE_LENGTH))
+
+
+def get_open_cart(user, lock=False):
+    """
+    The cart the user is still shopping with, or None
+    With lock=True the cart row stays locked until the surrounding transaction ends
+    """
+    queryset = Cart.objects.filter(user=user, ordered=False)
+    if lock:
+        queryset = queryset.select_for_update()
+    return queryset.first()
+
+
+def get_or_create_open_cart(user, lock=True):
+    """
+    The user's open cart, created when there is none
+    The one_open_cart_per_user constraint makes the loser of a creation race fail with an
+    IntegrityError, in which case the cart the winner created is returned instead.
+    """
+    cart = get_open_cart(user, lock=lock)
+    if cart is not None:
+        return cart
+    try:
+        with transaction.atomic():
+            return Cart.objects.create(user=user, ordered_date=timezone.now())
+    except IntegrityError:
+        return get_open_cart(user, lock=lock)
+
+
+def _add_line(cart, user, item_id, quantity=1):
+    order_item = OrderItem.objects.create(user=user, item_id=item_id, quantity=quantity)
+    Cart.items.through.objects.create(cart=cart, orderitem=order_item)
+    return order_item
+
+
+def add_item(user, item):
+    """
+    Add one unit of the item to the user's open cart, creating the cart or the line when needed
+    The quantity is bumped with an UPDATE ... SET quantity = quantity + 1 so concurrent clicks add up.
+    That update runs first, so a repeat click is a single query and the transaction holds the
+    write lock from its first statement on.
+    """
+    with transaction.atomic():
+        open_lines = OrderItem.objects.filter(cart__user=user, cart__ordered=False, item=item)
+        if open_lines.update(quantity=F('quantity') + 1):
+            return UPDATED
+        cart = get_or_create_open_cart(user)
+        # Another request may have added the line while this one waited for the cart lock
+        if OrderItem.objects.filter(cart=cart, item=item).update(quantity=F('quantity') + 1):
+            return UPDATED
+        _add_line(cart, user, item.pk)
+        return ADDED
+
+
+def remove_item(user, item):
+    """
+    Remove the item's line from the user's open cart whatever its quantity
+    """
+    with transaction.atomic():
+        cart = get_open_cart(user, lock=True)
+        if cart is None:
+            return NO_CART
+        deleted, _ = OrderItem.objects.filter(cart=cart, item=item).delete()
+        return REMOVED if deleted else NOT_IN_CART
+
+
+def remove_single_item(user, item):
+    """
+    Take one unit of the item out of the user's open cart, the line goes away with its last unit
+    """
+    with transaction.atomic():
+        cart = get_open_cart(user, lock=True)
+        if cart is None:
+            return NO_CART
+        lines = OrderItem.objects.filter(cart=cart, item=item)
+        if lines.filter(quantity__gt=1).update(quantity=F('quantity') - 1):
+            return UPDATED
+        deleted, _ = lines.delete()
+        return REMOVED if deleted else NOT_IN_CART
+
+
+def set_quantities(user, quantities):
+    """
+    Set the quantities of several items in the user's open cart at once
+    quantities maps items (or item ids) to their new quantity, 0 or less removes the line. The
+    lines are read once and written with one bulk update, insert and delete, so the number of
+    queries stays the same however many items are passed. A cart is only created when there are
+    lines to put in it, returns the cart or None when there is none.
+    """
+    quantities = {getattr(item, 'pk', item): quantity for item, quantity in quantities.items()}
+    with transaction.atomic():
+        cart = get_open_cart(user, lock=True)
+        if cart is None:
+            if not any(quantity > 0 for quantity in quantities.values()):
+                return None
+            cart = get_or_create_open_cart(user)
+        lines = {line.item_id: line for line in OrderItem.objects.filter(cart=cart, item_id__in=quantities)}
+        to_create, to_update, to_delete = [], [], []
+        for item_id, quantity in quantities.items():
+            line = lines.get(item_id)
+            if quantity <= 0:
+                if line is not None:
+                    to_delete.append(line.pk)
+            elif line is None:
+                to_create.append(OrderItem(user=user, item_id=item_id, quantity=quantity))
+            elif line.quantity != quantity:
+                line.quantity = quantity
+                to_update.append(line)
+        if to_delete:
+            OrderItem.objects.filter(pk__in=to_delete).delete()
+        if to_update:
+            OrderItem.objects.bulk_update(to_update, ['quantity'])
+        if to_create:
+            OrderItem.objects.bulk_create(to_create)
+            Cart.items.through.objects.bulk_create(
+                [Cart.items.through(cart=cart, orderitem=line) for line in to_create]
+            )
+            # bulk_create sends no signals, so the cached cart count is dropped here
+            invalidate_cart_count(user.pk)
+        return cart
+
+
+def finalize_order(user, tran_id, payment_type, reference_code, amount=None):
+    """
+    Turn the user's open cart into an order paid by the transaction tran_id
+    Records the payment, snapshots the lines and the total at today's prices, marks the cart and
+    all its lines ordered and sets the reference code in one transaction, with the same handful
+    of queries whatever the size of the cart. Replaying a tran_id that already paid for an order
+    returns that order and changes nothing. Returns None when there is neither an open cart nor
+    an order paid by tran_id. The cart's coupon takes its use here. amount is what the gateway
+    charged, recorded as the payment and the order total instead of the total worked out from
+    the lines, so the books agree with the gateway.
+    """
+    from .coupons import redeem
+    charge_id_field = CHARGE_ID_FIELDS.get(payment_type, DEFAULT_CHARGE_ID_FIELD)
+    with transaction.atomic():
+        order = get_open_cart(user, lock=True)
+        # Checked after taking the lock, so a concurrent replay sees the order the first request made
+        paid = Cart.objects.filter(user=user, ordered=True, **{f'payment__{charge_id_field}': tran_id}).first()
+        if paid is not None or order is None:
+            return paid
+        lines = [
+            OrderLine(order=order, item=line.item, item_name=line.item.item_name, price=line.item.price,
+                      discount_price=line.item.discount_price, quantity=line.quantity,
+                      line_total=line.line_total)
+            for line in OrderItem.objects.filter(cart=order).with_prices()
+        ]
+        OrderLine.objects.bulk_create(lines)
+        coupon = order.coupon
+        if coupon is not None and not redeem(coupon):
+            # Expired or used up between the payment page's check and the charge, the customer
+            # was charged with the discount and keeps it, the use is not counted
+            logger.warning("Order %s was paid with coupon %s, which could no longer be redeemed",
+                           order.pk, coupon.coupon)
+        if amount is None:
+            # Same sum as Cart.objects.with_totals(), worked out from the lines already in hand
+            amount = sum(line.line_total for line in lines) - (coupon.amount if coupon else 0)
+        payment = Payment.objects.create(user=user, amount=int(amount), **{charge_id_field: tran_id})
+        order.ordered = True
+        order.payment = payment
+        order.reference_code = reference_code
+        order.total = amount
+        order.save(update_fields=['ordered', 'payment', 'reference_code', 'total'])
+        OrderItem.objects.filter(cart=order).update(ordered=True)
+        return order
@@ -0,0 +1,169 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .cart import get_open_cart
+from .models import Cart, Coupon
+
+# What applying a coupon did, so the view can tell the user
+APPLIED = 'applied'
+ALREADY_APPLIED = 'already_applied'
+INVALID = 'invalid'
+EXPIRED = 'expired'
+USED_UP = 'used_up'
+NO_CART = 'no_cart'
+
+# Coupons kept in each process, for a short while since other processes can not drop them on a change
+LOCAL_CACHE_SIZE = 1024
+LOCAL_CACHE_TIMEOUT = 30
+# Codes that matched no coupon are remembered for this long, creating the coupon forgets them
+MISSING_CACHE_TIMEOUT = 60 * 5
+
+# Stands for "no such coupon" in the caches, where None means not cached
+MISSING = False
+
+
+class LRUCache:
+    """
+    Thread-safe in-process cache of the size most recently used keys, entries expire after timeout seconds
+    """
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_cache = LRUCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TIMEOUT)
+
+
+def missing_key(code):
+    return f'core:coupon_missing:{code}'
+
+
+def get_coupon(code):
+    """
+    The coupon with the code, or None
+    Looked up in this process's LRU first, then in the shared object cache and only then in the
+    database. Unknown codes are cached as well, so a flood of mistyped codes stays off the database.
+    The copy returned may be a little behind on times_used, redeem() has the final word.
+    """
+    coupon = local_cache.get(code)
+    if coupon is None:
+        if cache.get(missing_key(code)):
+            coupon = MISSING
+        else:
+            try:
+                coupon = Coupon.objects.get_cached(coupon=code)
+            except Coupon.DoesNotExist:
+                coupon = MISSING
+                cache.set(missing_key(code), True, MISSING_CACHE_TIMEOUT)
+        local_cache.set(code, coupon)
+    return coupon or None
+
+
+def uncache_coupon(coupon):
+    """
+    Drop the coupon from every cache once the current transaction commits
+    """
+    Coupon.objects.uncache(coupon)
+
+    def forget():
+        local_cache.delete(coupon.coupon)
+        cache.delete(missing_key(coupon.coupon))
+    transaction.on_commit(forget)
+
+
+def check_coupon(coupon):
+    """
+    Why the coupon can not be used, or None when it looks usable
+    """
+    if coupon is None:
+        return INVALID
+    if coupon.valid_until is not None and coupon.valid_until <= timezone.now():
+        return EXPIRED
+    if coupon.max_uses is not None and coupon.times_used >= coupon.max_uses:
+        return USED_UP
+    return None
+
+
+def redeem(coupon):
+    """
+    Take one use of the coupon if it is still valid and has uses left, returns whether it did
+    A single conditional UPDATE, so concurrent redemptions can never go past max_uses. Run by
+    cart.finalize_order as the order is paid, carts that are never paid for take no use.
+    """
+    redeemed = Coupon.objects.filter(
+        Q(max_uses__isnull=True) | Q(times_used__lt=F('max_uses')),
+        Q(valid_until__isnull=True) | Q(valid_until__gt=timezone.now()),
+        pk=coupon.pk,
+    ).update(times_used=F('times_used') + 1) == 1
+    # Cached copies would keep offering the use just taken, or the one that was not there
+    uncache_coupon(coupon)
+    return redeemed
+
+
+def apply_coupon(user, code):
+    """
+    Put the coupon with the code on the user's open cart
+    Unknown, expired and used up codes are turned away from the caches without touching the
+    database. The cached copy may be a little behind, drop_unusable_coupon() checks again before
+    the order is charged and finalize_order takes the use.
+    """
+    coupon = get_coupon(code.strip())
+    problem = check_coupon(coupon)
+    if problem:
+        return problem
+    cart = get_open_cart(user)
+    if cart is None:
+        return NO_CART
+    if cart.coupon_id == coupon.pk:
+        return ALREADY_APPLIED
+    Cart.objects.filter(pk=cart.pk).update(coupon=coupon)
+    return APPLIED
+
+
+def drop_unusable_coupon(cart):
+    """
+    Take the coupon off the cart if it expired or was used up since it was applied, returns why or None
+    Read from the database rather than the caches. Run before charging, so the customer is charged
+    the total the order will record.
+    """
+    if not cart.coupon_id:
+        return None
+    problem = check_coupon(Coupon.objects.filter(pk=cart.coupon_id).first())
+    if problem:
+        Cart.objects.filter(pk=cart.pk).update(coupon=None)
+    return problem
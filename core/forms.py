@@ -1,4 +1,7 @@
+from datetime import datetime, time, timedelta
+
 from django import forms
+from django.utils import timezone
 
 from django_countries.fields import CountryField
 from django_countries.widgets import CountrySelectWidget
@@ -10,6 +13,14 @@ CHOICE_FIELDS = (
     ('P', 'Paypal'),
 )
 
+ORDER_STATUS_CHOICES = (
+    ('', 'All orders'),
+    ('being_delivered', 'Being delivered'),
+    ('received', 'Received'),
+    ('refund_requested', 'Refund requested'),
+    ('refund_granted', 'Refund granted'),
+)
+
 
 class CheckoutForm(forms.Form):
     # Shipping information
@@ -66,3 +77,40 @@ class CommentForm(forms.Form):
         "class": "form-control",
         "placeholder": "Write A Comment"
     }))
+
+
+class OrderHistoryFilterForm(forms.Form):
+    date_from = forms.DateField(required=False, widget=forms.DateInput(attrs={
+        'type': 'date',
+        'class': 'form-control'
+    }))
+    date_to = forms.DateField(required=False, widget=forms.DateInput(attrs={
+        'type': 'date',
+        'class': 'form-control'
+    }))
+    status = forms.ChoiceField(required=False, choices=ORDER_STATUS_CHOICES, widget=forms.Select(attrs={
+        'class': 'custom-select'
+    }))
+
+    def is_filtered(self):
+        return self.is_valid() and any(self.cleaned_data.values())
+
+    def filter(self, queryset):
+        """
+        Narrow the orders down to the chosen dates (both days included) and status
+        The dates become a range on ordered_date itself, so an index on it can still be used
+        """
+        if not self.is_valid():
+            return queryset
+        date_from = self.cleaned_data['date_from']
+        date_to = self.cleaned_data['date_to']
+        status = self.cleaned_data['status']
+        if date_from:
+            queryset = queryset.filter(ordered_date__gte=timezone.make_aware(datetime.combine(date_from, time.min)))
+        if date_to:
+            queryset = queryset.filter(
+                ordered_date__lt=timezone.make_aware(datetime.combine(date_to + timedelta(days=1), time.min))
+            )
+        if status:
+            queryset = queryset.filter(**{status: True})
+        return queryset
@@ -0,0 +1,132 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Where the derivatives live, under MEDIA_ROOT and MEDIA_URL
+DERIVATIVES_DIR = 'derivatives'
+
+# Sizes rendered per use, (width, height) crops to exactly that box while no height keeps the aspect ratio
+VARIANTS = {
+    'card': [(240, 240), (480, 480)],
+    'detail': [(480, None), (960, None)],
+}
+
+# (extension, Pillow format, mime type, save options), best compression first, the last one is the fallback
+FORMATS = [
+    ('webp', 'WEBP', 'image/webp', {'quality': 80, 'method': 6}),
+    ('jpg', 'JPEG', 'image/jpeg', {'quality': 85, 'optimize': True, 'progressive': True}),
+]
+Image.init()
+if 'AVIF' in Image.SAVE:
+    FORMATS.insert(0, ('avif', 'AVIF', 'image/avif', {'quality': 60}))
+
+
+def image_digest(data):
+    return hashlib.sha256(data).hexdigest()[:20]
+
+
+def derivative_name(digest, variant, width, ext):
+    # Content-hashed, so a new upload gets new URLs and old ones can be cached forever
+    return f"{DERIVATIVES_DIR}/{digest[:2]}/{digest}-{variant}-{width}.{ext}"
+
+
+def derivative_url(digest, variant, width, ext):
+    return settings.MEDIA_URL + derivative_name(digest, variant, width, ext)
+
+
+def srcset(digest, variant, ext):
+    return ", ".join(f"{derivative_url(digest, variant, width, ext)} {width}w" for width, _ in VARIANTS[variant])
+
+
+def render_derivatives(source_path, media_root, force=False):
+    """
+    Write every variant of the image at source_path in every format and return its digest
+    Files already on disk are left alone unless force is set, so rendering the same image again is
+    only a read and a hash. Runs in the worker processes, so it touches neither the database nor Django.
+    """
+    with open(source_path, 'rb') as f:
+        data = f.read()
+    digest = image_digest(data)
+    todo = [
+        (variant, size, fmt) for variant, sizes in VARIANTS.items() for size in sizes for fmt in FORMATS
+        if force or not os.path.exists(os.path.join(media_root, derivative_name(digest, variant, size[0], fmt[0])))
+    ]
+    if not todo:
+        return digest
+    with Image.open(source_path) as original:
+        original = ImageOps.exif_transpose(original).convert('RGB')
+        for variant, (width, height), (ext, image_format, _, options) in todo:
+            if height:
+                image = ImageOps.fit(original, (width, height), Image.LANCZOS)
+            else:
+                image = original.copy()
+                image.thumbnail((width, width * 10), Image.LANCZOS)
+            path = os.path.join(media_root, derivative_name(digest, variant, width, ext))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written aside and renamed, so a page never links to a half written file
+            partial = f"{path}.{os.getpid()}.part"
+            image.save(partial, image_format, **options)
+            os.replace(partial, path)
+    return digest
+
+
+_executor = None
+
+
+def get_executor():
+    """
+    The process pool rendering uploads, started on first use
+    Workers are spawned rather than forked so they never inherit the server's threads or sockets.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=settings.IMAGE_WORKERS,
+                                        mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def store_image_hash(pk, name, future, scheduled_on):
+    """
+    Point the item at its derivatives once they are on disk, unless its image changed meanwhile
+    Runs as the future's done callback, on the pool's result thread, or on the thread with id
+    scheduled_on when the future was done before the callback was added.
+    """
+    from .models import Item
+    try:
+        digest = future.result()
+    except Exception:
+        logger.exception("Rendering the derivatives of %s failed", name)
+        return
+    try:
+        item = Item.objects.filter(pk=pk, item_image=name).first()
+        if item is not None and item.image_hash != digest:
+            item.image_hash = digest
+            item.save(update_fields=['image_hash'])
+    finally:
+        # The pool's thread got a connection of its own, which no request would ever close
+        if threading.get_ident() != scheduled_on:
+            connection.close()
+
+
+def schedule_derivatives(item):
+    """
+    Render the item's image on the process pool once the upload is committed
+    Until that is done the item keeps its old image_hash and the templates serve the original.
+    """
+    pk, name, path = item.pk, item.item_image.name, item.item_image.path
+
+    def submit():
+        future = get_executor().submit(render_derivatives, path, settings.MEDIA_ROOT)
+        scheduled_on = threading.get_ident()
+        future.add_done_callback(lambda future: store_image_hash(pk, name, future, scheduled_on))
+
+    transaction.on_commit(submit)
@@ -0,0 +1,120 @@
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, OperationalError
+from django.test.utils import override_settings
+
+from core import cart
+from core.backends.sqlite3.base import SQLITE_PROFILES
+from core.models import Item
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = ("Run concurrent shoppers through the cart and the checkout on scratch copies of the "
+            "database and report throughput and lock errors per SQLite profile")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help="Shoppers writing at the same time")
+        parser.add_argument('--orders', type=int, default=20, help="Orders placed by each shopper")
+        parser.add_argument('--items-per-order', type=int, default=3,
+                            help="Items added to the cart before each checkout")
+        parser.add_argument('--profiles', nargs='+', default=list(SQLITE_PROFILES), choices=list(SQLITE_PROFILES),
+                            help="SQLite profiles compared, see core.backends.sqlite3")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed picking the items")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("The write benchmark only runs on SQLite")
+        self.options = options
+        item_ids = list(Item.objects.values_list('pk', flat=True)[:1000])
+        if len(item_ids) < options['items_per_order']:
+            raise CommandError("Not enough items to shop for, run seed_data first")
+        self.stdout.write(f"{options['threads']} shoppers placing {options['orders']} orders of "
+                          f"{options['items_per_order']} items each")
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            for profile in options['profiles']:
+                scratch = os.path.join(scratch_dir, f"{profile}.sqlite3")
+                self.copy_database(connection.settings_dict['NAME'], scratch)
+                with self.use_database(scratch), override_settings(SQLITE_PROFILE=profile):
+                    operations, lock_errors, elapsed = self.run(item_ids)
+                self.stdout.write(
+                    f"  {profile:<12} {operations:>6} writes {lock_errors:>5} lock errors "
+                    f"{elapsed:>7.2f}s {operations / elapsed:>8.1f} writes/s"
+                )
+
+    def copy_database(self, source, target):
+        connections.close_all()
+        with sqlite3.connect(source) as src, sqlite3.connect(target) as dst:
+            src.backup(dst)
+        src.close()
+        dst.close()
+
+    @contextmanager
+    def use_database(self, name):
+        # Every thread builds its connection from this dict, so all of them open the scratch copy
+        settings_dict = connections.settings['default']
+        original = settings_dict['NAME']
+        settings_dict['NAME'] = name
+        connections.close_all()
+        try:
+            yield
+        finally:
+            connections.close_all()
+            settings_dict['NAME'] = original
+
+    def run(self, item_ids):
+        options = self.options
+        rng = random.Random(options['seed'])
+        shoppers = [
+            (User.objects.create_user(username=f"benchmark-{n}"),
+             [Item(pk=pk) for pk in rng.sample(item_ids, options['items_per_order'])])
+            for n in range(options['threads'])
+        ]
+        connection.close()
+        counts = {'operations': 0, 'lock_errors': 0}
+        lock = threading.Lock()
+        start = threading.Barrier(len(shoppers) + 1)
+
+        def shop(user, items):
+            operations = lock_errors = 0
+            start.wait()
+            try:
+                for order in range(options['orders']):
+                    for item in items:
+                        try:
+                            cart.add_item(user, item)
+                            operations += 1
+                        except OperationalError as e:
+                            if 'locked' not in str(e):
+                                raise
+                            lock_errors += 1
+                    try:
+                        cart.finalize_order(user, f"{user.username}-{order}", 'S', f"{user.pk}-{order}")
+                        operations += 1
+                    except OperationalError as e:
+                        if 'locked' not in str(e):
+                            raise
+                        lock_errors += 1
+            finally:
+                connection.close()
+                with lock:
+                    counts['operations'] += operations
+                    counts['lock_errors'] += lock_errors
+
+        threads = [threading.Thread(target=shop, args=shopper) for shopper in shoppers]
+        for thread in threads:
+            thread.start()
+        start.wait()
+        started = time.monotonic()
+        for thread in threads:
+            thread.join()
+        return counts['operations'], counts['lock_errors'], time.monotonic() - started
@@ -0,0 +1,66 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from core.cache import bump_catalog_version
+from core.images import render_derivatives
+from core.models import Item
+
+
+class Command(BaseCommand):
+    help = "Render the thumbnails and WebP copies of every item image and point the items at them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help="Processes rendering images in parallel")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of items read and updated per transaction")
+        parser.add_argument('--force', action='store_true',
+                            help="Render again images whose derivatives are already on disk")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        started = time.monotonic()
+        last_id = Item.objects.aggregate(last=Max('pk'))['last'] or 0
+        # Digest per image file, many items share a file and each file is rendered once
+        digests = {}
+        checked = updated = missing = 0
+        with ProcessPoolExecutor(max_workers=options['workers'],
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            for start in range(0, last_id, batch_size):
+                rows = list(Item.objects.filter(pk__gt=start, pk__lte=start + batch_size).exclude(
+                    item_image='').values_list('pk', 'slug', 'item_image', 'image_hash'))
+                names = []
+                for name in {name for _, _, name, _ in rows} - digests.keys():
+                    if os.path.exists(os.path.join(settings.MEDIA_ROOT, name)):
+                        names.append(name)
+                    else:
+                        digests[name] = None
+                        missing += 1
+                        self.stderr.write(f"  {name}: file not found")
+                paths = [os.path.join(settings.MEDIA_ROOT, name) for name in names]
+                renders = pool.map(render_derivatives, paths, [settings.MEDIA_ROOT] * len(paths),
+                                   [options['force']] * len(paths))
+                digests.update(zip(names, renders))
+                stale = {}
+                for pk, slug, name, image_hash in rows:
+                    checked += 1
+                    if digests[name] and digests[name] != image_hash:
+                        stale.setdefault(digests[name], []).append(Item(pk=pk, slug=slug))
+                with transaction.atomic():
+                    for digest, items in stale.items():
+                        updated += Item.objects.filter(pk__in=[item.pk for item in items]).update(image_hash=digest)
+                        for item in items:
+                            Item.objects.uncache(item)
+        if updated:
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(
+            f"Rendered {len(digests) - missing} images for {checked} items, updated {updated}, "
+            f"{missing} missing in {time.monotonic() - started:.1f}s"
+        ))
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.cache import bump_catalog_version
+from core.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index of the items from scratch"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--optimize', action='store_true',
+                            help="Merge the index into a single segment after rebuilding it")
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        started = time.monotonic()
+        indexed = backend.rebuild()
+        if options['optimize']:
+            backend.optimize()
+        # Cached search result pages may be built from the old index
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {indexed} items with {type(backend).__name__} in {time.monotonic() - started:.1f}s"
+        ))
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from core.cache import bump_item_version
+from core.models import Item, actual_like_count
+
+
+class Command(BaseCommand):
+    help = "Repair Item.like_count where it drifted from the number of likes actually stored"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of items checked and repaired per transaction")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        started = time.monotonic()
+        last_id = Item.objects.aggregate(last=Max('pk'))['last'] or 0
+        checked = repaired = 0
+        # Walk the table in pk ranges, each batch in its own short transaction so likes keep flowing
+        for start in range(0, last_id, batch_size):
+            with transaction.atomic():
+                rows = Item.objects.filter(pk__gt=start, pk__lte=start + batch_size).annotate(
+                    actual=actual_like_count()).values_list('pk', 'slug', 'like_count', 'actual')
+                for pk, slug, stored, actual in rows:
+                    checked += 1
+                    if stored == actual:
+                        continue
+                    # Counted again in the UPDATE, in case a like came in since the batch was read
+                    Item.objects.filter(pk=pk).update(like_count=actual_like_count())
+                    Item.objects.uncache(Item(pk=pk, slug=slug))
+                    bump_item_version(slug)
+                    repaired += 1
+                    self.stdout.write(f"  {slug}: {stored} -> {actual}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {checked} items, repaired {repaired} in {time.monotonic() - started:.1f}s"
+        ))
@@ -0,0 +1,268 @@
+import random
+import string
+import time
+from datetime import timedelta
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from core.models import (Item, Cart, OrderItem, OrderLine, Address, Comment, Payment, Coupon,
+                         Category, UserProfile, LABEL_CHOICES, actual_like_count,
+                         actual_comment_count)
+from core.cache import bump_catalog_version
+from core.search import get_search_backend
+
+User = get_user_model()
+
+WORDS = ['classic', 'slim', 'cotton', 'leather', 'denim', 'summer', 'winter', 'sport', 'casual',
+         'premium', 'vintage', 'wireless', 'smart', 'portable', 'organic', 'handmade', 'travel',
+         'shirt', 'jacket', 'shoes', 'watch', 'bag', 'headphones', 'lamp', 'mug', 'backpack',
+         'dress', 'hat', 'scarf', 'wallet', 'speaker', 'bottle', 'notebook', 'chair', 'jeans']
+COUNTRIES = ['BD', 'US', 'GB', 'IN', 'DE', 'FR', 'CA', 'AU', 'JP', 'NL']
+
+
+def skewed_index(rng, size, skew):
+    """
+    Pick an index in range(size) where low indices are far more likely than high ones
+    A skew of 1 is uniform, bigger values concentrate more of the picks on the head
+    """
+    return min(int(size * rng.random() ** skew), size - 1)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def next_id(model):
+    return (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+
+
+class Command(BaseCommand):
+    help = "Fill the catalog, carts and order history tables with realistic, skewed fake data"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=30)
+        parser.add_argument('--items', type=int, default=20000)
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--orders-per-user', type=float, default=8,
+                            help="Average number of completed orders per user")
+        parser.add_argument('--lines-per-order', type=float, default=3,
+                            help="Average number of order lines per cart")
+        parser.add_argument('--open-cart-ratio', type=float, default=0.3,
+                            help="Share of users that have an open cart")
+        parser.add_argument('--comments-per-item', type=float, default=5)
+        parser.add_argument('--likes-per-item', type=float, default=20)
+        parser.add_argument('--skew', type=float, default=3,
+                            help="How strongly popularity concentrates on a few items and users")
+        parser.add_argument('--years', type=int, default=3, help="How far back the order history goes")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.options = options
+        self.now = timezone.now()
+        started = time.monotonic()
+
+        category_ids = self.create_categories()
+        item_ids, item_details = self.create_items(category_ids)
+        user_ids = self.create_users()
+        coupon_amounts = self.create_coupons()
+        self.create_orders(user_ids, item_ids, item_details, coupon_amounts)
+        self.create_comments(item_ids, user_ids)
+        self.create_likes(item_ids, user_ids)
+        # bulk_create skips the signals that keep the search index and the cached listings up to date
+        self.stdout.write(f"  search index: {get_search_backend().rebuild()}")
+        bump_catalog_version()
+
+        self.stdout.write(self.style.SUCCESS(f"Seeding finished in {time.monotonic() - started:.1f}s"))
+
+    def insert(self, model, rows, ignore_conflicts=False):
+        """
+        Bulk insert the generated rows one transaction per batch and return how many were written
+        """
+        total = 0
+        for batch in batched(rows, self.options['batch_size']):
+            with transaction.atomic():
+                model.objects.bulk_create(batch, batch_size=self.options['batch_size'],
+                                          ignore_conflicts=ignore_conflicts)
+            total += len(batch)
+        self.stdout.write(f"  {model.__name__}: {total}")
+        return total
+
+    def create_categories(self):
+        start = next_id(Category)
+        ids = list(range(start, start + self.options['categories']))
+        self.insert(Category, (Category(pk=pk, category=f"Category {pk}") for pk in ids))
+        return ids
+
+    def create_items(self, category_ids):
+        rng = self.rng
+        start = next_id(Item)
+        ids = list(range(start, start + self.options['items']))
+        details = {}
+
+        def rows():
+            for pk in ids:
+                price = round(rng.lognormvariate(3.5, 0.8), 2)
+                discount_price = round(price * rng.uniform(0.5, 0.95), 2) if rng.random() < 0.3 else None
+                item_name = " ".join(rng.choices(WORDS, k=3)).title()[:100]
+                details[pk] = (item_name, price, discount_price)
+                yield Item(
+                    pk=pk,
+                    item_name=item_name,
+                    item_category_id=category_ids[skewed_index(rng, len(category_ids), self.options['skew'])],
+                    price=price,
+                    discount_price=discount_price,
+                    item_image='items_images/sample.jpg',
+                    labels=rng.choice(LABEL_CHOICES)[0],
+                    slug=f"seed-item-{pk}",
+                    description=" ".join(rng.choices(WORDS, k=rng.randint(10, 40)))
+                )
+
+        self.insert(Item, rows())
+        return ids, details
+
+    def create_users(self):
+        rng = self.rng
+        start = next_id(User)
+        ids = list(range(start, start + self.options['users']))
+        # Hashing is slow on purpose, so every seeded user shares the same password
+        password = make_password('password')
+        self.insert(User, (User(pk=pk, username=f"seed_user_{pk}", email=f"seed_user_{pk}@example.com",
+                                password=password, date_joined=self.now) for pk in ids))
+        # bulk_create skips the post_save signal that normally creates the profile
+        self.insert(UserProfile, (UserProfile(user_id=pk) for pk in ids))
+
+        def addresses():
+            for pk in ids:
+                for address_type in ('B', 'S'):
+                    yield Address(
+                        user_id=pk,
+                        street_address=f"{rng.randint(1, 999)} {rng.choice(WORDS).title()} Road",
+                        apartment_address=f"Apt {rng.randint(1, 99)}",
+                        country=rng.choice(COUNTRIES),
+                        zip_code=str(rng.randint(1000, 99999)),
+                        address_type=address_type,
+                        is_default=True
+                    )
+
+        self.insert(Address, addresses())
+        return ids
+
+    def create_coupons(self):
+        start = next_id(Coupon)
+        amounts = {pk: self.rng.choice([5, 10, 20]) for pk in range(start, start + 10)}
+        self.insert(Coupon, (Coupon(pk=pk, coupon=f"SEED{pk}", amount=amount) for pk, amount in amounts.items()))
+        return amounts
+
+    def create_orders(self, user_ids, item_ids, item_details, coupon_amounts):
+        """
+        Generate the order history user by user, writing carts, their lines, the cart/line
+        relation and the payments and line snapshots of completed orders in dependent batches
+        """
+        rng = self.rng
+        options = self.options
+        through = Cart.items.through
+        cart_id = next_id(Cart)
+        order_item_id = next_id(OrderItem)
+        payment_id = next_id(Payment)
+        history = timedelta(days=365 * options['years'])
+        coupon_ids = list(coupon_amounts)
+        counts = {'Cart': 0, 'OrderItem': 0, 'OrderLine': 0, 'Payment': 0}
+
+        for user_batch in batched(user_ids, max(options['batch_size'] // 50, 1)):
+            payments, carts, order_items, links, snapshots = [], [], [], [], []
+            for user_id in user_batch:
+                orders = int(rng.expovariate(1 / options['orders_per_user'])) if options['orders_per_user'] else 0
+                has_open_cart = rng.random() < options['open_cart_ratio']
+                for n in range(orders + has_open_cart):
+                    ordered = n < orders
+                    lines = max(1, int(rng.expovariate(1 / options['lines_per_order'])))
+                    picked = {item_ids[skewed_index(rng, len(item_ids), options['skew'])] for _ in range(lines)}
+                    total = 0
+                    for item_id in picked:
+                        quantity = skewed_index(rng, 5, 2) + 1
+                        item_name, price, discount_price = item_details[item_id]
+                        line_total = (discount_price or price) * quantity
+                        total += line_total
+                        if ordered:
+                            snapshots.append(OrderLine(order_id=cart_id, item_id=item_id, item_name=item_name,
+                                                       price=price, discount_price=discount_price,
+                                                       quantity=quantity, line_total=line_total))
+                        order_items.append(OrderItem(pk=order_item_id, user_id=user_id, item_id=item_id,
+                                                     quantity=quantity, ordered=ordered))
+                        links.append(through(cart_id=cart_id, orderitem_id=order_item_id))
+                        order_item_id += 1
+                    cart = Cart(pk=cart_id, user_id=user_id, ordered=ordered, ordered_date=self.now)
+                    if ordered:
+                        cart.ordered_date = self.now - history * rng.random()
+                        cart.reference_code = "".join(rng.choices(string.ascii_letters + string.digits, k=20))
+                        cart.being_delivered = rng.random() < 0.9
+                        cart.received = cart.being_delivered and rng.random() < 0.8
+                        cart.refund_requested = rng.random() < 0.03
+                        cart.refund_granted = not cart.refund_requested and rng.random() < 0.02
+                        if rng.random() < 0.1:
+                            cart.coupon_id = rng.choice(coupon_ids)
+                            total -= coupon_amounts[cart.coupon_id]
+                        cart.total = total
+                        payments.append(Payment(pk=payment_id, user_id=user_id, amount=int(total),
+                                                stripe_charge_id=f"ch_seed_{payment_id}"))
+                        cart.payment_id = payment_id
+                        payment_id += 1
+                    carts.append(cart)
+                    cart_id += 1
+
+            with transaction.atomic():
+                Payment.objects.bulk_create(payments, batch_size=options['batch_size'])
+                Cart.objects.bulk_create(carts, batch_size=options['batch_size'])
+                OrderItem.objects.bulk_create(order_items, batch_size=options['batch_size'])
+                through.objects.bulk_create(links, batch_size=options['batch_size'])
+                OrderLine.objects.bulk_create(snapshots, batch_size=options['batch_size'])
+            counts['Cart'] += len(carts)
+            counts['OrderItem'] += len(order_items)
+            counts['OrderLine'] += len(snapshots)
+            counts['Payment'] += len(payments)
+
+        for name, count in counts.items():
+            self.stdout.write(f"  {name}: {count}")
+
+    def create_comments(self, item_ids, user_ids):
+        rng = self.rng
+        total = int(len(item_ids) * self.options['comments_per_item'])
+
+        def rows():
+            for _ in range(total):
+                yield Comment(
+                    user_id=rng.choice(user_ids),
+                    item_id=item_ids[skewed_index(rng, len(item_ids), self.options['skew'])],
+                    comment=" ".join(rng.choices(WORDS, k=rng.randint(3, 30))).capitalize()
+                )
+
+        self.insert(Comment, rows())
+        # bulk_create sends no signals, so the cached counts are worked out in one pass afterwards
+        Item.objects.filter(pk__gte=item_ids[0], pk__lte=item_ids[-1]).update(comment_count=actual_comment_count())
+
+    def create_likes(self, item_ids, user_ids):
+        rng = self.rng
+        through = Item.likes.through
+        total = int(len(item_ids) * self.options['likes_per_item'])
+
+        def rows():
+            for _ in range(total):
+                yield through(item_id=item_ids[skewed_index(rng, len(item_ids), self.options['skew'])],
+                              user_id=rng.choice(user_ids))
+
+        # A user likes an item at most once, repeated picks are dropped by the unique constraint
+        self.insert(through, rows(), ignore_conflicts=True)
+        Item.objects.filter(pk__gte=item_ids[0], pk__lte=item_ids[-1]).update(like_count=actual_like_count())
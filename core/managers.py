@@ -0,0 +1,92 @@
+from collections import Counter
+
+from django.core.cache import cache
+from django.db import models, transaction
+from django.http import Http404
+
+from .routers import primary_reads
+
+OBJECT_CACHE_TIMEOUT = 60 * 60
+
+# Hits and misses of the object cache in this process, per model label
+object_cache_stats = Counter()
+
+
+class CachedManager(models.Manager):
+    """
+    Manager with a cache-aside path for fetching single rows by primary key or by a unique field
+    Rows are cached under their pk, while the unique fields only map to the pk, so a row renamed
+    since its mapping was cached is still found under the new value and never under the old one.
+    The model's save and delete signals call uncache(). Misses are read from the primary, the
+    signals run there and a replica that is behind would put back what they dropped.
+    """
+    def __init__(self, cache_fields=()):
+        super().__init__()
+        self.cache_fields = tuple(cache_fields)
+
+    def cache_key(self, field, value):
+        return f'core:object:{self.model._meta.label_lower}:{field}:{value}'
+
+    def get_cached(self, **lookup):
+        """
+        Like get(), with a single pk or cache_fields lookup, raises DoesNotExist the same way
+        """
+        (field, value), = lookup.items()
+        if field != 'pk' and field not in self.cache_fields:
+            raise ValueError(f"{self.model.__name__} is not cached by {field}")
+        label = self.model._meta.label_lower
+        pk = value if field == 'pk' else cache.get(self.cache_key(field, value))
+        if pk is not None:
+            obj = cache.get(self.cache_key('pk', pk))
+            if obj is not None and (field == 'pk' or getattr(obj, field) == value):
+                object_cache_stats[f'{label}.hits'] += 1
+                return obj
+        object_cache_stats[f'{label}.misses'] += 1
+        with primary_reads():
+            obj = self.get(**lookup)
+        self.cache_objects([obj])
+        return obj
+
+    def get_many(self, pks):
+        """
+        Rows for all of pks as a {pk: object} dict like in_bulk(), with one query for the misses only
+        """
+        label = self.model._meta.label_lower
+        keys = {self.cache_key('pk', pk): pk for pk in pks}
+        objects = {obj.pk: obj for obj in cache.get_many(keys).values()}
+        missing = [pk for pk in keys.values() if pk not in objects]
+        object_cache_stats[f'{label}.hits'] += len(objects)
+        object_cache_stats[f'{label}.misses'] += len(missing)
+        if missing:
+            with primary_reads():
+                fetched = self.in_bulk(missing)
+            self.cache_objects(fetched.values())
+            objects.update(fetched)
+        return objects
+
+    def cache_objects(self, objs):
+        values = {}
+        for obj in objs:
+            values[self.cache_key('pk', obj.pk)] = obj
+            for field in self.cache_fields:
+                values[self.cache_key(field, getattr(obj, field))] = obj.pk
+        cache.set_many(values, OBJECT_CACHE_TIMEOUT)
+
+    def uncache(self, obj):
+        """
+        Drop the row from the cache once the current transaction commits
+        """
+        keys = [self.cache_key('pk', obj.pk)]
+        keys += [self.cache_key(field, getattr(obj, field)) for field in self.cache_fields]
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+    def cache_stats(self):
+        label = self.model._meta.label_lower
+        return {'hits': object_cache_stats[f'{label}.hits'], 'misses': object_cache_stats[f'{label}.misses']}
+
+
+def get_cached_object_or_404(model, **lookup):
+    try:
+        return model.objects.get_cached(**lookup)
+    except model.DoesNotExist:
+        raise Http404(f"No {model._meta.object_name} matches the given query.")
@@ -0,0 +1,40 @@
+from django.db import migrations, OperationalError
+
+FTS_TABLE = 'core_item_fts'
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        try:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                f"item_name, category, tokenize = 'unicode61 remove_diacritics 2')"
+            )
+        except OperationalError:
+            # SQLite was built without FTS5, search falls back to icontains
+            return
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, item_name, category) "
+            f"SELECT core_item.id, core_item.item_name, core_category.category "
+            f"FROM core_item INNER JOIN core_category ON core_item.item_category_id = core_category.id"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_alter_address_country'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
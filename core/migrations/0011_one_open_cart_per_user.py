@@ -0,0 +1,45 @@
+# Generated by Django 5.0.1 on 2026-10-18 20:08
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_open_carts(apps, schema_editor):
+    """
+    Fold every extra open cart of a user into their oldest one before the constraint is added
+    Lines for an item the oldest cart already has are added to that line's quantity
+    """
+    Cart = apps.get_model('core', 'Cart')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    Through = Cart.items.through
+    duplicated = (Cart.objects.filter(ordered=False).values('user')
+                  .annotate(open_carts=Count('id')).filter(open_carts__gt=1).values_list('user', flat=True))
+    for user_id in duplicated:
+        keep, *extra = Cart.objects.filter(user_id=user_id, ordered=False).order_by('id')
+        lines = {line.item_id: line for line in OrderItem.objects.filter(cart=keep)}
+        for line in OrderItem.objects.filter(cart__in=extra).order_by('id'):
+            if line.item_id in lines:
+                lines[line.item_id].quantity += line.quantity
+                lines[line.item_id].save(update_fields=['quantity'])
+                line.delete()
+            else:
+                Through.objects.filter(orderitem=line).update(cart=keep)
+                lines[line.item_id] = line
+        Cart.objects.filter(pk__in=[cart.pk for cart in extra]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_item_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_open_carts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(condition=models.Q(('ordered', False)), fields=('user',), name='one_open_cart_per_user'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.1 on 2026-10-18 20:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_one_open_cart_per_user'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='ssl_charge_id',
+            field=models.CharField(blank=True, db_index=True, max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='stripe_charge_id',
+            field=models.CharField(blank=True, db_index=True, max_length=50, null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.0.1 on 2026-10-18 20:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_payment_charge_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='total',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='OrderLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('item_name', models.CharField(max_length=100)),
+                ('price', models.FloatField()),
+                ('discount_price', models.FloatField(blank=True, null=True)),
+                ('quantity', models.IntegerField()),
+                ('line_total', models.FloatField()),
+                ('item', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.item')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='core.cart')),
+            ],
+        ),
+    ]
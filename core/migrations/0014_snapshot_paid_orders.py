@@ -0,0 +1,47 @@
+from django.db import migrations
+from django.db.models import ExpressionWrapper, FloatField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def snapshot_paid_orders(apps, schema_editor):
+    """
+    Give the orders paid so far their lines and total
+    The prices they were bought at are gone, so the current catalog prices are the best there is
+    """
+    Cart = apps.get_model('core', 'Cart')
+    OrderLine = apps.get_model('core', 'OrderLine')
+    Coupon = apps.get_model('core', 'Coupon')
+    # One INSERT ... SELECT, building a model instance per historical line is far too slow
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO core_orderline (order_id, item_id, item_name, price, discount_price, quantity, line_total) "
+            "SELECT core_cart_items.cart_id, core_item.id, core_item.item_name, core_item.price, "
+            "core_item.discount_price, core_orderitem.quantity, "
+            "COALESCE(NULLIF(core_item.discount_price, 0.0), core_item.price) * core_orderitem.quantity "
+            "FROM core_cart_items "
+            "INNER JOIN core_cart ON core_cart_items.cart_id = core_cart.id "
+            "INNER JOIN core_orderitem ON core_cart_items.orderitem_id = core_orderitem.id "
+            "INNER JOIN core_item ON core_orderitem.item_id = core_item.id "
+            "WHERE core_cart.ordered = %s ORDER BY core_cart_items.id",
+            [True]
+        )
+
+    subtotal = OrderLine.objects.filter(order=OuterRef('pk')).values('order').annotate(
+        subtotal=Sum('line_total')).values('subtotal')
+    coupon = Coupon.objects.filter(pk=OuterRef('coupon_id')).values('amount')
+    Cart.objects.filter(ordered=True).update(
+        total=ExpressionWrapper(Coalesce(Subquery(subtotal), Value(0.0)) - Coalesce(Subquery(coupon), Value(0)),
+                                output_field=FloatField())
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_order_line_snapshots'),
+    ]
+
+    operations = [
+        # Separate from the table creation, whose indexes only exist once that migration is done
+        migrations.RunPython(snapshot_paid_orders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.1 on 2026-10-18 20:32
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_likes(apps, schema_editor):
+    Item = apps.get_model('core', 'Item')
+    likes = Item.likes.through.objects.filter(item_id=OuterRef('pk')).values('item_id')
+    Item.objects.update(like_count=Coalesce(Subquery(likes.annotate(count=Count('*')).values('count')), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_snapshot_paid_orders'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_likes, migrations.RunPython.noop),
+    ]
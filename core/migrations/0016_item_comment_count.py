@@ -0,0 +1,35 @@
+# Generated by Django 5.0.1 on 2026-10-18 20:35
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_comments(apps, schema_editor):
+    Item = apps.get_model('core', 'Item')
+    Comment = apps.get_model('core', 'Comment')
+    comments = Comment.objects.filter(item_id=OuterRef('pk')).values('item_id')
+    Item.objects.update(comment_count=Coalesce(Subquery(comments.annotate(count=Count('*')).values('count')),
+                                               Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_item_like_count'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['item', 'date'], name='comment_item_date_idx'),
+        ),
+        migrations.RunPython(count_comments, migrations.RunPython.noop),
+    ]
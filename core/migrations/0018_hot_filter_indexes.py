@@ -0,0 +1,53 @@
+# Generated by Django 5.0.1 on 2026-10-18 20:41
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_coupons(apps, schema_editor):
+    """
+    Keep the oldest coupon of each code before the code is made unique, carts using the others move to it
+    """
+    Cart = apps.get_model('core', 'Cart')
+    Coupon = apps.get_model('core', 'Coupon')
+    duplicated = (Coupon.objects.values('coupon').annotate(coupons=Count('id'))
+                  .filter(coupons__gt=1).values_list('coupon', flat=True))
+    for code in duplicated:
+        keep, *extra = Coupon.objects.filter(coupon=code).order_by('id')
+        Cart.objects.filter(coupon__in=extra).update(coupon=keep)
+        Coupon.objects.filter(pk__in=[coupon.pk for coupon in extra]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_item_image_hash'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_coupons, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='coupon',
+            name='coupon',
+            field=models.CharField(max_length=30, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='refund',
+            name='reference_code',
+            field=models.CharField(db_index=True, max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['user', 'address_type', 'is_default'], name='address_default_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(condition=models.Q(('ordered', True)), fields=['user', 'ordered_date'], name='cart_order_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['reference_code', 'refund_granted'], name='cart_reference_code_idx'),
+        ),
+    ]
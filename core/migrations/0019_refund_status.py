@@ -0,0 +1,39 @@
+# Generated by Django 5.0.1 on 2026-10-18 21:34
+
+from django.db import migrations, models
+
+
+def mark_granted_refunds(apps, schema_editor):
+    Refund = apps.get_model('core', 'Refund')
+    Refund.objects.filter(order__refund_granted=True).update(status='G')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_hot_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='refund',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='processed_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='status',
+            field=models.CharField(choices=[('R', 'Requested'), ('P', 'Processing'), ('G', 'Granted'), ('F', 'Failed')], default='R', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='stripe_refund_id',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        migrations.RunPython(mark_granted_refunds, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 5.0.1 on 2026-10-18 21:39
+
+import secrets
+import string
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def dedupe_reference_codes(apps, schema_editor):
+    """
+    Carts still shopping lose their empty code, orders sharing a code keep it on the oldest and the others get a new one
+    """
+    Cart = apps.get_model('core', 'Cart')
+    Cart.objects.filter(reference_code='').update(reference_code=None)
+    duplicated = (Cart.objects.exclude(reference_code=None).values('reference_code')
+                  .annotate(orders=Count('id')).filter(orders__gt=1).values_list('reference_code', flat=True))
+    alphabet = string.ascii_letters + string.digits
+    for code in list(duplicated):
+        for order in Cart.objects.filter(reference_code=code).order_by('id')[1:]:
+            order.reference_code = "".join(secrets.choice(alphabet) for _ in range(20))
+            order.save(update_fields=['reference_code'])
+
+
+def dedupe_refunds(apps, schema_editor):
+    """
+    Keep one refund per order, the granted one or else the latest
+    """
+    Refund = apps.get_model('core', 'Refund')
+    duplicated = (Refund.objects.values('order').annotate(refunds=Count('id'))
+                  .filter(refunds__gt=1).values_list('order', flat=True))
+    for order_id in list(duplicated):
+        keep = Refund.objects.filter(order_id=order_id).order_by(
+            models.Case(models.When(status='G', then=0), default=1), '-id').first()
+        Refund.objects.filter(order_id=order_id).exclude(pk=keep.pk).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_coupon_limits'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='cart',
+            name='cart_reference_code_idx',
+        ),
+        migrations.AlterField(
+            model_name='cart',
+            name='reference_code',
+            field=models.CharField(blank=True, max_length=20, null=True),
+        ),
+        migrations.RunPython(dedupe_reference_codes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='cart',
+            name='reference_code',
+            field=models.CharField(blank=True, max_length=20, null=True, unique=True),
+        ),
+        migrations.RunPython(dedupe_refunds, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='refund',
+            constraint=models.UniqueConstraint(fields=('order',), name='one_refund_per_order'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-18 21:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_unique_reference_codes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='address',
+            name='zip_code',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+    ]
@@ -1,10 +1,15 @@
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Sum, Count, Value, FloatField, ExpressionWrapper, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest, NullIf
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
 from django.conf import settings
 from django.shortcuts import reverse
 
 from django_countries.fields import CountryField
 
+from .images import schedule_derivatives
+from .managers import CachedManager
+
 LABEL_CHOICES = (
     ('P', 'primary'),
     ('S', 'secondary'),
@@ -16,6 +21,18 @@ ADDRESS_CHOICES = (
     ('S', 'Shipping')
 )
 
+REFUND_REQUESTED = 'R'
+REFUND_PROCESSING = 'P'
+REFUND_GRANTED = 'G'
+REFUND_FAILED = 'F'
+
+REFUND_STATUS_CHOICES = (
+    (REFUND_REQUESTED, 'Requested'),
+    (REFUND_PROCESSING, 'Processing'),
+    (REFUND_GRANTED, 'Granted'),
+    (REFUND_FAILED, 'Failed')
+)
+
 
 class UserProfile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -29,6 +46,8 @@ class UserProfile(models.Model):
 class Category(models.Model):
     category = models.CharField(max_length=30)
 
+    objects = CachedManager()
+
     def __str__(self):
         return self.category
 
@@ -44,11 +63,19 @@ class Item(models.Model):
     price = models.FloatField()
     discount_price = models.FloatField(blank=True, null=True)
     item_image = models.ImageField(upload_to='items_images/')
+    # Content hash naming the image's thumbnails and WebP copies, empty until they are rendered
+    image_hash = models.CharField(max_length=20, blank=True, editable=False)
     labels = models.CharField(choices=LABEL_CHOICES, max_length=2)
     slug = models.SlugField(unique=True)
     likes = models.ManyToManyField(settings.AUTH_USER_MODEL, blank=True)
+    # Number of rows in likes, kept in step by toggle_like and the likes signal, repaired by reconcile_like_counts
+    like_count = models.PositiveIntegerField(default=0)
+    # Number of comments on the item, kept in step by the comment signals
+    comment_count = models.PositiveIntegerField(default=0)
     description = models.TextField()
 
+    objects = CachedManager(cache_fields=['slug'])
+
     def __str__(self):
         return self.item_name
 
@@ -67,6 +94,88 @@ class Item(models.Model):
             'slug':self.slug
         })
 
+    def is_liked_by(self, user):
+        # Answered by the unique (item, user) index of the likes table
+        return Item.likes.through.objects.filter(item_id=self.pk, user_id=user.pk).exists()
+
+    def toggle_like(self, user):
+        """
+        Like the item for the user, or take the like back if there is one, and return whether it is liked now
+        The like row is written first and like_count moves with an UPDATE ... SET like_count = like_count + 1
+        in the same transaction, so concurrent clicks never lose or double count a like. The decrement
+        stops at 0, so a count that drifted below the likes rows can not block taking a like back.
+        """
+        from .cache import bump_item_version
+        through = Item.likes.through
+        with transaction.atomic():
+            if through.objects.filter(item_id=self.pk, user_id=user.pk).delete()[0]:
+                liked, change = False, -1
+            else:
+                try:
+                    through.objects.create(item_id=self.pk, user_id=user.pk)
+                except IntegrityError:
+                    # A concurrent click liked it first, and counted it
+                    transaction.set_rollback(True)
+                    return True
+                liked, change = True, 1
+            Item.objects.filter(pk=self.pk).update(like_count=Greatest(F('like_count') + change, 0))
+            # update() sends no signals
+            Item.objects.uncache(self)
+            bump_item_version(self.slug)
+        return liked
+
+
+def actual_like_count():
+    """
+    SQL expression counting the likes rows of an item, what like_count should hold
+    """
+    likes = Item.likes.through.objects.filter(item_id=OuterRef('pk')).values('item_id')
+    return Coalesce(Subquery(likes.annotate(count=Count('*')).values('count')), Value(0))
+
+
+def actual_comment_count():
+    """
+    SQL expression counting the comments of an item, what comment_count should hold
+    """
+    comments = Comment.objects.filter(item_id=OuterRef('pk')).values('item_id')
+    return Coalesce(Subquery(comments.annotate(count=Count('*')).values('count')), Value(0))
+
+
+def unit_price(prefix=''):
+    """
+    SQL expression for the price of one unit of an item, the discount price when the item has one
+    Matches OrderItem.get_final_price, where a discount price of 0 counts as no discount
+    """
+    return Coalesce(NullIf(F(f'{prefix}item__discount_price'), Value(0.0)), F(f'{prefix}item__price'),
+                    output_field=FloatField())
+
+
+class OrderItemQuerySet(models.QuerySet):
+    def with_prices(self):
+        """
+        Annotate every line with unit_price and line_total, and join its item in the same query
+        """
+        return self.select_related('item').annotate(
+            unit_price=unit_price(),
+            line_total=ExpressionWrapper(unit_price() * F('quantity'), output_field=FloatField())
+        )
+
+
+class CartQuerySet(models.QuerySet):
+    def with_totals(self):
+        """
+        Annotate every cart with line_count, subtotal and final_total (subtotal minus the coupon)
+        All of them come from one aggregate query instead of one query per cart line
+        """
+        line_total = ExpressionWrapper(unit_price('items__') * F('items__quantity'), output_field=FloatField())
+        return self.annotate(
+            line_count=Count('items'),
+            subtotal=Coalesce(Sum(line_total), Value(0.0))
+        ).annotate(
+            final_total=ExpressionWrapper(F('subtotal') - Coalesce(F('coupon__amount'), Value(0)),
+                                          output_field=FloatField())
+        )
+
 
 class OrderItem(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -74,6 +183,8 @@ class OrderItem(models.Model):
     quantity = models.IntegerField(default=1)
     ordered = models.BooleanField(default=False)
 
+    objects = OrderItemQuerySet.as_manager()
+
     def __str__(self):
         return f"{self.quantity} of {self.item.item_name}"
 
@@ -102,22 +213,62 @@ class Cart(models.Model):
     start_date = models.DateTimeField(auto_now_add=True)
     ordered_date = models.DateTimeField()
     ordered = models.BooleanField(default=False)
-    reference_code = models.CharField(max_length=20)
+    # Given when the order is paid, so carts still shopping have none
+    reference_code = models.CharField(max_length=20, unique=True, blank=True, null=True)
     being_delivered = models.BooleanField(default=False)
     received = models.BooleanField(default=False)
     refund_requested = models.BooleanField(default=False)
     refund_granted = models.BooleanField(default=False)
+    # What the order came to when it was paid, coupon included, set along with its lines
+    total = models.FloatField(blank=True, null=True)
+
+    objects = CartQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # A user shops with a single cart at a time, ordered carts are their history
+            models.UniqueConstraint(fields=['user'], condition=models.Q(ordered=False),
+                                    name='one_open_cart_per_user')
+        ]
+        indexes = [
+            # Order history, read backwards for newest first with the pk breaking ties
+            models.Index(fields=['user', 'ordered_date'], condition=models.Q(ordered=True),
+                         name='cart_order_history_idx'),
+        ]
 
     def __str__(self):
         return self.user.username
 
     def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total = total + order_item.get_final_price()
-        if self.coupon is not None:
-            total -= self.coupon.amount
-        return total
+        # Paid orders keep the total they were paid with
+        if self.total is not None:
+            return self.total
+        # Carts fetched through with_totals() already carry their total
+        if hasattr(self, 'final_total'):
+            return self.final_total
+        return Cart.objects.with_totals().values_list('final_total', flat=True).get(pk=self.pk)
+
+
+class OrderLine(models.Model):
+    """
+    A line of a paid order as it was at the time of purchase
+    The item's name and prices are copied, so later catalog changes leave the order history alone
+    and reading it does not need the item table.
+    """
+    order = models.ForeignKey(Cart, related_name='lines', on_delete=models.CASCADE)
+    item = models.ForeignKey(Item, related_name='+', on_delete=models.SET_NULL, blank=True, null=True)
+    item_name = models.CharField(max_length=100)
+    price = models.FloatField()
+    discount_price = models.FloatField(blank=True, null=True)
+    quantity = models.IntegerField()
+    line_total = models.FloatField()
+
+    def __str__(self):
+        return f"{self.quantity} of {self.item_name}"
+
+    @property
+    def unit_price(self):
+        return self.discount_price or self.price
 
 
 class Address(models.Model):
@@ -125,18 +276,25 @@ class Address(models.Model):
     street_address = models.CharField(max_length=100)
     apartment_address = models.CharField(max_length=100)
     country = models.CharField(max_length=200, choices=CountryField().choices + [('', 'Select Country')])
-    zip_code = models.CharField(max_length=100)
+    # The admin looks addresses up by zip code prefix
+    zip_code = models.CharField(max_length=100, db_index=True)
     address_type = models.CharField(max_length=1, choices=ADDRESS_CHOICES)
     is_default = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # The checkout looks up the user's default address of each type
+            models.Index(fields=['user', 'address_type', 'is_default'], name='address_default_idx'),
+        ]
+
     def __str__(self):
         return self.user.username
 
 
 class Payment(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, blank=True, null=True)
-    stripe_charge_id = models.CharField(max_length=50, null=True, blank=True)
-    ssl_charge_id = models.CharField(max_length=50, null=True, blank=True)
+    stripe_charge_id = models.CharField(max_length=50, null=True, blank=True, db_index=True)
+    ssl_charge_id = models.CharField(max_length=50, null=True, blank=True, db_index=True)
     amount = models.IntegerField()
     date = models.DateTimeField(auto_now_add=True)
 
@@ -145,8 +303,14 @@ class Payment(models.Model):
 
 
 class Coupon(models.Model):
-    coupon = models.CharField(max_length=30)
+    coupon = models.CharField(max_length=30, unique=True)
     amount = models.IntegerField()
+    # Carts the coupon may go on in total, no limit when empty, times_used is kept by core.coupons
+    max_uses = models.PositiveIntegerField(blank=True, null=True)
+    times_used = models.PositiveIntegerField(default=0)
+    valid_until = models.DateTimeField(blank=True, null=True)
+
+    objects = CachedManager(cache_fields=['coupon'])
 
     def __str__(self):
         return self.coupon
@@ -154,9 +318,20 @@ class Coupon(models.Model):
 
 class Refund(models.Model):
     order = models.ForeignKey(Cart, on_delete=models.CASCADE)
-    reference_code = models.CharField(max_length=20)
+    reference_code = models.CharField(max_length=20, db_index=True)
     reason = models.TextField()
     email = models.EmailField()
+    # Progress of the refund through core.refunds, a Processing refund was cut short and is resumed
+    status = models.CharField(max_length=1, choices=REFUND_STATUS_CHOICES, default=REFUND_REQUESTED)
+    stripe_refund_id = models.CharField(max_length=50, blank=True, null=True)
+    error = models.TextField(blank=True)
+    processed_date = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            # A second request for the same order fails on insert, without checking first
+            models.UniqueConstraint(fields=['order'], name='one_refund_per_order')
+        ]
 
     def __str__(self):
         return str(self.pk)
@@ -168,6 +343,12 @@ class Comment(models.Model):
     comment = models.TextField()
     date = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Serves the newest first comment stream of an item, the pk breaks ties within a date
+            models.Index(fields=['item', 'date'], name='comment_item_date_idx'),
+        ]
+
     def __str__(self):
         return self.comment
 
@@ -179,3 +360,159 @@ def user_profile_receiver(sender, instance, created, *args, **kwargs):
 
 # Signal to create user profile every time a new user is created
 post_save.connect(user_profile_receiver, sender=settings.AUTH_USER_MODEL)
+
+
+def item_search_index_receiver(sender, instance, **kwargs):
+    from .search import get_search_backend
+    get_search_backend().index_item(instance)
+
+
+def item_search_index_delete_receiver(sender, instance, **kwargs):
+    from .search import get_search_backend
+    get_search_backend().remove_item(instance)
+
+
+def category_search_index_receiver(sender, instance, created, **kwargs):
+    from .search import get_search_backend
+    if not created:
+        get_search_backend().index_category(instance)
+
+
+# Signals to keep the full-text search index in step with the items and their category names
+post_save.connect(item_search_index_receiver, sender=Item)
+post_delete.connect(item_search_index_delete_receiver, sender=Item)
+post_save.connect(category_search_index_receiver, sender=Category)
+
+
+def cart_count_receiver(sender, instance, **kwargs):
+    from .cache import invalidate_cart_count
+    invalidate_cart_count(instance.user_id)
+
+
+def cart_items_count_receiver(sender, instance, action, **kwargs):
+    from .cache import invalidate_cart_count
+    if action in ('post_add', 'post_remove', 'post_clear') and isinstance(instance, Cart):
+        invalidate_cart_count(instance.user_id)
+
+
+# Signals to drop the cached navbar cart count whenever the lines of a cart change
+post_save.connect(cart_count_receiver, sender=Cart)
+post_delete.connect(cart_count_receiver, sender=Cart)
+post_save.connect(cart_count_receiver, sender=OrderItem)
+post_delete.connect(cart_count_receiver, sender=OrderItem)
+m2m_changed.connect(cart_items_count_receiver, sender=Cart.items.through)
+
+
+def catalog_version_receiver(sender, **kwargs):
+    from .cache import bump_catalog_version
+    bump_catalog_version()
+
+
+# Signals to move cached listings and sidebars on to a new key whenever the catalog changes
+post_save.connect(catalog_version_receiver, sender=Item)
+post_delete.connect(catalog_version_receiver, sender=Item)
+post_save.connect(catalog_version_receiver, sender=Category)
+post_delete.connect(catalog_version_receiver, sender=Category)
+
+
+def item_page_version_receiver(sender, instance, **kwargs):
+    from .cache import bump_item_version
+    bump_item_version(instance.item.slug)
+
+
+def item_likes_version_receiver(sender, instance, action, reverse, pk_set, **kwargs):
+    from .cache import bump_item_version
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        bump_item_version(instance.slug)
+    elif pk_set:
+        for slug in Item.objects.filter(pk__in=pk_set).values_list('slug', flat=True):
+            bump_item_version(slug)
+
+
+def update_comment_count(comment, change):
+    Item.objects.filter(pk=comment.item_id).update(comment_count=F('comment_count') + change)
+    # update() sends no signals
+    Item.objects.uncache(comment.item)
+
+
+def comment_added_receiver(sender, instance, created, **kwargs):
+    if created:
+        update_comment_count(instance, 1)
+
+
+def comment_deleted_receiver(sender, instance, **kwargs):
+    update_comment_count(instance, -1)
+
+
+# Signals to keep the comment count of the items in step with their comments
+post_save.connect(comment_added_receiver, sender=Comment)
+post_delete.connect(comment_deleted_receiver, sender=Comment)
+
+
+def item_like_count_receiver(sender, instance, action, reverse, pk_set, **kwargs):
+    # toggle_like writes the likes table directly, this covers changes made through the M2M API
+    if action == 'pre_clear' and reverse:
+        instance._cleared_like_items = list(
+            Item.likes.through.objects.filter(user_id=instance.pk).values_list('item_id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        item_ids = [instance.pk]
+    elif action == 'post_clear':
+        item_ids = instance.__dict__.pop('_cleared_like_items', [])
+    else:
+        item_ids = pk_set or []
+    Item.objects.filter(pk__in=item_ids).update(like_count=actual_like_count())
+    # update() sends no signals
+    for item in Item.objects.filter(pk__in=item_ids).only('pk', 'slug'):
+        Item.objects.uncache(item)
+
+
+# Signal to recount the likes of items whose likes change through item.likes or user.item_set
+m2m_changed.connect(item_like_count_receiver, sender=Item.likes.through)
+
+
+# Signals to move a cached product page on to a new key when its comments or likes change
+post_save.connect(item_page_version_receiver, sender=Comment)
+post_delete.connect(item_page_version_receiver, sender=Comment)
+m2m_changed.connect(item_likes_version_receiver, sender=Item.likes.through)
+
+
+def object_cache_receiver(sender, instance, **kwargs):
+    sender.objects.uncache(instance)
+
+
+# Signals to drop items and categories from the object cache whenever they change
+post_save.connect(object_cache_receiver, sender=Item)
+post_delete.connect(object_cache_receiver, sender=Item)
+post_save.connect(object_cache_receiver, sender=Category)
+post_delete.connect(object_cache_receiver, sender=Category)
+
+
+def item_image_upload_receiver(sender, instance, **kwargs):
+    # A freshly uploaded file is only committed to storage while the item saves
+    instance._image_uploaded = bool(instance.item_image) and not instance.item_image._committed
+
+
+def item_image_receiver(sender, instance, **kwargs):
+    if getattr(instance, '_image_uploaded', False):
+        instance._image_uploaded = False
+        schedule_derivatives(instance)
+
+
+# Signals to render the thumbnails and WebP copies of a newly uploaded item image
+pre_save.connect(item_image_upload_receiver, sender=Item)
+post_save.connect(item_image_receiver, sender=Item)
+
+
+def coupon_cache_receiver(sender, instance, **kwargs):
+    from .coupons import uncache_coupon
+    uncache_coupon(instance)
+
+
+# Signals to drop a coupon from the coupon caches whenever it changes
+post_save.connect(coupon_cache_receiver, sender=Coupon)
+post_delete.connect(coupon_cache_receiver, sender=Coupon)
@@ -0,0 +1,160 @@
+import hashlib
+
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import Paginator, Page, InvalidPage
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+from .routers import primary_reads
+
+CURSOR_SALT = 'core.pagination.cursor'
+# How long the total row count of a listing is reused before it is counted again
+COUNT_CACHE_TIMEOUT = 60 * 5
+
+
+class KeysetPage(Page):
+    """
+    A page that also knows the opaque cursors pointing to its neighbours
+    Pages fetched through a cursor know from the keyset query itself whether a neighbour exists
+    """
+    def __init__(self, object_list, number, paginator, has_previous=None, has_next=None):
+        super().__init__(object_list, number, paginator)
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def has_next(self):
+        if self._has_next is None:
+            return super().has_next()
+        return self._has_next
+
+    def has_previous(self):
+        if self._has_previous is None:
+            return super().has_previous()
+        return self._has_previous
+
+    @cached_property
+    def next_cursor(self):
+        if not self.paginator.keyset or not self.has_next() or not len(self.object_list):
+            return None
+        last = self.object_list[len(self.object_list) - 1]
+        return self.paginator.encode_cursor(getattr(last, self.paginator.key), self.number + 1, 'n')
+
+    @cached_property
+    def previous_cursor(self):
+        if not self.paginator.keyset or not self.has_previous() or not len(self.object_list):
+            return None
+        first = self.object_list[0]
+        return self.paginator.encode_cursor(getattr(first, self.paginator.key), self.number - 1, 'p')
+
+
+class CachedCountPaginator(Paginator):
+    """
+    Paginator reusing the total count of a query for count_cache_timeout seconds
+    Each filtered or searched variant of a listing is counted once per period instead of on every
+    request, and is counted again as soon as count_cache_version changes.
+    """
+    count_cache_timeout = COUNT_CACHE_TIMEOUT
+    count_cache_version = None
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None:
+            return super().count
+        try:
+            key = 'core:count:' + hashlib.md5(str(query).encode()).hexdigest()
+        except EmptyResultSet:
+            return 0
+        count = cache.get(key, version=self.count_cache_version)
+        if count is None:
+            # Counted on the primary, the count is cached under the version the primary is at
+            with primary_reads():
+                count = self.object_list.count()
+            cache.set(key, count, self.count_cache_timeout, version=self.count_cache_version)
+        return count
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        # Slice by page size alone, a cached count that is behind must not cut rows off the page
+        return self._get_page(self.object_list[bottom:bottom + self.per_page], number, self)
+
+
+class KeysetPaginator(CachedCountPaginator):
+    """
+    Paginator for listings ordered by a unique key
+    Pages can be fetched by number as usual or through a cursor, which seeks with WHERE key > last
+    instead of an OFFSET, so page 5000 costs the same as page 1.
+    """
+    def __init__(self, object_list, per_page, key='id', count_cache_timeout=COUNT_CACHE_TIMEOUT,
+                 count_cache_version=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.key = key
+        self.count_cache_timeout = count_cache_timeout
+        self.count_cache_version = count_cache_version
+
+    @cached_property
+    def keyset(self):
+        # Cursors only make sense when the rows are ordered by the key alone
+        query = getattr(self.object_list, 'query', None)
+        return query is not None and tuple(query.order_by) == (self.key,)
+
+    def _get_page(self, *args, **kwargs):
+        return KeysetPage(*args, **kwargs)
+
+    def encode_cursor(self, value, number, direction):
+        return signing.dumps({'k': value, 'n': number, 'd': direction}, salt=CURSOR_SALT)
+
+    def page_from_cursor(self, cursor):
+        if not self.keyset:
+            raise InvalidPage("This listing can not be paginated with a cursor")
+        try:
+            data = signing.loads(cursor, salt=CURSOR_SALT)
+            value, number, direction = data['k'], int(data['n']), data['d']
+        except (signing.BadSignature, KeyError, TypeError, ValueError):
+            raise InvalidPage("Invalid cursor")
+        if direction == 'n':
+            rows = list(self.object_list.filter(**{f"{self.key}__gt": value})[:self.per_page + 1])
+            has_next = len(rows) > self.per_page
+            return KeysetPage(rows[:self.per_page], max(number, 2), self, has_previous=True, has_next=has_next)
+        rows = list(self.object_list.filter(**{f"{self.key}__lt": value}).reverse()[:self.per_page + 1])
+        has_previous = len(rows) > self.per_page
+        rows = rows[:self.per_page][::-1]
+        number = number if has_previous else 1
+        return KeysetPage(rows, max(number, 1), self, has_previous=has_previous, has_next=True)
+
+
+class KeysetStream:
+    """
+    Newest first listing read a batch at a time, for "load more" links rather than numbered pages
+    Rows are ordered by a datetime field with the pk breaking ties, and each batch seeks past the
+    last row of the one before through an opaque cursor, so there is neither an OFFSET nor a count.
+    """
+    def __init__(self, queryset, per_page, field):
+        self.queryset = queryset.order_by(f'-{field}', '-pk')
+        self.per_page = per_page
+        self.field = field
+
+    def batch(self, cursor=None):
+        """
+        The rows after cursor, or the first ones without it, and the cursor of the next batch (None at the end)
+        """
+        queryset = self.queryset
+        if cursor:
+            try:
+                value, pk = signing.loads(cursor, salt=CURSOR_SALT)
+                value, pk = parse_datetime(value), int(pk)
+            except (signing.BadSignature, TypeError, ValueError):
+                raise InvalidPage("Invalid cursor")
+            if value is None:
+                raise InvalidPage("Invalid cursor")
+            queryset = queryset.filter(Q(**{f'{self.field}__lt': value}) | Q(**{self.field: value, 'pk__lt': pk}))
+        rows = list(queryset[:self.per_page + 1])
+        if len(rows) <= self.per_page:
+            return rows, None
+        rows = rows[:self.per_page]
+        last = rows[-1]
+        return rows, signing.dumps([getattr(last, self.field).isoformat(), last.pk], salt=CURSOR_SALT)
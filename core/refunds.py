@@ -0,0 +1,152 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import stripe
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+
+from .models import Cart, Refund, REFUND_PROCESSING, REFUND_GRANTED, REFUND_FAILED
+
+logger = logging.getLogger(__name__)
+
+# What a refund request did, so the view can tell the user
+REQUESTED = 'requested'
+ALREADY_REQUESTED = 'already_requested'
+ALREADY_REFUNDED = 'already_refunded'
+NO_ORDER = 'no_order'
+
+# Reason recorded on the refunds of orders nobody asked a refund for
+ADMIN_REFUND_REASON = "Refunded from the admin"
+
+_http_client = None
+
+
+def get_http_client():
+    """
+    The Stripe HTTP client, one session keeping up to REFUND_WORKERS connections alive
+    Installed as Stripe's default client on first use, so the refund workers reuse their TLS
+    connections instead of opening one per call.
+    """
+    global _http_client
+    if _http_client is None:
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=settings.REFUND_WORKERS))
+        _http_client = stripe.http_client.RequestsClient(session=session)
+        stripe.default_http_client = _http_client
+    return _http_client
+
+
+def request_refund(user, reference_code, reason, email):
+    """
+    Ask for a refund of the user's order with the reference code
+    The order row is locked while the refund is created, and the one_refund_per_order constraint
+    turns a second request away on insert, so there is no check-then-create race and the unique
+    reference code index serves the only lookup.
+    """
+    try:
+        with transaction.atomic():
+            order = Cart.objects.select_for_update().filter(user=user, ordered=True,
+                                                            reference_code=reference_code).first()
+            if order is None:
+                return NO_ORDER
+            if order.refund_granted:
+                return ALREADY_REFUNDED
+            Refund.objects.create(order=order, reference_code=reference_code, reason=reason, email=email)
+            Cart.objects.filter(pk=order.pk).update(refund_requested=True)
+            return REQUESTED
+    except IntegrityError:
+        return ALREADY_REQUESTED
+
+
+def refund_charge(order_id, charge_id):
+    """
+    Refund the Stripe charge that paid the order, returns the refund id and an error message
+    The idempotency key is the order's, so a refund retried after a crash or a timeout is the one
+    Stripe already made instead of a second one. Runs on the worker threads and does not touch the database.
+    """
+    if not charge_id:
+        return None, "Not paid through Stripe, refund it through the payment gateway"
+    try:
+        refund = stripe.Refund.create(charge=charge_id, idempotency_key=f"refund-order-{order_id}",
+                                      api_key=settings.STRIPE_SECRET_KEY)
+    except stripe.error.InvalidRequestError as e:
+        # Refunded by a run whose idempotency key Stripe no longer remembers
+        if e.code == 'charge_already_refunded':
+            return None, ''
+        return None, e.user_message or str(e)
+    except stripe.error.StripeError as e:
+        return None, e.user_message or str(e)
+    except Exception:
+        logger.exception("Refunding the charge %s of order %s failed", charge_id, order_id)
+        return None, "Unexpected error, see the logs"
+    return refund['id'], ''
+
+
+def claim_refunds(order_ids):
+    """
+    Mark the refunds of the orders Processing, creating the missing ones, and return them
+    Refunds of an earlier run that were granted are returned as they are and not sent again.
+    """
+    with transaction.atomic():
+        orders = Cart.objects.filter(pk__in=order_ids, ordered=True, refund_granted=False).select_related(
+            'user', 'payment')
+        refunds = {refund.order_id: refund for refund in Refund.objects.filter(order__in=order_ids)}
+        to_create, to_claim = [], []
+        for order in orders:
+            refund = refunds.get(order.pk)
+            if refund is None:
+                refund = Refund(order=order, reference_code=order.reference_code, reason=ADMIN_REFUND_REASON,
+                                email=order.user.email, status=REFUND_PROCESSING)
+                to_create.append(refund)
+            elif refund.status != REFUND_GRANTED:
+                refund.status = REFUND_PROCESSING
+                to_claim.append(refund)
+            refund.order = order
+            refunds[order.pk] = refund
+        Refund.objects.bulk_create(to_create)
+        Refund.objects.filter(pk__in=[refund.pk for refund in to_claim]).update(status=REFUND_PROCESSING)
+        return [refunds[order.pk] for order in orders]
+
+
+def refund_chunk(order_ids, pool):
+    """
+    Refund one chunk of orders, the Stripe calls run on the pool between two short transactions
+    """
+    refunds = claim_refunds(order_ids)
+    pending = [refund for refund in refunds if refund.status != REFUND_GRANTED]
+    outcomes = pool.map(refund_charge, [refund.order_id for refund in pending],
+                        [refund.order.payment.stripe_charge_id if refund.order.payment_id else None
+                         for refund in pending])
+    now = timezone.now()
+    for refund, (stripe_refund_id, error) in zip(pending, outcomes):
+        refund.status = REFUND_FAILED if error else REFUND_GRANTED
+        refund.stripe_refund_id = stripe_refund_id or refund.stripe_refund_id
+        refund.error = error
+        refund.processed_date = now
+    with transaction.atomic():
+        Refund.objects.bulk_update(pending, ['status', 'stripe_refund_id', 'error', 'processed_date'])
+        Cart.objects.filter(pk__in=[refund.order_id for refund in refunds if refund.status == REFUND_GRANTED]).update(
+            refund_requested=False, refund_granted=True)
+    return refunds
+
+
+def grant_refunds(orders, chunk_size=None, workers=None):
+    """
+    Refund the paid orders of the queryset through Stripe, chunk_size orders at a time
+    Each chunk is claimed in one transaction and settled in another, the cart table is never
+    locked while Stripe is called. Orders already refunded are skipped and refunds left Processing
+    or Failed by an earlier run are retried, so running the same selection again picks up where
+    the last run stopped. Returns the refunds of the orders processed, with their status and error.
+    """
+    chunk_size = chunk_size or settings.REFUND_BATCH_SIZE
+    order_ids = list(orders.filter(ordered=True, refund_granted=False).order_by('pk').values_list('pk', flat=True))
+    refunds = []
+    if not order_ids:
+        return refunds
+    get_http_client()
+    with ThreadPoolExecutor(max_workers=workers or settings.REFUND_WORKERS) as pool:
+        for start in range(0, len(order_ids), chunk_size):
+            refunds.extend(refund_chunk(order_ids[start:start + chunk_size], pool))
+    return refunds
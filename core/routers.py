@@ -0,0 +1,108 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+
+PRIMARY = 'default'
+
+# Cookie keeping a client that just wrote on the primary, so it reads its own writes
+PIN_COOKIE = 'pin_primary'
+
+# The replica the running catalog view reads from, None sends reads to the primary
+_replica = ContextVar('replica', default=None)
+# Set by the first write of the request, later reads go to the primary to see it
+_wrote = ContextVar('wrote', default=False)
+# Set while a cache is being filled, a replica that is behind would get its rows cached under the
+# version the primary already moved on to
+_filling_cache = ContextVar('filling_cache', default=False)
+
+
+def choose_replica():
+    return random.choice(settings.REPLICA_DATABASES)
+
+
+@contextmanager
+def reading_from(alias):
+    token = _replica.set(alias)
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """
+    Read from the primary inside the block, even in a view wrapped with replica_reads
+    Wraps whatever fills a cache, so caches only ever hold what the primary has.
+    """
+    token = _filling_cache.set(True)
+    try:
+        yield
+    finally:
+        _filling_cache.reset(token)
+
+
+class ReplicaRouter:
+    """
+    Send the reads of catalog views to a replica and everything else to the primary
+    Reads only leave the primary inside views wrapped with replica_reads, so the cart, checkout and
+    payment never see replication lag. A request sticks to one replica, and goes back to the
+    primary for good once it wrote anything.
+    """
+    def db_for_read(self, model, **hints):
+        replica = _replica.get()
+        if replica is not None and not _wrote.get() and not _filling_cache.get():
+            return replica
+        return PRIMARY
+
+    def db_for_write(self, model, **hints):
+        _wrote.set(True)
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY
+
+
+def replica_reads(view):
+    """
+    Let the view read from one of the REPLICA_DATABASES, unless the client wrote a moment ago
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if (not settings.REPLICA_DATABASES or request.method not in ('GET', 'HEAD')
+                or request.COOKIES.get(PIN_COOKIE) or _filling_cache.get()):
+            return view(request, *args, **kwargs)
+        with reading_from(choose_replica()):
+            response = view(request, *args, **kwargs)
+            # Template responses run their lazy querysets while rendering
+            if hasattr(response, 'render'):
+                response = response.render()
+            return response
+    return wrapper
+
+
+class PinPrimaryMiddleware:
+    """
+    Keep clients on the primary for REPLICA_PIN_SECONDS after a request of theirs wrote
+    Comes first in MIDDLEWARE so it also sees the session and the login being saved.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _wrote.set(False)
+        try:
+            response = self.get_response(request)
+            if _wrote.get() and settings.REPLICA_DATABASES:
+                response.set_cookie(PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS,
+                                    httponly=True, samesite='Lax')
+            return response
+        finally:
+            _wrote.reset(token)
@@ -0,0 +1,116 @@
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from .models import Item
+
+FTS_TABLE = 'core_item_fts'
+
+
+class ContainsSearchBackend:
+    """
+    Plain icontains search on the item name and category name
+    Used on databases that have no full-text index, every search scans the item table
+    """
+    def search(self, queryset, query):
+        return queryset.filter(
+            Q(item_category__category__icontains=query) |
+            Q(item_name__icontains=query)
+        )
+
+    def index_item(self, item):
+        pass
+
+    def remove_item(self, item):
+        pass
+
+    def index_category(self, category):
+        pass
+
+    def rebuild(self):
+        return 0
+
+    def optimize(self):
+        pass
+
+
+class SQLiteFTSSearchBackend(ContainsSearchBackend):
+    """
+    Search through an FTS5 virtual table holding the item name and category name of every item
+    The rowid of the index is the item id. Every word of the query has to match the start of a
+    word in the item or category name, and results are ordered by bm25 relevance.
+    """
+    def match_expression(self, query):
+        words = re.findall(r'\w+', query)
+        return " ".join(f'"{word}"*' for word in words)
+
+    def search(self, queryset, query):
+        match = self.match_expression(query)
+        if not match:
+            return queryset.none()
+        # Join the index so the MATCH runs once and drives the query, rank comes along with each row
+        return queryset.extra(
+            tables=[FTS_TABLE],
+            where=[f"{FTS_TABLE}.rowid = {Item._meta.db_table}.id", f"{FTS_TABLE} MATCH %s"],
+            params=[match],
+            select={'search_rank': f"{FTS_TABLE}.rank"},
+        ).order_by('search_rank', 'id')
+
+    def index_item(self, item):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [item.pk])
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, item_name, category) "
+                f"SELECT %s, %s, category FROM core_category WHERE id = %s",
+                [item.pk, item.item_name, item.item_category_id]
+            )
+
+    def remove_item(self, item):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [item.pk])
+
+    def index_category(self, category):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {FTS_TABLE} SET category = %s "
+                f"WHERE rowid IN (SELECT id FROM core_item WHERE item_category_id = %s)",
+                [category.category, category.pk]
+            )
+
+    def rebuild(self):
+        # One transaction, searches never see the index emptied and a failed refill keeps the old one
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, item_name, category) "
+                f"SELECT core_item.id, core_item.item_name, core_category.category "
+                f"FROM core_item INNER JOIN core_category ON core_item.item_category_id = core_category.id"
+            )
+            return cursor.rowcount
+
+    def optimize(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+
+
+# Whether the full-text table exists, per database file, so it is only looked up once per process
+_fts_table_exists = {}
+
+
+def get_search_backend():
+    """
+    The backend named by the SEARCH_BACKEND setting, otherwise the best one for the database in use
+    """
+    path = getattr(settings, 'SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)()
+    if connection.vendor == 'sqlite':
+        name = connection.settings_dict['NAME']
+        if name not in _fts_table_exists:
+            _fts_table_exists[name] = FTS_TABLE in connection.introspection.table_names()
+        if _fts_table_exists[name]:
+            return SQLiteFTSSearchBackend()
+    return ContainsSearchBackend()
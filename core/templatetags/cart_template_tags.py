@@ -1,5 +1,5 @@
 from django import template
-from core.models import Cart
+from core.cache import get_cart_count
 
 register = template.Library()
 
@@ -7,8 +7,4 @@ register = template.Library()
 @register.filter
 def cart_item_count(user):
     if user.is_authenticated:
-        qs = Cart.objects.filter(user=user, ordered=False)
-        if qs.exists():
-            return qs[0].items.count()
-        else:
-            return 0
+        return get_cart_count(user)
@@ -0,0 +1,23 @@
+from django import template
+
+from core.images import FORMATS, VARIANTS, derivative_url, srcset
+
+register = template.Library()
+
+
+@register.inclusion_tag('item_picture.html')
+def item_picture(item, variant, sizes, css_class='', width=None, height=None):
+    """
+    The item's image as a <picture> offering each rendered format in every size of the variant
+    The browser picks the first format it supports and the smallest size covering the slot given by
+    sizes. Items whose derivatives are not rendered yet show the uploaded original.
+    """
+    context = {'item': item, 'sizes': sizes, 'css_class': css_class, 'width': width, 'height': height}
+    digest = item.image_hash
+    if digest:
+        *sources, (fallback, _, _, _) = FORMATS
+        context['sources'] = [{'type': mime_type, 'srcset': srcset(digest, variant, ext)}
+                              for ext, _, mime_type, _ in sources]
+        context['srcset'] = srcset(digest, variant, fallback)
+        context['src'] = derivative_url(digest, variant, VARIANTS[variant][0][0], fallback)
+    return context
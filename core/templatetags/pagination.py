@@ -2,7 +2,23 @@ from django import template
 
 register = template.Library()
 
+# How many page links are shown on each side of the current page
+PAGE_WINDOW = 3
+
 
 @register.filter(name='paginate')
-def paginate(pages):
-    return range(1, pages + 1)
+def paginate(pages, current=None):
+    """
+    Page numbers for the pagination strip
+    Given the current page only the first, the last and a window around the current page are
+    returned, with None marking each gap, so the strip stays short however many pages there are
+    """
+    if current is None:
+        return range(1, pages + 1)
+    shown = sorted({1, pages} | set(range(max(current - PAGE_WINDOW, 1), min(current + PAGE_WINDOW, pages) + 1)))
+    strip = []
+    for page in shown:
+        if strip and page - strip[-1] > 1:
+            strip.append(None)
+        strip.append(page)
+    return strip
@@ -0,0 +1,24 @@
+from django import template
+from django.templatetags.cache import CacheNode, do_cache
+
+from ..routers import primary_reads
+
+register = template.Library()
+
+
+class PrimaryCacheNode(CacheNode):
+    def render(self, context):
+        # A hit reads nothing, a miss renders the fragment from the primary
+        with primary_reads():
+            return super().render(context)
+
+
+@register.tag('cache')
+def do_primary_cache(parser, token):
+    """
+    Django's {% cache %}, with the fragment rendered from the primary database when it is not cached
+    Fragments are keyed by the catalog version, one rendered from a replica that is behind would
+    be kept under the version the primary already moved on to.
+    """
+    node = do_cache(parser, token)
+    return PrimaryCacheNode(node.nodelist, node.expire_time_var, node.fragment_name, node.vary_on, node.cache_name)
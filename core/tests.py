@@ -1,3 +1,1990 @@
-from django.test import TestCase
+import contextvars
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.paginator import InvalidPage
+from django.db import connection, connections, transaction, DatabaseError, IntegrityError
+from django.db.models import QuerySet
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image as PILImage
+import stripe
+
+from . import cart as cart_service, coupons, images, refunds as refund_service, views
+from .cache import get_cart_count
+from .models import (Item, Cart, OrderItem, OrderLine, Address, Comment, Payment, Coupon,
+                     Category, UserProfile, Refund, actual_like_count, actual_comment_count,
+                     REFUND_PROCESSING, REFUND_GRANTED, REFUND_FAILED)
+from .search import get_search_backend, SQLiteFTSSearchBackend
+from .pagination import KeysetPaginator, KeysetStream
+from .routers import PIN_COOKIE, ReplicaRouter, reading_from
+from .templatetags.pagination import paginate
+
+User = get_user_model()
+
+
+def seed_catalog(categories=3, items_per_category=4, comments_per_item=5):
+    """
+    Create a small but non-trivial catalog so that per-row queries show up in the query counts
+    """
+    commenter = User.objects.create_user(username='commenter', password='password')
+    items = []
+    for c in range(categories):
+        category = Category.objects.create(category=f"category{c}")
+        for i in range(items_per_category):
+            item = Item.objects.create(
+                item_name=f"item {c}-{i}",
+                item_category=category,
+                price=10.0 + i,
+                discount_price=8.0 + i if i % 2 else None,
+                item_image='items_images/sample.jpg',
+                labels='P',
+                slug=f"item-{c}-{i}",
+                description="A seeded item"
+            )
+            for n in range(comments_per_item):
+                Comment.objects.create(user=commenter, item=item, comment=f"comment {n}")
+            items.append(item)
+    return items
+
+
+def seed_cart(user, items, ordered=False, coupon=None):
+    cart = Cart.objects.create(user=user, ordered_date=timezone.now(), ordered=ordered, coupon=coupon)
+    for quantity, item in enumerate(items, start=1):
+        order_item = OrderItem.objects.create(user=user, item=item, quantity=quantity, ordered=ordered)
+        cart.items.add(order_item)
+        if ordered:
+            OrderLine.objects.create(order=cart, item=item, item_name=item.item_name, price=item.price,
+                                     discount_price=item.discount_price, quantity=quantity,
+                                     line_total=order_item.get_final_price())
+    if ordered:
+        cart.total = cart.get_total()
+        cart.save()
+    return cart
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Drive every route in core/urls.py against a seeded database and hold each one to a query budget.
+    Query count, SQL time, the rest of the request time (views and rendering) and total request time
+    are recorded for every route and printed once the suite finishes; set QUERY_BUDGET_REPORT to a file path to also dump them as JSON.
+    """
+    # Maximum number of SQL queries a single request to the route may run
+    budgets = {
+        'item_list': 6,
+        'item_list_by_category': 6,
+        'item_list_search': 6,
+        'products': 7,
+        'order_summary': 5,
+        'checkout': 9,
+        'payment': 6,
+        'payment_post': 7,
+        'customer_profile': 6,
+        'add_to_cart': 6,
+        'add_to_cart_new_item': 10,
+        'remove_from_the_cart': 9,
+        'remove_single_from_the_cart': 7,
+        'add_coupon': 5,
+        'request_refund': 4,
+        'request_refund_post': 7,
+        'likes': 8,
+        'comments': 5,
+        'item_comments': 4,
+        'item_comments_cursor': 4,
+        'complete_payment': 11,
+    }
+    results = []
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog()
+        cls.user = User.objects.create_user(username='shopper', email='shopper@example.com',
+                                            password='password')
+        cls.coupon = Coupon.objects.create(coupon='Django', amount=5)
+        billing = Address.objects.create(user=cls.user, street_address='1 Road', apartment_address='2',
+                                         country='BD', zip_code='1000', address_type='B', is_default=True)
+        Address.objects.create(user=cls.user, street_address='1 Road', apartment_address='2',
+                               country='BD', zip_code='1000', address_type='S', is_default=True)
+        cls.cart = seed_cart(cls.user, cls.items[:5])
+        cls.cart.billing_address = billing
+        cls.cart.save()
+        for n in range(3):
+            order = seed_cart(cls.user, cls.items[5 + n * 2:8 + n * 2], ordered=True, coupon=cls.coupon)
+            order.payment = Payment.objects.create(user=cls.user, amount=50, stripe_charge_id=f"ch_{n}")
+            order.reference_code = f"reference{n}"
+            order.save()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if not cls.results:
+            return
+        lines = [f"{'route':<30}{'queries':>8}{'budget':>8}{'sql ms':>10}{'render ms':>10}{'total ms':>10}"]
+        for result in cls.results:
+            lines.append(f"{result['route']:<30}{result['queries']:>8}{result['budget']:>8}"
+                         f"{result['sql_ms']:>10.2f}{result['render_ms']:>10.2f}{result['total_ms']:>10.2f}")
+        sys.stderr.write("\n" + "\n".join(lines) + "\n")
+        report = os.environ.get('QUERY_BUDGET_REPORT')
+        if report:
+            with open(report, 'w') as fp:
+                json.dump(cls.results, fp, indent=2)
+
+    def setUp(self):
+        # Measure the cold path, nothing cached by an earlier test
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def assertWithinBudget(self, route, path, method='get', data=None, status=None):
+        # The debug cursor rounds each query's time to the millisecond, time them here instead
+        sql_seconds = []
+
+        def timed(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                sql_seconds.append(time.perf_counter() - start)
+
+        with CaptureQueriesContext(connection) as queries, connection.execute_wrapper(timed):
+            start = time.perf_counter()
+            response = getattr(self.client, method)(path, data or {})
+            total = time.perf_counter() - start
+        sql = sum(sql_seconds)
+        self.results.append({
+            'route': route,
+            'queries': len(queries),
+            'budget': self.budgets[route],
+            'sql_ms': sql * 1000,
+            'render_ms': (total - sql) * 1000,
+            'total_ms': total * 1000,
+        })
+        if status is not None:
+            self.assertEqual(response.status_code, status)
+        self.assertLessEqual(
+            len(queries), self.budgets[route],
+            f"{route} ran {len(queries)} queries, over its budget of {self.budgets[route]}:\n"
+            + "\n".join(query['sql'] for query in queries.captured_queries)
+        )
+        return response
+
+    def test_item_list(self):
+        self.assertWithinBudget('item_list', reverse('core:item_list'), status=200)
+
+    def test_item_list_by_category(self):
+        path = reverse('core:item_list_by_category', kwargs={'category_name': 'category1'})
+        self.assertWithinBudget('item_list_by_category', path, status=200)
+
+    def test_item_list_search(self):
+        self.assertWithinBudget('item_list_search', reverse('core:item_list'), data={'key': 'item'},
+                                status=200)
+
+    def test_products(self):
+        path = reverse('core:products', kwargs={'slug': self.items[0].slug})
+        self.assertWithinBudget('products', path, status=200)
+
+    def test_order_summary(self):
+        self.assertWithinBudget('order_summary', reverse('core:order_summary'), status=200)
+
+    def test_checkout(self):
+        self.assertWithinBudget('checkout', reverse('core:checkout'), status=200)
+
+    def test_payment(self):
+        path = reverse('core:payment', kwargs={'payment_option': 'Stripe'})
+        self.assertWithinBudget('payment', path, status=200)
+
+    def test_payment_post(self):
+        path = reverse('core:payment', kwargs={'payment_option': 'Stripe'})
+        with mock.patch('core.views.stripe.Charge.create', return_value={'id': 'ch_test'}):
+            response = self.assertWithinBudget('payment_post', path, method='post',
+                                               data={'stripeToken': 'tok_visa'}, status=302)
+        self.assertIn('ch_test', response.url)
+
+    def test_customer_profile(self):
+        self.assertWithinBudget('customer_profile', reverse('core:customer_profile'), status=200)
+
+    def test_add_to_cart(self):
+        path = reverse('core:add_to_cart', kwargs={'slug': self.items[0].slug})
+        self.assertWithinBudget('add_to_cart', path, status=302)
+
+    def test_add_to_cart_new_item(self):
+        path = reverse('core:add_to_cart', kwargs={'slug': self.items[-1].slug})
+        self.assertWithinBudget('add_to_cart_new_item', path, status=302)
+
+    def test_remove_from_the_cart(self):
+        path = reverse('core:remove_from_the_cart', kwargs={'slug': self.items[0].slug})
+        self.assertWithinBudget('remove_from_the_cart', path, status=302)
+
+    def test_remove_single_from_the_cart(self):
+        path = reverse('core:remove_single_from_the_cart', kwargs={'slug': self.items[1].slug})
+        self.assertWithinBudget('remove_single_from_the_cart', path, status=302)
+
+    def test_add_coupon(self):
+        self.assertWithinBudget('add_coupon', reverse('core:add_coupon'), method='post',
+                                data={'coupon_code': 'Django'}, status=302)
+
+    def test_request_refund(self):
+        self.assertWithinBudget('request_refund', reverse('core:request_refund'), status=200)
+
+    def test_request_refund_post(self):
+        data = {'reference_code': 'reference0', 'reason': 'Broken', 'email': 'shopper@example.com'}
+        self.assertWithinBudget('request_refund_post', reverse('core:request_refund'), method='post',
+                                data=data, status=302)
+
+    def test_likes(self):
+        path = reverse('core:likes', kwargs={'slug': self.items[0].slug})
+        self.assertWithinBudget('likes', path, status=302)
+
+    def test_comments(self):
+        path = reverse('core:comments', kwargs={'slug': self.items[0].slug})
+        self.assertWithinBudget('comments', path, method='post', data={'comment': 'Nice'}, status=302)
+
+    def test_item_comments(self):
+        path = reverse('core:item_comments', kwargs={'slug': self.items[0].slug})
+        self.assertWithinBudget('item_comments', path, status=200)
+
+    def test_item_comments_cursor(self):
+        item = self.items[0]
+        Comment.objects.bulk_create(Comment(user=self.user, item=item, comment=f"Comment {n}")
+                                    for n in range(views.COMMENTS_PER_PAGE))
+        path = reverse('core:item_comments', kwargs={'slug': item.slug})
+        cursor = self.client.get(path).context['next_cursor']
+        self.assertTrue(cursor)
+        cache.clear()
+        response = self.assertWithinBudget('item_comments_cursor', path, data={'cursor': cursor}, status=200)
+        self.assertEqual(len(response.context['comments']), 5)
+
+    def test_complete_payment(self):
+        path = reverse('core:complete_payment', kwargs={'tran_id': 'ch_test', 'payment_type': 'S'})
+        self.assertWithinBudget('complete_payment', path, status=302)
+
+
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=2, items_per_category=10, comments_per_item=0)
+
+    def setUp(self):
+        cache.clear()
+
+    def page_ids(self, response):
+        return [item.pk for item in response.context['object_list']]
+
+    def test_cursors_walk_the_listing(self):
+        ids = [item.pk for item in self.items]
+        response = self.client.get(reverse('core:item_list'))
+        self.assertEqual(self.page_ids(response), ids[:8])
+        page = response.context['page_obj']
+        self.assertIsNone(page.previous_cursor)
+
+        response = self.client.get(reverse('core:item_list'), {'cursor': page.next_cursor})
+        self.assertEqual(self.page_ids(response), ids[8:16])
+        page = response.context['page_obj']
+        self.assertEqual(page.number, 2)
+        self.assertTrue(page.has_previous())
+
+        response = self.client.get(reverse('core:item_list'), {'cursor': page.next_cursor})
+        self.assertEqual(self.page_ids(response), ids[16:])
+        page = response.context['page_obj']
+        self.assertEqual(page.number, 3)
+        self.assertFalse(page.has_next())
+        self.assertIsNone(page.next_cursor)
+
+        response = self.client.get(reverse('core:item_list'), {'cursor': page.previous_cursor})
+        self.assertEqual(self.page_ids(response), ids[8:16])
+        response = self.client.get(reverse('core:item_list'),
+                                   {'cursor': response.context['page_obj'].previous_cursor})
+        self.assertEqual(self.page_ids(response), ids[:8])
+        self.assertFalse(response.context['page_obj'].has_previous())
+
+    def test_cursor_pages_do_not_offset_or_recount(self):
+        first = self.client.get(reverse('core:item_list'))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('core:item_list'), {'cursor': first.context['page_obj'].next_cursor})
+        sql = " ".join(query['sql'] for query in queries.captured_queries)
+        self.assertNotIn('OFFSET', sql)
+        self.assertNotIn('COUNT(', sql)
+
+    def test_tampered_cursor_is_not_found(self):
+        response = self.client.get(reverse('core:item_list'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_stale_count_does_not_cut_rows_off_a_page(self):
+        KeysetPaginator(Item.objects.order_by('id'), 8).count
+        extra = Item.objects.create(item_name="item extra", item_category=self.items[0].item_category, price=10.0,
+                                    item_image='items_images/sample.jpg', labels='P', slug='item-extra')
+        # The count cached before the new item still says 20, the last page is sliced by page size anyway
+        paginator = KeysetPaginator(Item.objects.order_by('id'), 8)
+        self.assertEqual(paginator.count, 20)
+        self.assertEqual(list(paginator.page(3))[-1], extra)
+
+    def test_empty_result_set_counts_nothing(self):
+        paginator = KeysetPaginator(Item.objects.none().order_by('id'), 8)
+        self.assertEqual(paginator.count, 0)
+        self.assertEqual(list(paginator.page(1)), [])
+
+    def test_page_strip_is_windowed(self):
+        self.assertEqual(list(paginate(3)), [1, 2, 3])
+        self.assertEqual(paginate(1000, 500), [1, None, 497, 498, 499, 500, 501, 502, 503, None, 1000])
+        self.assertEqual(paginate(6, 2), [1, 2, 3, 4, 5, 6])
+
+
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        clothes = Category.objects.create(category='Clothes')
+        gadgets = Category.objects.create(category='Gadgets')
+        cls.shirt = cls.create_item('Red cotton shirt', clothes, 'red-shirt')
+        cls.jacket = cls.create_item('Shirt jacket', clothes, 'shirt-jacket')
+        cls.speaker = cls.create_item('Wireless speaker', gadgets, 'speaker')
+
+    @staticmethod
+    def create_item(name, category, slug):
+        return Item.objects.create(item_name=name, item_category=category, price=10, slug=slug,
+                                   item_image='items_images/sample.jpg', labels='P', description='')
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self, key):
+        response = self.client.get(reverse('core:item_list'), {'key': key})
+        return [item.slug for item in response.context['object_list']]
+
+    def test_sqlite_uses_the_full_text_index(self):
+        self.assertIsInstance(get_search_backend(), SQLiteFTSSearchBackend)
+
+    def test_matches_name_and_category_prefixes(self):
+        self.assertEqual(set(self.search('shirt')), {'red-shirt', 'shirt-jacket'})
+        self.assertEqual(self.search('wire'), ['speaker'])
+        self.assertEqual(set(self.search('cloth')), {'red-shirt', 'shirt-jacket'})
+        self.assertEqual(self.search('cotton shirt'), ['red-shirt'])
+        self.assertEqual(self.search('"*'), [])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.speaker.item_name = 'Bluetooth speaker'
+        self.speaker.save()
+        self.assertEqual(self.search('bluetooth'), ['speaker'])
+        self.assertEqual(self.search('wireless'), [])
+
+        category = self.speaker.item_category
+        category.category = 'Electronics'
+        category.save()
+        self.assertEqual(self.search('electronics'), ['speaker'])
+
+        self.speaker.delete()
+        self.assertEqual(self.search('speaker'), [])
+
+    def test_rebuild_command(self):
+        Item.objects.filter(pk=self.shirt.pk).update(item_name='Blue linen shirt')
+        self.assertEqual(self.search('linen'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('rebuild_search_index', '--optimize', stdout=StringIO())
+        self.assertEqual(self.search('linen'), ['red-shirt'])
+
+    def test_failed_rebuild_keeps_the_index(self):
+        def fail_refill(execute, sql, params, many, context):
+            if sql.startswith('INSERT INTO core_item_fts'):
+                raise DatabaseError("disk I/O error")
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(fail_refill), self.assertRaises(DatabaseError):
+            get_search_backend().rebuild()
+        self.assertEqual(self.search('wire'), ['speaker'])
+
+
+class CartPricingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=1, items_per_category=6, comments_per_item=0)
+        # A discount price of 0 counts as no discount, just like OrderItem.get_final_price
+        Item.objects.filter(pk=cls.items[0].pk).update(discount_price=0)
+        cls.user = User.objects.create_user(username='shopper', password='password')
+        cls.coupon = Coupon.objects.create(coupon='Django', amount=5)
+        cls.cart = seed_cart(cls.user, cls.items, coupon=cls.coupon)
+
+    def test_totals_match_per_line_prices(self):
+        lines = list(self.cart.items.all())
+        expected = sum(line.get_final_price() for line in lines) - self.coupon.amount
+        with self.assertNumQueries(1):
+            cart = Cart.objects.with_totals().get(pk=self.cart.pk)
+        self.assertEqual(cart.line_count, len(lines))
+        self.assertAlmostEqual(cart.final_total, expected)
+        self.assertAlmostEqual(cart.subtotal, expected + self.coupon.amount)
+        self.assertAlmostEqual(Cart.objects.get(pk=self.cart.pk).get_total(), expected)
+
+    def test_line_prices(self):
+        with self.assertNumQueries(1):
+            lines = list(self.cart.items.with_prices())
+            for line in lines:
+                self.assertAlmostEqual(line.line_total, line.get_final_price())
+                self.assertAlmostEqual(line.unit_price, line.get_final_price() / line.quantity)
+
+    def test_empty_cart_total(self):
+        other = User.objects.create_user(username='browser', password='password')
+        cart = Cart.objects.create(user=other, ordered_date=timezone.now())
+        cart = Cart.objects.with_totals().get(pk=cart.pk)
+        self.assertEqual(cart.line_count, 0)
+        self.assertEqual(cart.final_total, 0)
+
+    def test_cart_pages_do_not_grow_with_the_cart(self):
+        self.client.force_login(self.user)
+        counts = []
+        for size in (1, len(self.items)):
+            self.cart.items.set(self.cart.items.order_by('pk')[:size])
+            for route in ('core:order_summary', 'core:checkout'):
+                with CaptureQueriesContext(connection) as queries:
+                    self.client.get(reverse(route))
+                counts.append((route, len(queries)))
+        self.assertEqual(counts[:2], counts[2:])
+
+
+class CartServiceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=1, items_per_category=6, comments_per_item=0)
+        cls.user = User.objects.create_user(username='shopper', password='password')
+
+    def quantities(self):
+        cart = cart_service.get_open_cart(self.user)
+        return dict(cart.items.values_list('item_id', 'quantity')) if cart else None
+
+    def test_add_item(self):
+        item = self.items[0]
+        self.assertEqual(cart_service.add_item(self.user, item), cart_service.ADDED)
+        self.assertEqual(cart_service.add_item(self.user, item), cart_service.UPDATED)
+        self.assertEqual(cart_service.add_item(self.user, self.items[1]), cart_service.ADDED)
+        self.assertEqual(self.quantities(), {item.pk: 2, self.items[1].pk: 1})
+        self.assertEqual(Cart.objects.filter(user=self.user).count(), 1)
+
+    def test_adding_to_an_existing_line_is_one_update(self):
+        cart_service.add_item(self.user, self.items[0])
+        # Just the quantity bump, plus the savepoint around it
+        with self.assertNumQueries(3):
+            cart_service.add_item(self.user, self.items[0])
+
+    def test_remove_single_item(self):
+        item = self.items[0]
+        self.assertEqual(cart_service.remove_single_item(self.user, item), cart_service.NO_CART)
+        cart_service.set_quantities(self.user, {item: 2})
+        self.assertEqual(cart_service.remove_single_item(self.user, item), cart_service.UPDATED)
+        self.assertEqual(self.quantities(), {item.pk: 1})
+        self.assertEqual(cart_service.remove_single_item(self.user, item), cart_service.REMOVED)
+        self.assertEqual(self.quantities(), {})
+        self.assertFalse(OrderItem.objects.exists())
+        self.assertEqual(cart_service.remove_single_item(self.user, item), cart_service.NOT_IN_CART)
+
+    def test_remove_item(self):
+        item = self.items[0]
+        self.assertEqual(cart_service.remove_item(self.user, item), cart_service.NO_CART)
+        cart_service.set_quantities(self.user, {item: 3, self.items[1]: 1})
+        self.assertEqual(cart_service.remove_item(self.user, item), cart_service.REMOVED)
+        self.assertEqual(self.quantities(), {self.items[1].pk: 1})
+        self.assertEqual(cart_service.remove_item(self.user, item), cart_service.NOT_IN_CART)
+
+    def test_set_quantities(self):
+        cart_service.set_quantities(self.user, {self.items[0]: 1, self.items[1]: 2})
+        cart_service.set_quantities(self.user, {self.items[0]: 0, self.items[1]: 5, self.items[2].pk: 3})
+        self.assertEqual(self.quantities(), {self.items[1].pk: 5, self.items[2].pk: 3})
+
+    def test_removals_alone_create_no_cart(self):
+        self.assertIsNone(cart_service.set_quantities(self.user, {self.items[0]: 0, self.items[1]: -1}))
+        self.assertFalse(Cart.objects.filter(user=self.user).exists())
+
+    def test_set_quantities_runs_a_fixed_number_of_queries(self):
+        cart_service.set_quantities(self.user, {item: 1 for item in self.items})
+        counts = []
+        for items in (self.items[:3], self.items):
+            # Drop one line and change the others, for a small and a big batch
+            quantities = {item: 2 for item in items[1:]}
+            quantities[items[0]] = 0
+            with CaptureQueriesContext(connection) as queries:
+                cart_service.set_quantities(self.user, quantities)
+            counts.append(len(queries))
+            cart_service.set_quantities(self.user, {item: 1 for item in self.items})
+        self.assertEqual(counts[0], counts[1])
+
+
+class FinalizeOrderTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=1, items_per_category=8, comments_per_item=0)
+        cls.user = User.objects.create_user(username='shopper', password='password')
+
+    def test_finalize_order(self):
+        cart = seed_cart(self.user, self.items[:3])
+        # A stray line outside the cart stays as it is
+        stray = OrderItem.objects.create(user=self.user, item=self.items[4])
+        total = int(cart.get_total())
+        order = cart_service.finalize_order(self.user, 'ch_1', 'S', 'ref1')
+        self.assertEqual(order.pk, cart.pk)
+        order.refresh_from_db()
+        self.assertTrue(order.ordered)
+        self.assertEqual(order.reference_code, 'ref1')
+        self.assertEqual(order.payment.stripe_charge_id, 'ch_1')
+        self.assertEqual(order.payment.amount, total)
+        self.assertFalse(order.items.filter(ordered=False).exists())
+        stray.refresh_from_db()
+        self.assertFalse(stray.ordered)
+
+    def test_replayed_transaction_is_a_no_op(self):
+        cart = seed_cart(self.user, self.items[:3])
+        cart_service.finalize_order(self.user, 'ch_1', 'S', 'ref1')
+        # The next cart is untouched by a replay of the first payment
+        seed_cart(self.user, self.items[3:5])
+        order = cart_service.finalize_order(self.user, 'ch_1', 'S', 'ref2')
+        self.assertEqual(order.pk, cart.pk)
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(Cart.objects.get(pk=cart.pk).reference_code, 'ref1')
+        self.assertEqual(Cart.objects.filter(user=self.user, ordered=False).count(), 1)
+
+    def test_lines_and_total_are_snapshotted(self):
+        cart = seed_cart(self.user, self.items[:3], coupon=Coupon.objects.create(coupon='Django', amount=5))
+        expected = {line.item.item_name: (line.quantity, line.get_final_price()) for line in cart.items.all()}
+        total = cart.get_total()
+        order = cart_service.finalize_order(self.user, 'ch_1', 'S', 'ref1')
+        # Catalog changes after the purchase leave the order as it was paid
+        Item.objects.update(price=1000, discount_price=None, item_name='Renamed')
+        order = Cart.objects.get(pk=order.pk)
+        self.assertEqual(order.total, total)
+        self.assertEqual(order.get_total(), total)
+        lines = {line.item_name: (line.quantity, line.line_total) for line in order.lines.all()}
+        self.assertEqual(lines, expected)
+
+    def test_history_reads_no_items(self):
+        for n in range(3):
+            seed_cart(self.user, self.items[n:n + 3])
+            cart_service.finalize_order(self.user, f'ch_{n}', 'S', f'ref{n}')
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('core:customer_profile'))
+        self.assertContains(response, str(OrderLine.objects.first()))
+        self.assertFalse([query for query in queries if 'core_item' in query['sql']])
+
+    def test_no_open_cart(self):
+        self.assertIsNone(cart_service.finalize_order(self.user, 'ch_1', 'S', 'ref1'))
+        self.assertFalse(Payment.objects.exists())
+
+    def test_queries_do_not_grow_with_the_cart(self):
+        counts = []
+        for n, size in enumerate((1, len(self.items))):
+            seed_cart(self.user, self.items[:size])
+            with CaptureQueriesContext(connection) as queries:
+                cart_service.finalize_order(self.user, f'ch_{n}', 'S', f'ref{n}')
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_complete_payment_replay(self):
+        seed_cart(self.user, self.items[:3])
+        self.client.force_login(self.user)
+        path = reverse('core:complete_payment', kwargs={'tran_id': 'ch_1', 'payment_type': 'S'})
+        self.assertEqual(self.client.get(path).status_code, 302)
+        self.assertEqual(self.client.get(path).status_code, 302)
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(Cart.objects.filter(user=self.user, ordered=True).count(), 1)
+
+
+class OrderHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=1, items_per_category=4, comments_per_item=0)
+        cls.user = User.objects.create_user(username='shopper', password='password')
+        now = timezone.now()
+        cls.orders = []
+        for n in range(25):
+            order = seed_cart(cls.user, cls.items[:n % 4 + 1], ordered=True)
+            order.ordered_date = now - timezone.timedelta(days=n)
+            order.reference_code = f"reference{n}"
+            order.received = n % 2 == 0
+            order.refund_requested = n % 5 == 0
+            order.save()
+            cls.orders.append(order)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def history(self, **params):
+        response = self.client.get(reverse('core:customer_profile'), params)
+        self.assertEqual(response.status_code, 200)
+        return [order.reference_code for order in response.context['orders']]
+
+    def test_newest_first_a_page_at_a_time(self):
+        self.assertEqual(self.history(), [f"reference{n}" for n in range(10)])
+        self.assertEqual(self.history(page=3), [f"reference{n}" for n in range(20, 25)])
+
+    def test_queries_do_not_grow_with_the_history(self):
+        counts = []
+        for size in (25, 1):
+            Cart.objects.filter(pk__in=[order.pk for order in self.orders[size:]]).delete()
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(reverse('core:customer_profile'))
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_filter_by_status(self):
+        self.assertEqual(self.history(status='refund_requested'), [f"reference{n}" for n in range(0, 25, 5)])
+        self.assertEqual(len(self.history(status='received')), 10)
+        response = self.client.get(reverse('core:customer_profile'), {'status': 'received', 'page': 2})
+        self.assertContains(response, 'href="?page=1&status=received"')
+
+    def test_filter_by_date(self):
+        today = timezone.now().date()
+        params = {'date_from': today - timezone.timedelta(days=3), 'date_to': today - timezone.timedelta(days=1)}
+        self.assertEqual(self.history(**params), ['reference1', 'reference2', 'reference3'])
+
+    def test_filters_without_a_match(self):
+        self.assertEqual(self.history(status='refund_granted'), [])
+
+    def test_no_orders_redirects(self):
+        Cart.objects.filter(user=self.user).delete()
+        self.assertRedirects(self.client.get(reverse('core:customer_profile')), '/', fetch_redirect_response=False)
+
+
+class CartCountCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=1, items_per_category=4, comments_per_item=0)
+        cls.user = User.objects.create_user(username='shopper', password='password')
+
+    def setUp(self):
+        cache.clear()
+
+    def count(self):
+        # A fresh user object, the way every request gets one
+        return get_cart_count(User.objects.get(pk=self.user.pk))
+
+    def test_cache_hits_run_no_queries(self):
+        seed_cart(self.user, self.items[:3])
+        with self.assertNumQueries(1):
+            self.assertEqual(get_cart_count(self.user), 3)
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cart_count(user), 3)
+            self.assertEqual(get_cart_count(user), 3)
+
+    def test_cart_mutations_invalidate(self):
+        self.assertEqual(self.count(), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            cart_service.add_item(self.user, self.items[0])
+        self.assertEqual(self.count(), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            cart_service.set_quantities(self.user, {self.items[1]: 2, self.items[2]: 1})
+        self.assertEqual(self.count(), 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            cart_service.remove_item(self.user, self.items[1])
+        self.assertEqual(self.count(), 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            cart_service.finalize_order(self.user, 'ch_1', 'S', 'ref1')
+        self.assertEqual(self.count(), 0)
+
+    def test_uncommitted_changes_are_not_seen(self):
+        self.assertEqual(self.count(), 0)
+        with self.captureOnCommitCallbacks(execute=False):
+            cart_service.add_item(self.user, self.items[0])
+        # The count is only dropped once the change commits
+        self.assertEqual(self.count(), 0)
+
+    def test_count_taken_before_a_change_is_not_kept(self):
+        count = QuerySet.count
+
+        def count_then_add(queryset):
+            result = count(queryset)
+            # Another request adds to the cart and commits between the count and the cache fill
+            with mock.patch.object(QuerySet, 'count', count), self.captureOnCommitCallbacks(execute=True):
+                cart_service.add_item(self.user, self.items[0])
+            return result
+
+        with mock.patch.object(QuerySet, 'count', count_then_add):
+            self.assertEqual(self.count(), 0)
+        self.assertEqual(self.count(), 1)
+
+    def test_navbar_badge(self):
+        seed_cart(self.user, self.items[:2])
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('core:item_list'))
+        self.assertContains(response, 'href="/order_summary/">2')
+
+
+class CatalogFragmentCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=2, items_per_category=10, comments_per_item=0)
+
+    def setUp(self):
+        cache.clear()
+
+    def catalog_queries(self, path):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return response, [query['sql'] for query in queries if 'core_item' in query['sql']
+                          or 'core_category' in query['sql']]
+
+    def test_warm_listing_runs_no_catalog_queries(self):
+        path = reverse('core:item_list')
+        _, cold = self.catalog_queries(path)
+        self.assertTrue(cold)
+        response, warm = self.catalog_queries(path)
+        self.assertEqual(warm, [])
+        self.assertContains(response, self.items[0].item_name)
+        self.assertContains(response, self.items[0].item_category.category)
+
+    def test_pages_are_cached_separately(self):
+        first, _ = self.catalog_queries(reverse('core:item_list'))
+        second, _ = self.catalog_queries(reverse('core:item_list') + '?page=2')
+        self.assertNotEqual(first.content, second.content)
+        self.assertContains(second, self.items[8].item_name)
+
+    def test_item_changes_bump_the_version(self):
+        path = reverse('core:item_list')
+        self.catalog_queries(path)
+        with self.captureOnCommitCallbacks(execute=True):
+            item = Item.objects.get(pk=self.items[0].pk)
+            item.item_name = 'Renamed item'
+            item.save()
+        response, queries = self.catalog_queries(path)
+        self.assertTrue(queries)
+        self.assertContains(response, 'Renamed item')
+
+    def test_new_items_are_counted_right_away(self):
+        path = reverse('core:item_list')
+        response, _ = self.catalog_queries(path)
+        self.assertEqual(response.context['paginator'].count, 20)
+        with self.captureOnCommitCallbacks(execute=True):
+            Item.objects.create(item_name='New item', item_category=self.items[0].item_category, price=1,
+                                item_image='items_images/sample.jpg', labels='P', slug='new-item',
+                                description='New')
+        response, _ = self.catalog_queries(path)
+        self.assertEqual(response.context['paginator'].count, 21)
+
+    def test_category_changes_refresh_the_sidebar(self):
+        path = reverse('core:item_list')
+        self.catalog_queries(path)
+        category = self.items[0].item_category
+        with self.captureOnCommitCallbacks(execute=True):
+            category.category = 'Renamed'
+            category.save()
+        response, _ = self.catalog_queries(path)
+        self.assertContains(response, '>Renamed</a>')
+
+
+class AnonymousPageCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=2, items_per_category=3, comments_per_item=2)
+        cls.user = User.objects.create_user(username='shopper', password='password')
+
+    def setUp(self):
+        cache.clear()
+
+    def product_path(self):
+        return reverse('core:products', kwargs={'slug': self.items[0].slug})
+
+    def test_pages_carry_validators(self):
+        for path in (reverse('core:item_list'), reverse('core:item_list_by_category', kwargs={
+                'category_name': self.items[0].item_category.category}), self.product_path()):
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response['ETag'].startswith('"'))
+            self.assertIn('Last-Modified', response)
+            self.assertIn('Cookie', response['Vary'])
+
+    def test_cached_page_runs_no_queries(self):
+        first = self.client.get(self.product_path())
+        with self.assertNumQueries(0):
+            second = self.client.get(self.product_path())
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first['ETag'], second['ETag'])
+
+    def test_if_none_match_gets_a_304(self):
+        etag = self.client.get(reverse('core:item_list'))['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('core:item_list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get(reverse('core:item_list'), HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_if_modified_since_gets_a_304(self):
+        last_modified = self.client.get(reverse('core:item_list'))['Last-Modified']
+        response = self.client.get(reverse('core:item_list'), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_logged_in_pages_are_not_cached(self):
+        self.client.force_login(self.user)
+        response = self.client.get(self.product_path())
+        self.assertNotIn('ETag', response)
+        self.assertIn('Cookie', response['Vary'])
+        self.assertContains(response, 'Write A Comment')
+        # Nothing was stored for the next anonymous visitor either
+        self.client.logout()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertNotContains(self.client.get(self.product_path()), 'Write A Comment')
+        self.assertTrue(queries)
+
+    def test_comments_and_likes_change_the_product_page(self):
+        etag = self.client.get(self.product_path())['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(user=self.user, item=self.items[0], comment='Brand new comment')
+        response = self.client.get(self.product_path(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Brand new comment')
+        etag = response['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.items[0].likes.add(self.user)
+        self.assertNotEqual(self.client.get(self.product_path())['ETag'], etag)
+
+    def test_other_products_stay_cached(self):
+        other = reverse('core:products', kwargs={'slug': self.items[1].slug})
+        etag = self.client.get(other)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(user=self.user, item=self.items[0], comment='Brand new comment')
+        self.assertEqual(self.client.get(other, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_catalog_changes_change_the_listing(self):
+        etag = self.client.get(reverse('core:item_list'))['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Item.objects.get(pk=self.items[0].pk).save()
+        self.assertNotEqual(self.client.get(reverse('core:item_list'))['ETag'], etag)
+
+
+class ObjectCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=1, items_per_category=4, comments_per_item=0)
+        cls.user = User.objects.create_user(username='shopper', password='password')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_get_cached(self):
+        item = self.items[0]
+        with self.assertNumQueries(1):
+            self.assertEqual(Item.objects.get_cached(slug=item.slug), item)
+        with self.assertNumQueries(0):
+            self.assertEqual(Item.objects.get_cached(slug=item.slug).item_name, item.item_name)
+            self.assertEqual(Item.objects.get_cached(pk=item.pk), item)
+        category = item.item_category
+        Category.objects.get_cached(pk=category.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(Category.objects.get_cached(pk=category.pk).category, category.category)
+
+    def test_missing_rows_raise(self):
+        with self.assertRaises(Item.DoesNotExist):
+            Item.objects.get_cached(slug='missing')
+        with self.assertRaises(ValueError):
+            Item.objects.get_cached(item_name='Item')
+
+    def test_get_many(self):
+        pks = [item.pk for item in self.items]
+        Item.objects.get_cached(pk=pks[0])
+        with self.assertNumQueries(1):
+            items = Item.objects.get_many(pks)
+        self.assertEqual(set(items), set(pks))
+        with self.assertNumQueries(0):
+            self.assertEqual(Item.objects.get_many(pks)[pks[1]].slug, self.items[1].slug)
+
+    def test_stats(self):
+        before = Item.objects.cache_stats()
+        Item.objects.get_cached(slug=self.items[0].slug)
+        Item.objects.get_cached(slug=self.items[0].slug)
+        after = Item.objects.cache_stats()
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['misses'] - before['misses'], 1)
+
+    def test_save_and_delete_invalidate(self):
+        item = Item.objects.get_cached(slug=self.items[0].slug)
+        old_slug = item.slug
+        with self.captureOnCommitCallbacks(execute=True):
+            item.item_name = 'Renamed'
+            item.slug = 'renamed'
+            item.save()
+        self.assertEqual(Item.objects.get_cached(pk=item.pk).item_name, 'Renamed')
+        self.assertEqual(Item.objects.get_cached(slug='renamed').pk, item.pk)
+        with self.assertRaises(Item.DoesNotExist):
+            Item.objects.get_cached(slug=old_slug)
+        with self.captureOnCommitCallbacks(execute=True):
+            item.delete()
+        with self.assertRaises(Item.DoesNotExist):
+            Item.objects.get_cached(slug='renamed')
+
+    def test_cart_views_use_the_cache(self):
+        self.client.force_login(self.user)
+        path = reverse('core:add_to_cart', kwargs={'slug': self.items[0].slug})
+        self.client.get(path)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(path)
+        self.assertFalse([query for query in queries if 'FROM "core_item"' in query['sql']])
+        response = self.client.get(reverse('core:add_to_cart', kwargs={'slug': 'missing'}))
+        self.assertEqual(response.status_code, 404)
+
+
+class LikeCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=1, items_per_category=3, comments_per_item=0)
+        cls.users = [User.objects.create_user(username=f'fan{n}', password='password') for n in range(3)]
+
+    def setUp(self):
+        cache.clear()
+
+    def like_count(self, item):
+        return Item.objects.get(pk=item.pk).like_count
+
+    def test_toggle_like(self):
+        item = self.items[0]
+        self.assertTrue(item.toggle_like(self.users[0]))
+        self.assertTrue(item.toggle_like(self.users[1]))
+        self.assertEqual(self.like_count(item), 2)
+        self.assertTrue(item.is_liked_by(self.users[0]))
+        self.assertFalse(item.toggle_like(self.users[0]))
+        self.assertFalse(item.is_liked_by(self.users[0]))
+        self.assertEqual(self.like_count(item), 1)
+        self.assertEqual(self.like_count(item), item.likes.count())
+
+    def test_product_page_does_not_count_likes(self):
+        item = self.items[0]
+        for user in self.users:
+            item.toggle_like(user)
+        self.client.force_login(self.users[0])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('core:products', kwargs={'slug': item.slug}))
+        self.assertContains(response, '<i class="fas fa-heart mr-1">  3</i>', html=False)
+        self.assertFalse([query for query in queries if 'COUNT' in query['sql'] and 'likes' in query['sql']])
+        self.client.force_login(self.users[1])
+        with self.captureOnCommitCallbacks(execute=True):
+            item.toggle_like(self.users[1])
+        response = self.client.get(reverse('core:products', kwargs={'slug': item.slug}))
+        self.assertContains(response, '<i class="far fa-heart mr-1">  2</i>', html=False)
+
+    def test_likes_changed_through_the_m2m_are_counted(self):
+        item = self.items[0]
+        item.likes.add(*self.users)
+        self.assertEqual(self.like_count(item), 3)
+        item.likes.remove(self.users[0])
+        self.assertEqual(self.like_count(item), 2)
+        self.users[1].item_set.clear()
+        self.assertEqual(self.like_count(item), 1)
+        self.users[1].item_set.add(item, self.items[1])
+        self.assertEqual((self.like_count(item), self.like_count(self.items[1])), (2, 1))
+
+    def test_unlike_with_a_count_that_drifted(self):
+        item = self.items[0]
+        item.likes.add(self.users[0])
+        Item.objects.filter(pk=item.pk).update(like_count=0)
+        self.assertFalse(item.toggle_like(self.users[0]))
+        self.assertFalse(item.is_liked_by(self.users[0]))
+        self.assertEqual(self.like_count(item), 0)
+
+    def test_like_already_there(self):
+        item = self.items[0]
+        item.toggle_like(self.users[0])
+        # The like a concurrent click made lands between the delete and the insert
+        with mock.patch.object(QuerySet, 'delete', return_value=(0, {})):
+            self.assertTrue(item.toggle_like(self.users[0]))
+        self.assertEqual(self.like_count(item), 1)
+
+    def test_likes_view(self):
+        item = self.items[0]
+        self.client.force_login(self.users[0])
+        path = reverse('core:likes', kwargs={'slug': item.slug})
+        self.client.get(path)
+        self.assertEqual(self.like_count(item), 1)
+        self.client.get(path)
+        self.assertEqual(self.like_count(item), 0)
+
+    def test_reconcile_like_counts(self):
+        item = self.items[1]
+        for user in self.users:
+            item.toggle_like(user)
+        Item.objects.filter(pk=item.pk).update(like_count=10)
+        Item.objects.filter(pk=self.items[2].pk).update(like_count=4)
+        out = StringIO()
+        call_command('reconcile_like_counts', batch_size=2, stdout=out)
+        self.assertEqual(self.like_count(item), 3)
+        self.assertEqual(self.like_count(self.items[2]), 0)
+        self.assertEqual(self.like_count(self.items[0]), 0)
+        self.assertIn('Checked 3 items, repaired 2', out.getvalue())
+
+
+class CommentStreamTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.item, cls.quiet_item = seed_catalog(categories=1, items_per_category=2, comments_per_item=0)
+        cls.user = User.objects.create_user(username='reader', password='password')
+        cls.comments = [
+            Comment.objects.create(user=cls.user, item=cls.item, comment=f"remark {n}") for n in range(25)
+        ]
+
+    def setUp(self):
+        cache.clear()
+
+    def test_stream_batches(self):
+        stream = KeysetStream(Comment.objects.filter(item=self.item), 10, 'date')
+        seen, cursor = [], None
+        while True:
+            rows, cursor = stream.batch(cursor)
+            seen.extend(comment.pk for comment in rows)
+            if cursor is None:
+                break
+        self.assertEqual(seen, [comment.pk for comment in reversed(self.comments)])
+
+    def test_stream_rejects_tampered_cursor(self):
+        stream = KeysetStream(Comment.objects.filter(item=self.item), 10, 'date')
+        _, cursor = stream.batch()
+        with self.assertRaises(InvalidPage):
+            stream.batch(cursor + 'x')
+
+    def test_product_page_shows_newest_comments_first(self):
+        response = self.client.get(reverse('core:products', kwargs={'slug': self.item.slug}))
+        self.assertEqual([comment.pk for comment in response.context['comments']],
+                         [comment.pk for comment in reversed(self.comments[5:])])
+        self.assertContains(response, 'Total Comments 25')
+        self.assertContains(response, reverse('core:item_comments', kwargs={'slug': self.item.slug}))
+
+    def test_load_more(self):
+        response = self.client.get(reverse('core:products', kwargs={'slug': self.item.slug}))
+        path = reverse('core:item_comments', kwargs={'slug': self.item.slug})
+        response = self.client.get(path, {'cursor': response.context['next_cursor']})
+        self.assertEqual([comment.pk for comment in response.context['comments']],
+                         [comment.pk for comment in reversed(self.comments[:5])])
+        self.assertIsNone(response.context['next_cursor'])
+        self.assertNotContains(response, 'Load more comments')
+        self.assertEqual(self.client.get(path, {'cursor': 'bogus'}).status_code, 404)
+
+    def test_product_page_queries_do_not_grow_with_comments(self):
+        path = reverse('core:products', kwargs={'slug': self.quiet_item.slug})
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(path)
+        for n in range(30):
+            Comment.objects.create(user=User.objects.create_user(username=f'guest{n}'), item=self.quiet_item,
+                                   comment="Another one")
+        cache.clear()
+        with CaptureQueriesContext(connection) as after:
+            response = self.client.get(path)
+        self.assertEqual(len(response.context['comments']), 20)
+        self.assertEqual(len(after), len(before))
+
+    def test_comment_count_follows_comments(self):
+        self.assertEqual(Item.objects.get(pk=self.item.pk).comment_count, 25)
+        self.client.force_login(self.user)
+        self.client.post(reverse('core:comments', kwargs={'slug': self.quiet_item.slug}), {'comment': 'First'})
+        self.assertEqual(Item.objects.get(pk=self.quiet_item.pk).comment_count, 1)
+        self.comments[0].delete()
+        self.assertEqual(Item.objects.get(pk=self.item.pk).comment_count, 24)
+
+
+class InlineExecutor:
+    """
+    Runs submitted work straight away, so the upload path can be followed without a process pool
+    """
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+class ThreadExecutor:
+    """
+    Runs submitted work on a thread of its own, the way the pool's result thread runs the callbacks
+    """
+    def __init__(self):
+        self.connection_left_open = None
+
+    def submit(self, fn, *args):
+        future = Future()
+
+        def run():
+            future.set_result(fn(*args))
+            self.connection_left_open = connection.connection is not None
+
+        self.thread = threading.Thread(target=run)
+        self.thread.start()
+        return future
+
+
+class ImageDerivativeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=1, items_per_category=3, comments_per_item=0)
+
+    def setUp(self):
+        cache.clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = self.settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        os.makedirs(os.path.join(media_root, 'items_images'))
+        self.source = os.path.join(media_root, 'items_images', 'sample.jpg')
+        PILImage.new('RGB', (1200, 800), 'red').save(self.source)
+
+    def test_render_derivatives(self):
+        digest = images.render_derivatives(self.source, settings.MEDIA_ROOT)
+        with open(self.source, 'rb') as f:
+            self.assertEqual(digest, images.image_digest(f.read()))
+        for variant, sizes in images.VARIANTS.items():
+            for width, height in sizes:
+                for ext, *_ in images.FORMATS:
+                    path = os.path.join(settings.MEDIA_ROOT, images.derivative_name(digest, variant, width, ext))
+                    with PILImage.open(path) as derivative:
+                        self.assertEqual(derivative.size, (width, height or width * 2 // 3))
+        card = os.path.join(settings.MEDIA_ROOT, images.derivative_name(digest, 'card', 240, 'webp'))
+        rendered_at = os.stat(card).st_mtime_ns
+        self.assertEqual(images.render_derivatives(self.source, settings.MEDIA_ROOT), digest)
+        self.assertEqual(os.stat(card).st_mtime_ns, rendered_at)
+
+    def test_pages_fall_back_to_original(self):
+        response = self.client.get(reverse('core:item_list'))
+        self.assertContains(response, 'src="/media/items_images/sample.jpg"')
+        self.assertNotContains(response, '<picture>')
+
+    def test_build_image_derivatives(self):
+        Item.objects.filter(pk=self.items[2].pk).update(item_image='items_images/gone.jpg')
+        out, err = StringIO(), StringIO()
+        call_command('build_image_derivatives', workers=2, batch_size=2, stdout=out, stderr=err)
+        self.assertIn('Rendered 1 images for 3 items, updated 2, 1 missing', out.getvalue())
+        self.assertIn('items_images/gone.jpg: file not found', err.getvalue())
+        digest = Item.objects.get(pk=self.items[0].pk).image_hash
+        self.assertTrue(digest)
+        self.assertEqual(Item.objects.get(pk=self.items[1].pk).image_hash, digest)
+        self.assertEqual(Item.objects.get(pk=self.items[2].pk).image_hash, '')
+        response = self.client.get(reverse('core:item_list'))
+        self.assertContains(response, f'srcset="{images.srcset(digest, "card", "webp")}"')
+        self.assertContains(response, images.derivative_url(digest, 'card', 240, 'jpg'))
+        response = self.client.get(reverse('core:products', kwargs={'slug': self.items[0].slug}))
+        self.assertContains(response, images.srcset(digest, 'detail', 'webp'))
+
+    def test_upload_renders_derivatives(self):
+        with open(self.source, 'rb') as f:
+            upload = SimpleUploadedFile('new.jpg', f.read(), content_type='image/jpeg')
+        item = self.items[0]
+        item.item_image = upload
+        with mock.patch('core.images.get_executor', return_value=InlineExecutor()):
+            with self.captureOnCommitCallbacks(execute=True):
+                item.save()
+        item.refresh_from_db()
+        with open(item.item_image.path, 'rb') as f:
+            self.assertEqual(item.image_hash, images.image_digest(f.read()))
+        self.assertTrue(os.path.exists(os.path.join(
+            settings.MEDIA_ROOT, images.derivative_name(item.image_hash, 'card', 480, 'webp'))))
+        # Saving without a new upload renders nothing
+        with mock.patch('core.images.get_executor') as get_executor:
+            with self.captureOnCommitCallbacks(execute=True):
+                item.save()
+        get_executor.assert_not_called()
+
+    def test_callback_thread_closes_its_connection(self):
+        with open(self.source, 'rb') as f:
+            self.items[1].item_image = SimpleUploadedFile('other.jpg', f.read(), content_type='image/jpeg')
+        executor = ThreadExecutor()
+        with mock.patch('core.images.get_executor', return_value=executor):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.items[1].save()
+        executor.thread.join()
+        self.assertIs(executor.connection_left_open, False)
+
+
+class QueryPlanTests(TestCase):
+    """
+    The hot lookups of the views must be served by an index, checked with EXPLAIN QUERY PLAN
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='planner', password='password')
+        cls.item = seed_catalog(categories=1, items_per_category=1, comments_per_item=0)[0]
+
+    def assertPlanUses(self, queryset, index):
+        plan = queryset.explain()
+        self.assertNotRegex(plan, r'\bSCAN\b', f"table scan in:\n{plan}")
+        self.assertNotIn('TEMP B-TREE', plan, f"sort without an index in:\n{plan}")
+        # Prefix match, SQLite and Django suffix the names of the indexes they create
+        self.assertIn(f'INDEX {index}', plan)
+
+    def test_open_cart(self):
+        self.assertPlanUses(Cart.objects.filter(user=self.user, ordered=False), 'one_open_cart_per_user')
+
+    def test_open_cart_lines(self):
+        self.assertPlanUses(OrderItem.objects.filter(cart__user=self.user, cart__ordered=False, item=self.item),
+                            'one_open_cart_per_user')
+
+    def test_order_history(self):
+        orders = Cart.objects.filter(user=self.user, ordered=True).order_by('-ordered_date', '-id')
+        self.assertPlanUses(orders, 'cart_order_history_idx')
+
+    def test_order_by_reference_code(self):
+        self.assertPlanUses(Cart.objects.filter(reference_code='ABC123'), 'sqlite_autoindex_core_cart')
+        self.assertPlanUses(Cart.objects.filter(user=self.user, ordered=True, reference_code='ABC123'),
+                            'sqlite_autoindex_core_cart')
+
+    def test_default_address(self):
+        self.assertPlanUses(Address.objects.filter(user=self.user, address_type='S', is_default=True),
+                            'address_default_idx')
+
+    def test_refund_by_reference_code(self):
+        self.assertPlanUses(Refund.objects.filter(reference_code='ABC123'), 'core_refund_reference_code')
+
+    def test_coupon_by_code(self):
+        self.assertPlanUses(Coupon.objects.filter(coupon='SAVE10'), 'sqlite_autoindex_core_coupon')
+
+    def test_coupon_code_is_unique(self):
+        Coupon.objects.create(coupon='SAVE10', amount=10)
+        with self.assertRaises(IntegrityError):
+            Coupon.objects.create(coupon='SAVE10', amount=20)
+
+
+class AdminChangelistTests(TestCase):
+    """
+    The order admin changelists must cost the same number of queries whatever the page size
+    """
+    changelists = ['cart', 'orderitem', 'refund', 'comment', 'payment']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=1, items_per_category=3, comments_per_item=1)
+        cls.admin = User.objects.create_superuser(username='admin', password='password')
+        cls.coupon = Coupon.objects.create(coupon='Django', amount=5)
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def add_orders(self, count):
+        for n in range(Cart.objects.count() + 1, Cart.objects.count() + count + 1):
+            user = User.objects.create_user(username=f"customer{n}")
+            address = Address.objects.create(user=user, street_address='1 Road', apartment_address='2',
+                                              country='BD', zip_code='1000', address_type='B')
+            order = seed_cart(user, self.items[:2], ordered=True, coupon=self.coupon)
+            order.billing_address = order.shipping_address = address
+            order.payment = Payment.objects.create(user=user, amount=50, stripe_charge_id=f"ch_{n}")
+            order.reference_code = f"reference{n}"
+            order.save()
+            Refund.objects.create(order=order, reference_code=order.reference_code, reason="Broken",
+                                  email='customer@example.com')
+            Comment.objects.create(user=user, item=self.items[0], comment=f"comment {n}")
+
+    def changelist_queries(self, name, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(f'admin:core_{name}_changelist'), params)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self.add_orders(2)
+        cache.clear()
+        small = {name: self.changelist_queries(name) for name in self.changelists}
+        self.add_orders(10)
+        cache.clear()
+        for name in self.changelists:
+            with self.subTest(changelist=name):
+                self.assertEqual(self.changelist_queries(name), small[name])
+
+    def test_count_is_cached(self):
+        self.add_orders(2)
+        cache.clear()
+        first = self.changelist_queries('cart')
+        self.assertEqual(self.changelist_queries('cart'), first - 1)
+
+    def test_search_by_reference_code_or_username(self):
+        self.add_orders(3)
+        for term in ('reference2', 'customer2'):
+            response = self.client.get(reverse('admin:core_cart_changelist'), {'q': term})
+            self.assertEqual([order.reference_code for order in response.context['cl'].result_list],
+                             ['reference2'])
+        response = self.client.get(reverse('admin:core_refund_changelist'), {'q': 'reference3'})
+        self.assertEqual([refund.reference_code for refund in response.context['cl'].result_list],
+                         ['reference3'])
+
+    def test_search_uses_indexes(self):
+        request = RequestFactory().get('/')
+        for model, term in ((Cart, 'reference1'), (Refund, 'reference1'), (Payment, 'ch_1')):
+            with self.subTest(model=model.__name__):
+                queryset, _ = admin.site._registry[model].get_search_results(request, model.objects.all(), term)
+                self.assertNotRegex(queryset.explain(), r'\bSCAN core_')
+
+
+class AdminChangeFormTests(TestCase):
+    """
+    Change forms must not list every user, item or address as an option
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=1, items_per_category=3, comments_per_item=1)
+        cls.admin = User.objects.create_superuser(username='admin', password='password')
+        cls.customer = User.objects.create_user(username='customer', email='customer@example.com')
+        cls.address = Address.objects.create(user=cls.customer, street_address='1 Road', apartment_address='2',
+                                             country='BD', zip_code='1000', address_type='B')
+        cls.order = seed_cart(cls.customer, cls.items[:2], ordered=True)
+        cls.order.billing_address = cls.address
+        cls.order.save()
+        cls.refund = Refund.objects.create(order=cls.order, reference_code='reference', reason="Broken",
+                                           email='customer@example.com')
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def add_rows(self, count):
+        for n in range(User.objects.count(), User.objects.count() + count):
+            user = User.objects.create_user(username=f"shopper{n}")
+            Address.objects.create(user=user, street_address='1 Road', apartment_address='2',
+                                   country='BD', zip_code='1000', address_type='S')
+            seed_cart(user, self.items[:1], ordered=True)
+
+    def change_form_queries(self, obj):
+        url = reverse(f'admin:core_{obj._meta.model_name}_change', args=[obj.pk])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, 'shopper')
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        objects = [self.order, self.order.items.first(), self.refund, self.address,
+                   Comment.objects.first(), self.customer.userprofile]
+        self.add_rows(2)
+        # The first form of each model also loads its content type into the cache
+        for obj in objects:
+            self.change_form_queries(obj)
+        small = [self.change_form_queries(obj) for obj in objects]
+        self.add_rows(10)
+        for obj, queries in zip(objects, small):
+            with self.subTest(model=obj._meta.model_name):
+                self.assertEqual(self.change_form_queries(obj), queries)
+
+    def autocomplete(self, model_name, field_name, term):
+        response = self.client.get(reverse('admin:autocomplete'), {
+            'term': term, 'app_label': 'core', 'model_name': model_name, 'field_name': field_name,
+        })
+        self.assertEqual(response.status_code, 200)
+        return [result['text'] for result in response.json()['results']]
+
+    def test_autocomplete_users_by_prefix(self):
+        self.assertEqual(self.autocomplete('cart', 'user', 'cust'), ['customer'])
+        self.assertEqual(self.autocomplete('cart', 'user', 'ustomer'), [])
+
+    def test_autocomplete_items_through_search_index(self):
+        self.assertEqual(self.autocomplete('orderitem', 'item', 'item 0-2'), ['item 0-2'])
+
+    def test_autocomplete_addresses_by_username(self):
+        self.assertEqual(self.autocomplete('cart', 'billing_address', 'customer'), ['customer'])
+        self.assertEqual(self.autocomplete('cart', 'billing_address', '100'), ['customer'])
+
+    def test_user_list_still_searches_names(self):
+        User.objects.filter(pk=self.customer.pk).update(first_name='Rahim')
+        response = self.client.get(reverse('admin:auth_user_changelist'), {'q': 'rahim'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.customer])
+
+    def test_autocomplete_searches_use_indexes(self):
+        Coupon.objects.create(coupon='SAVE10', amount=10)
+        request = RequestFactory().get(reverse('admin:autocomplete'))
+        for model, term in ((User, 'cust'), (Address, 'cust'), (Coupon, 'SAVE')):
+            with self.subTest(model=model.__name__):
+                queryset, _ = admin.site._registry[model].get_search_results(request, model.objects.all(), term)
+                self.assertEqual(queryset.count(), 1)
+                self.assertNotRegex(queryset.explain(), r'\bSCAN (auth_user|core_)')
+
+
+class CouponEngineTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=1, items_per_category=2, comments_per_item=0)
+        cls.user = User.objects.create_user(username='shopper', password='password')
+        cls.other = User.objects.create_user(username='other', password='password')
+        cls.coupon = Coupon.objects.create(coupon='SAVE5', amount=5)
+        cls.cart = seed_cart(cls.user, cls.items)
+        seed_cart(cls.other, cls.items)
+
+    def setUp(self):
+        cache.clear()
+        coupons.local_cache.clear()
+
+    def times_used(self, coupon):
+        return Coupon.objects.values_list('times_used', flat=True).get(pk=coupon.pk)
+
+    def test_paying_takes_one_use(self):
+        self.assertEqual(coupons.apply_coupon(self.user, ' SAVE5 '), coupons.APPLIED)
+        self.assertEqual(coupons.apply_coupon(self.user, 'SAVE5'), coupons.ALREADY_APPLIED)
+        self.assertEqual(Cart.objects.get(pk=self.cart.pk).coupon, self.coupon)
+        # Carts that are never paid for take no use
+        self.assertEqual(self.times_used(self.coupon), 0)
+        order = cart_service.finalize_order(self.user, 'ch_1', 'S', 'ref1')
+        self.assertEqual(order.coupon, self.coupon)
+        self.assertEqual(self.times_used(self.coupon), 1)
+
+    def test_lookups_are_cached(self):
+        coupons.get_coupon('SAVE5')
+        coupons.get_coupon('NOPE')
+        with self.assertNumQueries(0):
+            self.assertEqual(coupons.get_coupon('SAVE5'), self.coupon)
+            self.assertIsNone(coupons.get_coupon('NOPE'))
+            # Other processes find them in the shared cache
+            coupons.local_cache.clear()
+            self.assertEqual(coupons.get_coupon('SAVE5'), self.coupon)
+            self.assertIsNone(coupons.get_coupon('NOPE'))
+            self.assertEqual(coupons.apply_coupon(self.user, 'NOPE'), coupons.INVALID)
+
+    def test_saving_and_creating_coupons_uncaches_them(self):
+        coupons.get_coupon('SAVE5')
+        coupons.get_coupon('NEW10')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.coupon.amount = 7
+            self.coupon.save()
+            Coupon.objects.create(coupon='NEW10', amount=10)
+        self.assertEqual(coupons.get_coupon('SAVE5').amount, 7)
+        self.assertEqual(coupons.get_coupon('NEW10').amount, 10)
+
+    def test_expired_coupon(self):
+        Coupon.objects.create(coupon='OLD', amount=5, valid_until=timezone.now() - timezone.timedelta(minutes=1))
+        self.assertEqual(coupons.apply_coupon(self.user, 'OLD'), coupons.EXPIRED)
+        self.assertIsNone(Cart.objects.get(pk=self.cart.pk).coupon_id)
+
+    def test_max_uses_holds_at_payment(self):
+        coupon = Coupon.objects.create(coupon='ONCE', amount=5, max_uses=1)
+        self.assertEqual(coupons.apply_coupon(self.user, 'ONCE'), coupons.APPLIED)
+        self.assertEqual(coupons.apply_coupon(self.other, 'ONCE'), coupons.APPLIED)
+
+        def charge_while_used_up(**kwargs):
+            # The other customer's order takes the last use between the payment page's check and the charge
+            with self.captureOnCommitCallbacks(execute=True):
+                cart_service.finalize_order(self.user, 'ch_1', 'S', 'ref1')
+            return {'id': 'ch_2'}
+
+        self.client.force_login(self.other)
+        with mock.patch('core.views.stripe.Charge.create', side_effect=charge_while_used_up) as charge, \
+                self.assertLogs('core.cart', 'WARNING'), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('core:payment', kwargs={'payment_option': 'Stripe'}),
+                             {'stripeToken': 'tok_visa'}, follow=True)
+        order = Cart.objects.select_related('payment').get(user=self.other, ordered=True)
+        # Charged with the discount, and recorded as charged
+        self.assertEqual(order.payment.amount * 100, charge.call_args.kwargs['amount'])
+        self.assertEqual(order.total, order.payment.amount)
+        self.assertEqual(order.coupon, coupon)
+        self.assertEqual(self.times_used(coupon), 1)
+        # Redeeming dropped the cached copy, the next carts are turned away right away
+        Cart.objects.create(user=self.other, ordered_date=timezone.now())
+        self.assertEqual(coupons.apply_coupon(self.other, 'ONCE'), coupons.USED_UP)
+
+    def test_expired_coupon_is_taken_off_before_charging(self):
+        coupon = Coupon.objects.create(coupon='SOON', amount=5, valid_until=timezone.now() + timezone.timedelta(days=1))
+        coupons.apply_coupon(self.user, 'SOON')
+        Coupon.objects.filter(pk=coupon.pk).update(valid_until=timezone.now() - timezone.timedelta(minutes=1))
+        self.client.force_login(self.user)
+        path = reverse('core:payment', kwargs={'payment_option': 'Stripe'})
+        with mock.patch('core.views.stripe.Charge.create') as charge:
+            response = self.client.post(path, {'stripeToken': 'tok_visa'})
+        charge.assert_not_called()
+        self.assertRedirects(response, path, fetch_redirect_response=False)
+        self.assertIsNone(Cart.objects.get(pk=self.cart.pk).coupon_id)
+        self.assertEqual(self.times_used(coupon), 0)
+
+    def test_switching_coupons(self):
+        coupons.apply_coupon(self.user, 'SAVE5')
+        Coupon.objects.create(coupon='TEN', amount=10)
+        self.assertEqual(coupons.apply_coupon(self.user, 'TEN'), coupons.APPLIED)
+        self.assertEqual(Cart.objects.get(pk=self.cart.pk).coupon.coupon, 'TEN')
+
+    def test_view_without_open_cart(self):
+        Cart.objects.filter(user=self.other).delete()
+        self.client.force_login(self.other)
+        response = self.client.post(reverse('core:add_coupon'), {'coupon_code': 'SAVE5'}, follow=True)
+        self.assertIn("You have no active order", [str(message) for message in response.context['messages']])
+
+    def test_lru_evicts_and_expires(self):
+        lru = coupons.LRUCache(size=2, timeout=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+        with mock.patch('core.coupons.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(lru.get('a'))
+
+
+class RefundRequestTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=1, items_per_category=2, comments_per_item=0)
+        cls.user = User.objects.create_user(username='shopper', password='password')
+        cls.order = seed_cart(cls.user, cls.items, ordered=True)
+        cls.order.reference_code = cart_service.generate_reference_code()
+        cls.order.save()
+
+    def request(self, user=None, reference_code=None):
+        return refund_service.request_refund(user or self.user, reference_code or self.order.reference_code,
+                                             "Broken", 'shopper@example.com')
+
+    def test_request_once(self):
+        self.assertEqual(self.request(), refund_service.REQUESTED)
+        self.assertEqual(self.request(), refund_service.ALREADY_REQUESTED)
+        self.assertEqual(Refund.objects.filter(order=self.order).count(), 1)
+        self.assertTrue(Cart.objects.get(pk=self.order.pk).refund_requested)
+
+    def test_refunded_order(self):
+        Cart.objects.filter(pk=self.order.pk).update(refund_granted=True)
+        self.assertEqual(self.request(), refund_service.ALREADY_REFUNDED)
+        self.assertFalse(Refund.objects.exists())
+
+    def test_only_own_orders(self):
+        other = User.objects.create_user(username='other')
+        self.assertEqual(self.request(user=other), refund_service.NO_ORDER)
+        self.assertEqual(self.request(reference_code='unknown'), refund_service.NO_ORDER)
+
+    def test_reference_codes_are_unique(self):
+        codes = {cart_service.generate_reference_code() for _ in range(1000)}
+        self.assertEqual(len(codes), 1000)
+        self.assertTrue(all(len(code) == 20 and code.isalnum() for code in codes))
+        # Carts still shopping have no code and do not clash
+        seed_cart(User.objects.create_user(username='other'), self.items)
+        seed_cart(User.objects.create_user(username='third'), self.items)
+        with self.assertRaises(IntegrityError):
+            Cart.objects.create(user=self.user, ordered_date=timezone.now(), ordered=True,
+                                reference_code=self.order.reference_code)
+
+
+def stripe_refund(charge, idempotency_key, api_key):
+    return {'id': f"re_{charge}"}
+
+
+class RefundPipelineTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=1, items_per_category=2, comments_per_item=0)
+        cls.admin = User.objects.create_superuser(username='admin', password='password')
+        cls.customer = User.objects.create_user(username='customer', email='customer@example.com')
+        cls.orders = []
+        for n in range(5):
+            order = seed_cart(cls.customer, cls.items, ordered=True)
+            order.payment = Payment.objects.create(user=cls.customer, amount=50, stripe_charge_id=f"ch_{n}")
+            order.reference_code = f"reference{n}"
+            order.save()
+            cls.orders.append(order)
+
+    def grant(self, **kwargs):
+        return refund_service.grant_refunds(Cart.objects.filter(pk__in=[order.pk for order in self.orders]),
+                                            **kwargs)
+
+    @mock.patch('stripe.Refund.create', side_effect=stripe_refund)
+    def test_refunds_orders_in_chunks(self, create):
+        with CaptureQueriesContext(connection) as queries:
+            refunds = self.grant(chunk_size=2, workers=3)
+        self.assertEqual([refund.status for refund in refunds], [REFUND_GRANTED] * 5)
+        # Three chunks, each claimed in a transaction and settled in another
+        self.assertEqual(sum(query['sql'].startswith('SAVEPOINT') for query in queries), 6)
+        self.assertEqual(sorted(call.kwargs['idempotency_key'] for call in create.call_args_list),
+                         [f"refund-order-{order.pk}" for order in self.orders])
+        self.assertFalse(Cart.objects.filter(pk__in=[order.pk for order in self.orders], refund_granted=False).exists())
+        self.assertEqual(sorted(Refund.objects.values_list('stripe_refund_id', flat=True)),
+                         [f"re_ch_{n}" for n in range(5)])
+        self.assertEqual(set(Refund.objects.values_list('reason', flat=True)), {refund_service.ADMIN_REFUND_REASON})
+
+    def test_failed_refunds_are_retried(self):
+        def declined(charge, **kwargs):
+            if charge == 'ch_3':
+                raise stripe.error.InvalidRequestError("No such charge: 'ch_3'", 'charge')
+            return stripe_refund(charge, **kwargs)
+
+        with mock.patch('stripe.Refund.create', side_effect=declined):
+            refunds = self.grant(chunk_size=2)
+        failed = [refund for refund in refunds if refund.status == REFUND_FAILED]
+        self.assertEqual([refund.reference_code for refund in failed], ['reference3'])
+        self.assertIn("No such charge", failed[0].error)
+        self.assertFalse(Cart.objects.get(pk=self.orders[3].pk).refund_granted)
+
+        with mock.patch('stripe.Refund.create', side_effect=stripe_refund) as create:
+            refunds = self.grant(chunk_size=2)
+        self.assertEqual([(refund.reference_code, refund.status, refund.error) for refund in refunds],
+                         [('reference3', REFUND_GRANTED, '')])
+        self.assertEqual(create.call_count, 1)
+        self.assertEqual(Refund.objects.count(), 5)
+
+    @mock.patch('stripe.Refund.create', side_effect=stripe_refund)
+    def test_resumes_requested_and_interrupted_refunds(self, create):
+        requested = Refund.objects.create(order=self.orders[0], reference_code='reference0', reason="Broken",
+                                          email='customer@example.com')
+        interrupted = Refund.objects.create(order=self.orders[1], reference_code='reference1', reason="Late",
+                                            email='customer@example.com', status=REFUND_PROCESSING)
+        self.grant()
+        requested.refresh_from_db()
+        interrupted.refresh_from_db()
+        self.assertEqual((requested.status, requested.reason), (REFUND_GRANTED, "Broken"))
+        self.assertEqual((interrupted.status, interrupted.stripe_refund_id), (REFUND_GRANTED, 're_ch_1'))
+        self.assertIn(mock.call(charge='ch_1', idempotency_key=f"refund-order-{self.orders[1].pk}",
+                                api_key=settings.STRIPE_SECRET_KEY), create.call_args_list)
+        self.assertEqual(Refund.objects.count(), 5)
+
+    @mock.patch('stripe.Refund.create', side_effect=stripe_refund)
+    def test_orders_not_paid_through_stripe_fail(self, create):
+        Payment.objects.filter(pk=self.orders[0].payment_id).update(stripe_charge_id=None, ssl_charge_id='ssl_0')
+        refunds = self.grant()
+        self.assertEqual(refunds[0].status, REFUND_FAILED)
+        self.assertEqual(create.call_count, 4)
+
+    @mock.patch('stripe.Refund.create', side_effect=stripe_refund)
+    def test_admin_action_reports_each_failure(self, create):
+        Payment.objects.filter(pk=self.orders[0].payment_id).update(stripe_charge_id=None)
+        self.client.force_login(self.admin)
+        response = self.client.post(reverse('admin:core_cart_changelist'), {
+            'action': 'grant_refunds', '_selected_action': [order.pk for order in self.orders],
+        }, follow=True)
+        messages = [str(message) for message in response.context['messages']]
+        self.assertEqual(messages[0], "Refunded 4 orders")
+        self.assertIn("Order reference0 was not refunded", messages[1])
+
+
+@override_settings(REPLICA_DATABASES=['replica1', 'replica2'])
+class ReplicaRouterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = seed_catalog(categories=1, items_per_category=2, comments_per_item=2)
+        cls.user = User.objects.create_user(username='shopper', password='password')
+
+    def setUp(self):
+        cache.clear()
+        self.router = ReplicaRouter()
+        # Replica aliases are not configured in tests, the chosen "replica" is the primary itself
+        patcher = mock.patch('core.routers.choose_replica', return_value='default')
+        self.choose_replica = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_go_to_primary_outside_catalog_views(self):
+        self.assertEqual(self.router.db_for_read(Item), 'default')
+        self.assertEqual(self.router.db_for_write(Item), 'default')
+
+    def test_catalog_reads_go_to_the_chosen_replica_until_a_write(self):
+        def request():
+            with reading_from('replica2'):
+                self.assertEqual(self.router.db_for_read(Item), 'replica2')
+                self.assertEqual(self.router.db_for_read(Comment), 'replica2')
+                self.assertEqual(self.router.db_for_write(Comment), 'default')
+                self.assertEqual(self.router.db_for_read(Item), 'default')
+
+        # A fresh context, as each request gets from PinPrimaryMiddleware
+        contextvars.Context().run(request)
+
+    def test_migrations_only_run_on_primary(self):
+        self.assertTrue(self.router.allow_migrate('default', 'core'))
+        self.assertFalse(self.router.allow_migrate('replica1', 'core'))
+
+    def test_catalog_views_read_from_replica(self):
+        item = self.items[0]
+        self.client.force_login(self.user)
+        for path in [reverse('core:item_list'), reverse('core:item_list') + '?category=category0',
+                     reverse('core:item_list') + '?q=item', reverse('core:products', kwargs={'slug': item.slug}),
+                     reverse('core:item_comments', kwargs={'slug': item.slug})]:
+            self.choose_replica.reset_mock()
+            self.assertEqual(self.client.get(path).status_code, 200)
+            self.assertEqual(self.choose_replica.call_count, 1, path)
+
+    def test_anonymous_pages_are_cached_from_primary(self):
+        cache.clear()
+        self.client.get(reverse('core:products', kwargs={'slug': self.items[0].slug}))
+        self.choose_replica.assert_not_called()
+
+    def test_cart_and_checkout_read_from_primary(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('core:add_to_cart', kwargs={'slug': self.items[0].slug}))
+        self.client.cookies.pop(PIN_COOKIE, None)
+        for name in ['order_summary', 'checkout']:
+            self.client.get(reverse(f'core:{name}'))
+        self.choose_replica.assert_not_called()
+
+    def test_write_pins_client_to_primary(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('core:item_list'))
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+        self.assertEqual(self.choose_replica.call_count, 1)
+        response = self.client.post(reverse('core:comments', kwargs={'slug': self.items[0].slug}),
+                                    {'comment': 'Fresh'})
+        self.assertEqual(response.cookies[PIN_COOKIE]['max-age'], settings.REPLICA_PIN_SECONDS)
+        response = self.client.get(reverse('core:products', kwargs={'slug': self.items[0].slug}))
+        self.assertContains(response, 'Fresh')
+        self.assertEqual(self.choose_replica.call_count, 1)
+
+    @override_settings(REPLICA_DATABASES=[])
+    def test_no_replicas(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('core:add_to_cart', kwargs={'slug': self.items[0].slug}))
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+        self.client.get(reverse('core:item_list'))
+        self.choose_replica.assert_not_called()
+
+
+class StaleReplicaCacheTests(TransactionTestCase):
+    """
+    Caches filled while a view reads from a replica that is behind must hold what the primary has
+    """
+    def setUp(self):
+        self.replica_dir = tempfile.mkdtemp()
+        # A replica of its own, a copy of the primary taken before the catalog changes
+        connections.settings['stale'] = {**connections.settings['default'], 'TEST': {},
+                                         'NAME': os.path.join(self.replica_dir, 'stale.sqlite3')}
+        self.addCleanup(shutil.rmtree, self.replica_dir)
+        self.addCleanup(connections.settings.pop, 'stale')
+        self.addCleanup(connections.__delitem__, 'stale')
+        self.addCleanup(lambda: connections['stale'].close())
+
+        cache.clear()
+        self.items = seed_catalog(categories=1, items_per_category=2, comments_per_item=1)
+        self.user = User.objects.create_user(username='shopper', password='password')
+        with sqlite3.connect(connection.settings_dict['NAME']) as primary, \
+                sqlite3.connect(connections['stale'].settings_dict['NAME']) as replica:
+            primary.backup(replica)
+        primary.close()
+        replica.close()
+        # Rendered and cached before the change, as the site was
+        for path in [reverse('core:item_list'), reverse('core:products', kwargs={'slug': self.items[0].slug})]:
+            self.client.get(path)
+        self.items[0].item_name = "Renamed"
+        self.items[0].save()
+
+    @override_settings(REPLICA_DATABASES=['stale'])
+    def test_caches_are_filled_from_the_primary(self):
+        product = reverse('core:products', kwargs={'slug': self.items[0].slug})
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connections['stale']) as replica_queries:
+            for path in [reverse('core:item_list'), product]:
+                self.assertContains(self.client.get(path), "Renamed")
+        # The comments are not cached and still come from the replica
+        self.assertTrue(replica_queries)
+        self.client.logout()
+        for path in [reverse('core:item_list'), product]:
+            self.assertContains(self.client.get(path), "Renamed")
+            self.assertContains(self.client.get(path), "Renamed")
+        self.assertEqual(Item.objects.get_cached(slug=self.items[0].slug).item_name, "Renamed")
+
+    @override_settings(REPLICA_DATABASES=['stale'])
+    def test_cart_badge_is_counted_on_the_primary(self):
+        # Added after the replica was copied, and without the pin cookie the add-to-cart view would set
+        cart_service.add_item(self.user, self.items[0])
+        cart_service.add_item(self.user, self.items[1])
+        self.client.force_login(self.user)
+        for _ in range(2):
+            self.assertContains(self.client.get(reverse('core:item_list')), 'href="/order_summary/">2')
+
+
+class OpenCartConstraintTests(TestCase):
+    def test_second_open_cart_is_rejected(self):
+        user = User.objects.create_user(username='shopper', password='password')
+        Cart.objects.create(user=user, ordered_date=timezone.now())
+        Cart.objects.create(user=user, ordered_date=timezone.now(), ordered=True)
+        with self.assertRaises(IntegrityError):
+            Cart.objects.create(user=user, ordered_date=timezone.now())
+
+    def test_get_or_create_open_cart(self):
+        user = User.objects.create_user(username='shopper', password='password')
+        cart = cart_service.get_or_create_open_cart(user)
+        self.assertEqual(cart_service.get_or_create_open_cart(user), cart)
+        self.assertEqual(Cart.objects.filter(user=user).count(), 1)
+
+
+class AddToCartStressTests(TransactionTestCase):
+    """
+    Many requests adding to the same user's cart at once, the way double clicks and several open
+    tabs do, must leave one open cart holding every unit that was added
+    """
+    threads = 8
+    clicks = 5
+
+    def setUp(self):
+        self.items = seed_catalog(categories=1, items_per_category=2, comments_per_item=0)
+        self.user = User.objects.create_user(username='shopper', password='password')
+
+    def hammer(self):
+        barrier = threading.Barrier(self.threads)
+        errors = []
+
+        def shop(n):
+            client = Client()
+            client.force_login(self.user)
+            barrier.wait()
+            try:
+                for click in range(self.clicks):
+                    item = self.items[(n + click) % len(self.items)]
+                    response = client.get(reverse('core:add_to_cart', kwargs={'slug': item.slug}))
+                    if response.status_code != 302:
+                        errors.append(response.status_code)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=shop, args=(n,)) for n in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return errors
+
+    def test_concurrent_adds_share_one_cart(self):
+        self.assertEqual(self.hammer(), [])
+        carts = Cart.objects.filter(user=self.user, ordered=False)
+        self.assertEqual(carts.count(), 1)
+        lines = OrderItem.objects.filter(cart=carts.get())
+        # One line per item, and no click lost
+        self.assertEqual(lines.count(), len(self.items))
+        self.assertEqual(sum(lines.values_list('quantity', flat=True)), self.threads * self.clicks)
+        self.assertEqual(OrderItem.objects.count(), len(self.items))
+
+
+class RefundRequestStressTests(TransactionTestCase):
+    """
+    Requests for the refund of the same order sent at once must make a single refund
+    """
+    threads = 8
+
+    def test_concurrent_requests_make_one_refund(self):
+        items = seed_catalog(categories=1, items_per_category=1, comments_per_item=0)
+        user = User.objects.create_user(username='shopper', password='password')
+        order = seed_cart(user, items, ordered=True)
+        order.reference_code = cart_service.generate_reference_code()
+        order.save()
+        barrier = threading.Barrier(self.threads)
+        results = []
+
+        def request():
+            barrier.wait()
+            try:
+                results.append(refund_service.request_refund(user, order.reference_code, "Broken",
+                                                             'shopper@example.com'))
+            except Exception as e:
+                results.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=request) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(sorted(results), [refund_service.ALREADY_REQUESTED] * (self.threads - 1)
+                         + [refund_service.REQUESTED])
+        self.assertEqual(Refund.objects.filter(order=order).count(), 1)
+
+
+class LikeStressTests(TransactionTestCase):
+    """
+    Users liking the same item all at once must leave its like_count equal to its likes
+    """
+    threads = 8
+
+    def setUp(self):
+        self.item = seed_catalog(categories=1, items_per_category=1, comments_per_item=0)[0]
+        self.users = [User.objects.create_user(username=f'fan{n}', password='password')
+                      for n in range(self.threads)]
+
+    def test_concurrent_likes_are_all_counted(self):
+        barrier = threading.Barrier(self.threads)
+        errors = []
+
+        def like(user):
+            client = Client()
+            client.force_login(user)
+            barrier.wait()
+            try:
+                # Like, unlike and like again
+                for _ in range(3):
+                    client.get(reverse('core:likes', kwargs={'slug': self.item.slug}))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=like, args=(user,)) for user in self.users]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        item = Item.objects.get(pk=self.item.pk)
+        self.assertEqual(item.likes.count(), self.threads)
+        self.assertEqual(item.like_count, self.threads)
+
+
+class SQLiteProfileTests(TransactionTestCase):
+    """
+    Connections run the production profile's PRAGMAs and take the write lock when a transaction begins
+    """
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA {name}")
+            return cursor.fetchone()[0]
+
+    def test_pragmas(self):
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        # 1 is NORMAL
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('busy_timeout'), 5000)
+        self.assertEqual(self.pragma('cache_size'), -64000)
+
+    def test_transactions_begin_immediate(self):
+        other = sqlite3.connect(connection.settings_dict['NAME'], timeout=0, isolation_level=None)
+        self.addCleanup(other.close)
+        with transaction.atomic():
+            # Nothing written yet, but the write lock is already held
+            with self.assertRaisesMessage(sqlite3.OperationalError, 'database is locked'):
+                other.execute("BEGIN IMMEDIATE")
+        other.execute("BEGIN IMMEDIATE")
+        other.execute("ROLLBACK")
+
+    def test_benchmark_writes(self):
+        seed_catalog(categories=1, items_per_category=3, comments_per_item=0)
+        out = StringIO()
+        call_command('benchmark_writes', threads=2, orders=2, items_per_order=2, stdout=out)
+        self.assertRegex(out.getvalue(), r'default\s+\d+ writes')
+        self.assertRegex(out.getvalue(), r'production\s+12 writes\s+0 lock errors')
+        # The benchmark ran on copies, this database is untouched and still in WAL mode
+        self.assertFalse(User.objects.filter(username__startswith='benchmark-').exists())
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+
+
+class SeedDataCommandTests(TestCase):
+    def seed(self, **options):
+        options = {'categories': 3, 'items': 40, 'users': 10, 'orders_per_user': 3, 'lines_per_order': 2,
+                   'comments_per_item': 2, 'likes_per_item': 3, 'batch_size': 7, **options}
+        call_command('seed_data', stdout=StringIO(), **options)
+
+    def test_fills_every_table(self):
+        self.seed()
+        self.assertEqual(Category.objects.count(), 3)
+        self.assertEqual(Item.objects.count(), 40)
+        self.assertEqual(User.objects.count(), 10)
+        self.assertEqual(UserProfile.objects.count(), 10)
+        self.assertEqual(Address.objects.count(), 20)
+        self.assertEqual(Comment.objects.count(), 80)
+        self.assertTrue(Item.likes.through.objects.exists())
+        self.assertFalse(Item.objects.exclude(like_count=actual_like_count()).exists())
+        self.assertFalse(Item.objects.exclude(comment_count=actual_comment_count()).exists())
+        ordered = Cart.objects.filter(ordered=True)
+        self.assertEqual(Payment.objects.count(), ordered.count())
+        self.assertFalse(ordered.filter(payment__isnull=True).exists())
+        self.assertEqual(OrderItem.objects.count(), Cart.items.through.objects.count())
+        self.assertFalse(OrderItem.objects.filter(cart__isnull=True).exists())
+        self.assertEqual(OrderLine.objects.count(), OrderItem.objects.filter(ordered=True).count())
+        self.assertFalse(ordered.filter(total__isnull=True).exists())
+        self.assertEqual(get_search_backend().search(Item.objects.all(), 'seed').count(), 0)
+        self.assertTrue(get_search_backend().search(Item.objects.all(), Item.objects.first().item_name).exists())
+
+    def test_same_seed_generates_the_same_data(self):
+        self.seed(seed=7)
+        first = list(OrderItem.objects.order_by('pk').values_list('item__slug', 'quantity'))
+        Category.objects.all().delete()
+        User.objects.all().delete()
+        self.seed(seed=7)
+        second = list(OrderItem.objects.order_by('pk').values_list('item__slug', 'quantity'))
+        self.assertEqual(len(first), len(second))
+        # Ids continue after the deleted rows so slugs differ, only the shape has to match
+        self.assertEqual([quantity for _, quantity in first], [quantity for _, quantity in second])
@@ -3,7 +3,7 @@ from django.urls import path
 from .views import (HomeView, ItemDetailView, add_to_cart, remove_from_the_cart, OrderSummary,
                     remove_single_from_the_cart, CheckoutView, PaymentView, AddCouponView,
                     RequestRefundView, add_likes_to_product, CustomerProfileView, add_comment_to_item,
-                    complete_payment
+                    complete_payment, item_comments
                     )
 
 app_name = 'core'
@@ -19,6 +19,8 @@ urlpatterns = [
           PaymentView.as_view(), name="payment"),
      path('products/<slug>/',
           ItemDetailView.as_view(), name='products'),
+     path('products/<slug>/comments/',
+          item_comments, name='item_comments'),
      path('order_summary/',
           OrderSummary.as_view(), name='order_summary'),
      path('customer_profile/',
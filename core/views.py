@@ -1,74 +1,144 @@
-import random
-import string
 import socket
 
 import stripe
 from django.conf import settings
-from django.db.models import Q
-from django.utils import timezone
 from django.contrib import messages
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.paginator import InvalidPage
+from django.http import Http404
+from django.utils.decorators import method_decorator
+from django.utils.functional import cached_property
 from django.views.generic import ListView, DeleteView, View
 from django.views.decorators.csrf import csrf_exempt
-from django.shortcuts import render, get_object_or_404, redirect, reverse, HttpResponseRedirect
+from django.shortcuts import render, redirect, reverse, HttpResponseRedirect
 
 import requests
 from decimal import Decimal
 
-from .forms import CheckoutForm, CouponForm, RefundForm, CommentForm
-from .models import (Item, Cart, OrderItem, Address, Comment, Payment, Coupon,
-                     Refund, Category, UserProfile)
+from . import cart, coupons, refunds
+from .cache import (get_catalog_version, get_item_version, cache_anonymous_page,
+                    CATALOG_CACHE_TIMEOUT)
+from .forms import CheckoutForm, CouponForm, RefundForm, CommentForm, OrderHistoryFilterForm
+from .models import Item, Cart, Address, Comment, Category, UserProfile
+from .managers import get_cached_object_or_404
+from .pagination import KeysetPaginator, KeysetStream
+from .routers import replica_reads
+from .search import get_search_backend
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
+COMMENTS_PER_PAGE = 20
+# The charge id and amount of the last Stripe charge, until complete_payment records them
+CHARGED_AMOUNT_SESSION_KEY = 'charged_amount'
 
+
+def catalog_page_versions(**kwargs):
+    return (get_catalog_version(),)
+
+
+def product_page_versions(slug, **kwargs):
+    return get_catalog_version(), get_item_version(slug)
+
+
+@method_decorator(cache_anonymous_page(catalog_page_versions), name='dispatch')
+@method_decorator(replica_reads, name='dispatch')
 class HomeView(ListView):
     model = Item
     template_name = "home-page.html"
     paginate_by = 8
+    paginator_class = KeysetPaginator
     ordering = '-id'
 
     def get_queryset(self):
-        queryset = Item.objects.all()
+        queryset = Item.objects.select_related('item_category')
         category = self.kwargs.get('category_name')
         search_by = self.request.GET.get('key')
         # Return queryset filtered by the category
         if category:
             queryset = queryset.filter(item_category__category=category)
+        queryset = queryset.order_by('id')
+        # Searching goes through the full-text index and orders the result by relevance
         if search_by:
-            queryset = queryset.filter(
-                Q(item_category__category__icontains=search_by) |
-                Q(item_name__icontains=search_by)
-            )
-        return queryset.order_by('id')
+            queryset = get_search_backend().search(queryset, search_by)
+        return queryset
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        # Counts are cached per catalog version, so a new or deleted item shows up in them right away
+        return super().get_paginator(queryset, per_page, count_cache_version=self.catalog_version, **kwargs)
+
+    @cached_property
+    def catalog_version(self):
+        return get_catalog_version()
+
+    def paginate_queryset(self, queryset, page_size):
+        # Deep pages are reached through opaque cursors which seek by id instead of using an OFFSET
+        cursor = self.request.GET.get('cursor')
+        if not cursor:
+            return super().paginate_queryset(queryset, page_size)
+        paginator = self.get_paginator(queryset, page_size)
+        try:
+            page = paginator.page_from_cursor(cursor)
+        except InvalidPage as e:
+            raise Http404(str(e))
+        return paginator, page, page.object_list, page.has_other_pages()
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
-        host = self.request.get_host()
+        # Only evaluated when the cached sidebar has to be rendered again
         categories = Category.objects.all()
         context['categories'] = categories
-        context['host'] = host
+        context['catalog_version'] = self.catalog_version
+        context['catalog_cache_timeout'] = CATALOG_CACHE_TIMEOUT
         return context
 
 
+def comment_stream(item):
+    return KeysetStream(Comment.objects.filter(item=item).select_related('user'), COMMENTS_PER_PAGE, 'date')
+
+
+@method_decorator(cache_anonymous_page(product_page_versions), name='dispatch')
+@method_decorator(replica_reads, name='dispatch')
 class ItemDetailView(DeleteView):
     model = Item
     template_name = "product-page.html"
 
+    def get_object(self, queryset=None):
+        return get_cached_object_or_404(Item, slug=self.kwargs.get(self.slug_url_kwarg))
+
     def get_context_data(self, **kwargs):
-        slug = self.kwargs.get(self.slug_url_kwarg)
-        comments = Comment.objects.filter(item__slug=slug)
         context = super().get_context_data(**kwargs)
+        comments, next_cursor = comment_stream(self.object).batch()
         context['form'] = CommentForm()
         context['comments'] = comments
+        context['next_cursor'] = next_cursor
+        # Anonymous pages are cached and shared, only logged-in users get their own like state
+        if self.request.user.is_authenticated:
+            context['liked'] = self.object.is_liked_by(self.request.user)
         return context
 
 
+@cache_anonymous_page(product_page_versions)
+@replica_reads
+def item_comments(request, slug):
+    # The next batch of comments behind the product page's "load more" link
+    item = get_cached_object_or_404(Item, slug=slug)
+    try:
+        comments, next_cursor = comment_stream(item).batch(request.GET.get('cursor'))
+    except InvalidPage as e:
+        raise Http404(str(e))
+    context = {
+        'object': item,
+        'comments': comments,
+        'next_cursor': next_cursor
+    }
+    return render(request, 'comment_list.html', context)
+
+
 @login_required
 def add_comment_to_item(request, slug):
-    item = get_object_or_404(Item, slug=slug)
+    item = get_cached_object_or_404(Item, slug=slug)
     comment = request.POST['comment']
     Comment(
         user=request.user,
@@ -81,11 +151,13 @@ def add_comment_to_item(request, slug):
 class OrderSummary(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
         try:
-            order = Cart.objects.get(user=self.request.user, ordered=False)
-            if order.items.count() == 0:
+            order = Cart.objects.with_totals().select_related('coupon').get(user=self.request.user,
+                                                                            ordered=False)
+            if order.line_count == 0:
                 return redirect("core:item_list")
             context = {
-                'object': order
+                'object': order,
+                'order_items': order.items.with_prices()
             }
             return render(self.request, 'order_summary.html', context)
         except ObjectDoesNotExist:
@@ -94,104 +166,45 @@ class OrderSummary(LoginRequiredMixin, View):
 
 @login_required
 def add_likes_to_product(request, slug):
-    product = get_object_or_404(Item, slug=slug)
-    try:
-        liked_by_user = product.likes.get(pk=request.user.pk)
-        product.likes.remove(liked_by_user)
-        return redirect("core:products", slug=slug)
-    except ObjectDoesNotExist:
-        product.likes.add(request.user)
-        return redirect("core:products", slug=slug)
+    product = get_cached_object_or_404(Item, slug=slug)
+    product.toggle_like(request.user)
+    return redirect("core:products", slug=slug)
 
 
 @login_required
 def add_to_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    """
-    Get the instance of the ordered item from the OrderItem model if it exists otherwise create the instance 
-    get_or_create() returns a tuple of (object, created), where object is the retrieved or created object and created 
-    is a boolean specifying whether a new object was created.
-    """
-    ordered_item, is_created = OrderItem.objects.get_or_create(
-        user=request.user,
-        item=item,
-        ordered=False
-    )
-    user_cart = Cart.objects.filter(user=request.user, ordered=False)
-    if user_cart.exists():
-        user_order = user_cart[0]
-        filtered_user_cart_by_the_ordered_item = user_order.items.filter(item__slug=item.slug)
-        """
-        If the item is already in the user cart list just increase the item quantity in the OrderItem model
-        And you don't have to worry about the update of quantity in the user items field in the Cart model
-        As items field in the Cart model has ManyToMany relation to the item field of the OrderItem
-        It will automatically update the value in the Cart model in the user item field
-        """
-        if filtered_user_cart_by_the_ordered_item.exists():
-            ordered_item.quantity += 1
-            ordered_item.save()
-            messages.info(request, "The quantity was updated")
-        else:
-            user_order.items.add(ordered_item)
-    # If user does not have any item in the cart create the new instance in the Order model
+    item = get_cached_object_or_404(Item, slug=slug)
+    if cart.add_item(request.user, item) == cart.UPDATED:
+        messages.info(request, "The quantity was updated")
     else:
-        new_order = Cart.objects.create(
-            user=request.user,
-            ordered_date=timezone.now(),
-        )
-        new_order.items.add(ordered_item)
         messages.info(request, "The item was added to the cart")
     return redirect("core:order_summary")
 
 
 @login_required
 def remove_from_the_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    order_qs = Cart.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item,
-                user=request.user,
-                ordered=False
-            )[0]
-            order.items.remove(order_item)
-            order_item.delete()
-            messages.info(request, "This item was removed from your cart")
-        else:
-            messages.info(request, "This item is not in your cart")
-            return redirect("core:products", slug=slug)
-    else:
+    item = get_cached_object_or_404(Item, slug=slug)
+    result = cart.remove_item(request.user, item)
+    if result == cart.NO_CART:
         messages.info(request, "You have no order existed")
         return redirect("core:products", slug=slug)
+    if result == cart.NOT_IN_CART:
+        messages.info(request, "This item is not in your cart")
+        return redirect("core:products", slug=slug)
+    messages.info(request, "This item was removed from your cart")
     return redirect("core:order_summary")
 
 
 @login_required
 def remove_single_from_the_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    order_qs = Cart.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item,
-                user=request.user,
-                ordered=False
-            )[0]
-            if order_item.quantity == 1:
-                order.items.remove(order_item)
-                order_item.delete()
-            else:
-                order_item.quantity -= 1
-                order_item.save()
-            messages.info(request, "This quantity was updated")
-        else:
-            messages.info(request, "This item is not in your cart")
-    else:
+    item = get_cached_object_or_404(Item, slug=slug)
+    result = cart.remove_single_item(request.user, item)
+    if result == cart.NO_CART:
         messages.info(request, "You have no order existed")
-        return redirect("core:order_summary")
+    elif result == cart.NOT_IN_CART:
+        messages.info(request, "This item is not in your cart")
+    else:
+        messages.info(request, "This quantity was updated")
     return redirect("core:order_summary")
 
 
@@ -207,13 +220,15 @@ class CheckoutView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
         form = CheckoutForm()
         try:
-            order_items = Cart.objects.get(user=self.request.user, ordered=False)
-            if order_items.items.count() == 0:
+            order = Cart.objects.with_totals().select_related('coupon').get(user=self.request.user,
+                                                                            ordered=False)
+            if order.line_count == 0:
                 messages.info(self.request, "No item in your cart")
                 return redirect("core:item_list")
             context = {
                 'form': form,
-                "orders": order_items,
+                "orders": order,
+                "order_items": order.items.with_prices(),
                 'coupon_form': CouponForm(),
                 'DISPLAY_COUPON_FORM': True
             }
@@ -336,26 +351,24 @@ class CheckoutView(LoginRequiredMixin, View):
             return redirect("core:checkout")
 
 
+COUPON_ERRORS = {
+    coupons.INVALID: "There is no such coupon",
+    coupons.EXPIRED: "This coupon has expired",
+    coupons.USED_UP: "This coupon has been used up",
+    coupons.NO_CART: "You have no active order",
+}
+
+
 class AddCouponView(LoginRequiredMixin, View):
     def post(self, *args, **kwargs):
-        order = Cart.objects.get(user=self.request.user, ordered=False)
-        coupon_code = self.request.POST['coupon_code']
-        available_coupons = Coupon.objects.filter(coupon=coupon_code)
-        if available_coupons.exists():
-            coupon = Coupon.objects.get(coupon=coupon_code)
-            order.coupon = coupon
-            order.save()
-            messages.info(self.request, "coupon added")
-            return redirect('core:checkout')
+        result = coupons.apply_coupon(self.request.user, self.request.POST.get('coupon_code', ''))
+        if result in COUPON_ERRORS:
+            messages.error(self.request, COUPON_ERRORS[result])
+        elif result == coupons.ALREADY_APPLIED:
+            messages.info(self.request, "This coupon is already applied")
         else:
-            messages.error(self.request, "There is no such coupon")
-            return redirect('core:checkout')
-
-
-def generate_reference_code():
-    return "".join(random.choices(string.ascii_lowercase
-                                  + string.ascii_uppercase
-                                  + string.digits, k=20))
+            messages.info(self.request, "coupon added")
+        return redirect('core:checkout')
 
 
 class PaymentView(LoginRequiredMixin, View):
@@ -364,14 +377,16 @@ class PaymentView(LoginRequiredMixin, View):
         if payment_option == "SSL":
             return redirect('core:ssl_payment')
         try:
-            order = Cart.objects.get(user=self.request.user, ordered=False)
+            order = Cart.objects.with_totals().select_related('coupon').get(user=self.request.user,
+                                                                            ordered=False)
             user_profile = self.request.user.userprofile
-            if order.items.count() == 0:
+            if order.line_count == 0:
                 messages.info(self.request, "No item in your cart")
                 return redirect("core:item_list")
-            if order.billing_address:
+            if order.billing_address_id:
                 context = {
                     "orders": order,
+                    "order_items": order.items.with_prices(),
                     'coupon_form': CouponForm(),
                     'DISPLAY_COUPON_FORM': False
                 }
@@ -396,9 +411,14 @@ class PaymentView(LoginRequiredMixin, View):
             return redirect("core:item_list")
 
     def post(self, *args, **kwargs):
-        order = Cart.objects.get(user=self.request.user, ordered=False)
+        order = Cart.objects.with_totals().get(user=self.request.user, ordered=False)
+        problem = coupons.drop_unusable_coupon(order)
+        if problem:
+            # Charged nothing yet, the customer gets to see the total without the coupon first
+            messages.warning(self.request, f"{COUPON_ERRORS[problem]}, it was taken off your order")
+            return redirect("core:payment", payment_option="Stripe")
         userprofile = UserProfile.objects.get(user=self.request.user)
-        amount = int(order.get_total())
+        amount = int(order.final_total)
         stripe_charge_token = self.request.POST.get('stripeToken')
         save = self.request.POST.get('save')
         user_default = self.request.POST.get('use_default')
@@ -447,6 +467,8 @@ class PaymentView(LoginRequiredMixin, View):
                     source=stripe_charge_token
                 )
             messages.success(self.request, "Stripe Payment Successful")
+            # What was charged is recorded as is, kept out of the URL where it could be edited
+            self.request.session[CHARGED_AMOUNT_SESSION_KEY] = [charge['id'], amount]
             return redirect('core:complete_payment', tran_id=charge['id'], payment_type="S")
 
         except stripe.error.CardError as e:
@@ -488,6 +510,14 @@ class PaymentView(LoginRequiredMixin, View):
             return redirect("core:payment", payment_option="Stripe")
 
 
+REFUND_REQUEST_MESSAGES = {
+    refunds.REQUESTED: "Your request was successful",
+    refunds.ALREADY_REQUESTED: "Refund already requested for this order",
+    refunds.ALREADY_REFUNDED: "Already Refunded",
+    refunds.NO_ORDER: "No such order with that reference code",
+}
+
+
 class RequestRefundView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
         orders = Cart.objects.filter(user=self.request.user, ordered=True)
@@ -503,58 +533,51 @@ class RequestRefundView(LoginRequiredMixin, View):
     def post(self, *args, **kwargs):
         refund_form = RefundForm(self.request.POST)
         if refund_form.is_valid():
-            reference_code = refund_form.cleaned_data['reference_code']
-            try:
-                is_refund_already_granted = Cart.objects.filter(reference_code=reference_code, refund_granted=True)
-                is_refund_already_requested = Refund.objects.filter(reference_code=reference_code)
-                if is_refund_already_granted.exists():
-                    messages.info(self.request, "Already Refunded")
-                    return redirect('core:customer_profile')
-                elif is_refund_already_requested.exists():
-                    messages.info(self.request, "Refund already requested for this order")
-                    return redirect('core:customer_profile')
-                else:
-                    order = Cart.objects.get(reference_code=reference_code)
-                    order.refund_requested = True
-                    order.save()
-                    refund = Refund.objects.create(order=order, **refund_form.cleaned_data)
-                    refund.save()
-                    messages.info(self.request, "Your request was successful")
-                    return redirect("core:customer_profile")
-            except ObjectDoesNotExist:
-                messages.info(self.request, "No such order with that reference code")
-                return redirect("core:customer_profile")
+            result = refunds.request_refund(self.request.user, **refund_form.cleaned_data)
+            messages.info(self.request, REFUND_REQUEST_MESSAGES[result])
+            return redirect("core:customer_profile")
+        return render(self.request, 'request_refund.html', {"form": refund_form})
 
 
-class CustomerProfileView(LoginRequiredMixin, View):
-    def get(self, slug, *args, **kwargs):
-        orders = Cart.objects.filter(user=self.request.user, ordered=True)
-        if orders.exists():
-            context = {
-                "orders": orders
-            }
-            return render(self.request, 'customer_profile.html', context)
-        else:
+class CustomerProfileView(LoginRequiredMixin, ListView):
+    """
+    The user's order history, newest first, a page at a time and optionally filtered
+    Every page costs the same few queries: the count, the orders and their snapshotted lines.
+    """
+    template_name = 'customer_profile.html'
+    context_object_name = 'orders'
+    paginate_by = 10
+
+    def get(self, request, *args, **kwargs):
+        self.filter_form = OrderHistoryFilterForm(request.GET or None)
+        response = super().get(request, *args, **kwargs)
+        if not response.context_data['paginator'].count and not self.filter_form.is_filtered():
             messages.info(self.request, "You have not yet ordered anything from our site")
             return redirect("/")
+        return response
+
+    def get_queryset(self):
+        orders = Cart.objects.filter(user=self.request.user, ordered=True)
+        return self.filter_form.filter(orders).order_by('-ordered_date', '-id').prefetch_related('lines')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        context.update({
+            'filter_form': self.filter_form,
+            'filter_query': query.urlencode(),
+        })
+        return context
+
 
 @login_required
 def complete_payment(request, tran_id, payment_type):
-    order = Cart.objects.get(user=request.user, ordered=False)
-    amount = int(order.get_total())
-    payment = Payment()
-    payment.user = request.user
-    payment.amount = amount
-    payment.stripe_charge_id = tran_id
-    payment.save()
-
-    order.ordered = True
-    order.payment = payment
-    order.reference_code = generate_reference_code()
-    order.save()
-    users_order = OrderItem.objects.filter(user=request.user, ordered=False)
-    for order in users_order:
-        order.ordered = True
-        order.save()
+    charged_tran_id, amount = request.session.pop(CHARGED_AMOUNT_SESSION_KEY, [None, None])
+    if charged_tran_id != tran_id:
+        amount = None
+    order = cart.finalize_order(request.user, tran_id, payment_type, cart.generate_reference_code(), amount)
+    if order is None:
+        messages.error(request, "You have no active order")
     return HttpResponseRedirect(reverse('core:item_list'))
 
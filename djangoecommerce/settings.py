@@ -1,5 +1,5 @@
 import os
-from decouple import config
+from decouple import config, Csv
 
 from django_countries.widgets import LazyChoicesMixin
 
@@ -31,6 +31,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.routers.PinPrimaryMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -65,8 +66,36 @@ WSGI_APPLICATION = 'djangoecommerce.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # Django's SQLite backend tuned by SQLITE_PROFILE, see core.backends.sqlite3
+        'ENGINE': 'core.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # A file rather than the in-memory default, so threaded tests get real connections
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')},
+        # Seconds a connection is kept open for the next requests of its thread
+        'CONN_MAX_AGE': config('CONN_MAX_AGE', default=60, cast=int),
+        'CONN_HEALTH_CHECKS': True,
+    }
+}
+# 'production' runs SQLite in WAL mode with immediate transactions, 'default' as Django ships it
+SQLITE_PROFILE = config('SQLITE_PROFILE', default='production')
+
+# Read-only copies of the database the catalog pages read from, as a comma separated list of files,
+# e.g. REPLICA_DATABASES=replica.sqlite3 with a copy of db.sqlite3 standing in for a replica
+REPLICA_DATABASES = []
+for n, name in enumerate(config('REPLICA_DATABASES', default='', cast=Csv()), start=1):
+    DATABASES[f'replica{n}'] = {**DATABASES['default'], 'NAME': os.path.join(BASE_DIR, name),
+                                'TEST': {'MIRROR': 'default'}}
+    REPLICA_DATABASES.append(f'replica{n}')
+# Seconds a client that wrote keeps reading from the primary, longer than the replicas lag behind
+REPLICA_PIN_SECONDS = config('REPLICA_PIN_SECONDS', default=10, cast=int)
+DATABASE_ROUTERS = ['core.routers.ReplicaRouter']
+
+# Counters and listing fragments are cached here. Local memory is per process, so deployments
+# running several processes should point this at a shared cache such as memcached or redis
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
     }
 }
 
@@ -100,6 +129,11 @@ MEDIA_URL = '/media/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static_in_env')]
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Processes rendering thumbnails and WebP copies of uploaded item images
+IMAGE_WORKERS = config('IMAGE_WORKERS', default=2, cast=int)
+# Orders refunded per transaction by the admin's refund action, and Stripe calls made at once
+REFUND_BATCH_SIZE = config('REFUND_BATCH_SIZE', default=100, cast=int)
+REFUND_WORKERS = config('REFUND_WORKERS', default=8, cast=int)
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 